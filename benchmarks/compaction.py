@@ -0,0 +1,48 @@
+"""Compare tracing a grazing incidence system, where most rays miss the
+first mirror, with and without compacting away the lost rays between
+the elements.
+
+Run from the top directory: python benchmarks/compaction.py
+"""
+
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from phoray.element import Mirror, ReflectiveGrating, Screen
+from phoray.frame import GroupFrame
+from phoray.source import GaussianSource
+from phoray.surface import Plane, Sphere, Toroid
+
+
+def make_system():
+    source = GaussianSource(size=(1e-3, 1e-3, 0),
+                            divergence=(1e-2, 1e-2, 0),
+                            wavelength=1e-9, random_seed=0)
+    mirror = Mirror(geometry=Toroid(R=20, r=1, xsize=0.3, ysize=0.05),
+                    position=(0, 0, 1), rotation=(-85, 0, 0))
+    grating = ReflectiveGrating(d=1e-6, order=1,
+                                geometry=Sphere(10, xsize=0.3, ysize=0.2),
+                                position=(0, -0.1792, 1.9835),
+                                rotation=(85, 0, 0))
+    screen = Screen(geometry=Plane(xsize=0.5, ysize=0.5),
+                    position=(0, 0.1, 2.5))
+    return GroupFrame([source, mirror, grating, screen])
+
+
+def main():
+    system = make_system()
+    n = 10**6
+    for compact in (False, True):
+        t0 = time()
+        system.trace(n=n, compact=compact)
+        print("compact=%-5s %.3fs" % (compact, time() - t0))
+    print("\nsurviving rays out of %d:" % n)
+    for element, hits in system.survival():
+        print("%20s %8d" % (type(element).__name__, sum(hits.values())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Compare intersecting all rays with a surface with culling the rays
+that can't hit it first, for grazing incidence mirrors where most of
+the rays miss, and some were already lost by earlier elements.
+
+Run from the top directory: python benchmarks/culling.py
+"""
+
+import os
+import sys
+from time import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from phoray.ray import Rays
+from phoray.surface import Plane, Sphere, Toroid
+
+
+def grazing_rays(n, length, width, angle=2.0, overfill=5.0, dead=0.3):
+    """Rays at a grazing angle (degrees) to the xy plane, with a beam
+    footprint 'overfill' times larger than the mirror, and a fraction
+    of dead rays."""
+    g = np.radians(angle)
+    direction = np.array((np.cos(g), 0, np.sin(g)))
+    hits = np.zeros((n, 3))
+    hits[:, 0] = np.random.uniform(-1, 1, n) * length / 2 * overfill
+    hits[:, 1] = np.random.uniform(-1, 1, n) * width / 2 * 2
+    endpoints = hits - direction
+    endpoints[:int(n * dead)] = np.nan
+    return Rays(endpoints, np.tile(direction, (n, 1)), None)
+
+
+def main():
+    n = 10**6
+    surfaces = [("Plane", Plane(xsize=1.0, ysize=0.05)),
+                ("Sphere", Sphere(R=50, xsize=1.0, ysize=0.05)),
+                ("Toroid", Toroid(R=50, r=0.1, xsize=1.0, ysize=0.05))]
+    print("%d rays, 30%% dead, 2 degree grazing incidence" % n)
+    print("%8s %8s %12s %12s %9s" % ("surface", "hits", "all rays",
+                                     "culled", "speedup"))
+    for name, surface in surfaces:
+        rays = grazing_rays(n, surface.xsize, surface.ysize)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t0 = time()
+            surface._intersect(rays)
+            dt_all = time() - t0
+            t0 = time()
+            points = surface.intersect(rays)
+            dt_culled = time() - t0
+        hits = np.isfinite(points[:, 0]).sum()
+        print("%8s %8d %11.3fs %11.3fs %8.1fx" % (
+            name, hits, dt_all, dt_culled, dt_all / dt_culled))
+
+
+if __name__ == "__main__":
+    main()
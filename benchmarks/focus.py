@@ -0,0 +1,76 @@
+"""Compare the least squares focus estimate with the previous one, which
+looped over randomly sampled ray pairs, using rays focused by a
+spherical mirror. Then compare a focus scan with moving a detector
+and tracing again for each position.
+
+Run from the top directory: python benchmarks/focus.py
+"""
+
+import os
+import sys
+from time import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from phoray.element import Mirror, Detector
+from phoray.footprint import Moments
+from phoray.frame import GroupFrame
+from phoray.solver import closest_points
+from phoray.source import GaussianSource
+from phoray.surface import Sphere, Plane
+
+
+def pairwise_focus(rays, samples):
+    """The previous estimate: the mean of the closest points of
+    randomly chosen pairs of rays."""
+    p, r = rays.endpoints, rays.directions
+    total = 0
+    for _ in range(samples):
+        i, j = np.random.randint(0, len(rays), 2)
+        s, t = closest_points(p[i], r[i], p[j], r[j])
+        total = total + p[i] + s*r[i] + p[j] + t*r[j]
+    return total / (2 * samples)
+
+
+def main():
+    source = GaussianSource(divergence=(0.01, 0.01, 0), random_seed=0)
+    mirror = Mirror(geometry=Sphere(1), position=(0, 0, 1))
+    print("%10s %14s %14s" % ("rays", "pairs (1%)", "least squares"))
+    for n in (10**4, 10**5, 10**6):
+        rays = mirror.trace({0: [source.generate(n)]})[0][0]
+
+        samples = n // 100
+        if n <= 10**5:
+            t0 = time()
+            pairwise_focus(rays, samples)
+            dt_pairs = time() - t0
+            pairs = "%.4fs" % dt_pairs
+        else:
+            dt_pairs *= 10
+            pairs = "~%.1fs" % dt_pairs
+
+        t0 = time()
+        rays.estimate_focus()
+        dt = time() - t0
+        print("%10d %14s %13.4fs" % (n, pairs, dt))
+
+    n, distances = 10**5, np.linspace(0.3, 0.7, 50)
+    detector = Detector(geometry=Plane(), save_footprint=False,
+                        accumulators=dict(moments=Moments()))
+    system = GroupFrame([source, mirror, detector])
+    print("\n%d planes, %d rays:" % (len(distances), n))
+    t0 = time()
+    for distance in distances:
+        detector.position = (0, 0, 1 - distance)
+        system.trace(n=n)
+    print("%25s %.4fs" % ("moving the detector", time() - t0))
+    rays = mirror.trace({0: [source.generate(n)]})[0][0]
+    t0 = time()
+    rays.focus_scan(distances, origin=(0, 0, 1), axis=(0, 0, -1))
+    print("%25s %.4fs" % ("focus_scan", time() - t0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compare the vectorized quartic solver with looping over numpy.roots,
+using the polynomials that a toroidal mirror produces.
+
+Run from the top directory: python benchmarks/quartic.py
+"""
+
+import os
+import sys
+from time import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from phoray.solver import quartic
+from phoray.surface import Toroid
+
+
+def toroid_polynomials(n):
+    """Coefficients for n rays hitting a toroid near normal incidence."""
+    toroid = Toroid(R=2.0, r=0.5)
+    rx, ry, rz = np.random.normal(0, 0.05, (3, n))
+    rz += 1
+    ax, ay, az = np.random.uniform(-0.1, 0.1, (3, n))
+    az += toroid.R - 1
+    _R, _r = toroid._R, toroid.r
+    A = rx**2 + ry**2 + rz**2
+    B = 2*(ax*rx + ay*ry + az*rz)
+    C = (ax**2 + ay**2 + az**2) - _r**2 - _R**2
+    return np.array((A**2,
+                     2*A*B,
+                     B**2 + 2*A*C + 4*_R**2*ry**2,
+                     2*B*C + 8*_R**2*ay*ry,
+                     C**2 + 4*_R**2*ay**2 - 4*_R**2*_r**2)).T
+
+
+def main():
+    print("%10s %12s %12s %10s" % ("rays", "np.roots", "quartic", "speedup"))
+    for n in (10**3, 10**4, 10**5, 10**6):
+        poly = toroid_polynomials(n)
+
+        t0 = time()
+        quartic(poly)
+        dt_quartic = time() - t0
+
+        if n <= 10**5:
+            t0 = time()
+            np.array([np.roots(p) for p in poly])
+            dt_roots = time() - t0
+            roots = "%.4fs" % dt_roots
+        else:
+            # too slow to bother; extrapolate from the previous size
+            dt_roots *= 10
+            roots = "~%.1fs" % dt_roots
+        print("%10d %12s %11.4fs %9.0fx" % (n, roots, dt_quartic,
+                                            dt_roots / dt_quartic))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Compare tracing rays through a single mirror with the previous
+implementation, which wrapped each array of the Rays in numpy.ma and
+transformed them using (N, 4) temporaries. (The surfaces themselves
+only take Rays now, so both use the current ones.)
+
+Reports the time and the peak memory allocated during the trace, the
+latter also as a multiple of the size of the incoming ray data, and
+the most numpy arrays alive at once during the trace: all of them, and
+those holding at least one float per ray. The arrays are sampled with
+tracemalloc after each line, so temporaries within a line are missed.
+
+Run from the top directory: python benchmarks/rays.py
+"""
+
+import os
+import sys
+from time import time
+import tracemalloc
+from tracemalloc import DomainFilter
+
+import numpy as np
+from numpy import ma
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from phoray.element import Mirror
+from phoray.ray import Rays
+from phoray.surface import Sphere
+
+
+class ArraySampler:
+
+    """
+    Samples the numpy arrays alive while code in this repository runs,
+    through tracemalloc's numpy domain, after every line executed, and
+    keeps the most found at once: all of them and those of at least
+    'large' bytes. Temporaries that live within one line are missed,
+    since tracemalloc only knows the blocks that are still allocated.
+    """
+
+    domain = DomainFilter(True, np.lib.tracemalloc_domain)
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def __init__(self, large):
+        self.large = large
+        self.count = self.large_count = 0
+
+    def sample(self, frame, event, arg):
+        if not frame.f_code.co_filename.startswith(self.top):
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces([self.domain])
+        sizes = [trace.size for trace in snapshot.traces]
+        self.count = max(self.count, len(sizes))
+        self.large_count = max(self.large_count,
+                               sum(size >= self.large for size in sizes))
+        return self.sample
+
+    def __enter__(self):
+        tracemalloc.start()
+        sys.settrace(self.sample)
+        return self
+
+    def __exit__(self, *exc):
+        sys.settrace(None)
+        tracemalloc.stop()
+
+
+class MaskedRays(object):
+
+    """The previous container, kept here for comparison."""
+
+    def __init__(self, endpoints, directions, wavelengths):
+        self.endpoints = ma.array(endpoints)
+        self.directions = ma.array(directions)
+        self.wavelengths = ma.array(wavelengths)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def derive(self, endpoints, directions):
+        return MaskedRays(endpoints, directions, self.wavelengths)
+
+
+def transform_position(v, matrix):
+    tmp = np.ones((len(v), 4))
+    tmp[:, :3] = v
+    return np.dot(tmp, matrix)[:, :3]
+
+
+def transform_direction(v, matrix):
+    tmp = np.zeros((len(v), 4))
+    tmp[:, :3] = v
+    return np.dot(tmp, matrix)[:, :3]
+
+
+def previous_trace(mirror, rays):
+    """
+    Element.trace as it was, without the footprint. The surfaces only
+    take Rays now, so the masked arrays are converted for propagating.
+    """
+    local = MaskedRays(transform_position(rays.endpoints, mirror._matloc),
+                       transform_direction(rays.directions, mirror._matloc),
+                       rays.wavelengths)
+    local = Rays(local.endpoints.filled(np.nan),
+                 local.directions.filled(np.nan),
+                 local.wavelengths.filled(np.nan))
+    new_rays = mirror.propagate(local)
+    return MaskedRays(
+        transform_position(new_rays.endpoints, mirror._matglob),
+        transform_direction(new_rays.directions, mirror._matglob),
+        new_rays.wavelengths)
+
+
+def current_trace(mirror, rays):
+    return mirror.trace({0: [rays]})
+
+
+def measure(trace, mirror, rays):
+    tracemalloc.start()
+    t0 = time()
+    trace(mirror, rays)
+    dt = time() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dt, peak
+
+
+def count_arrays(trace, mirror, rays):
+    "The most arrays, and large ones, alive at once during the trace."
+    with ArraySampler(large=8 * len(rays)) as sampler:
+        trace(mirror, rays)
+    return sampler.count, sampler.large_count
+
+
+def main():
+    mirror = Mirror(geometry=Sphere(2, xsize=0.1, ysize=0.1),
+                    position=(0, 0, 1), rotation=(10, 0, 0),
+                    save_footprint=False)
+    columns = ("time", "peak", "x data", "arrays", "large")
+    print("%8s %-49s %s" % ("", "previous", "current"))
+    print("%8s" % "rays", " ".join(["%9s" % c for c in columns] * 2))
+    for n in (10**4, 10**5, 10**6):
+        endpoints = np.zeros((n, 3))
+        directions = np.random.normal(0, 0.01, (n, 3)) + (0, 0, 1)
+        wavelengths = np.ones(n)
+        size = endpoints.nbytes + directions.nbytes + wavelengths.nbytes
+
+        results = []
+        for trace, cls in ((previous_trace, MaskedRays),
+                           (current_trace, Rays)):
+            rays = cls(endpoints, directions, wavelengths)
+            dt, peak = measure(trace, mirror, rays)
+            results += [dt, peak / 1e6, peak / size,
+                        *count_arrays(trace, mirror, rays)]
+        print("%8d" % n, " ".join(
+            "%8.4fs %7.1fMB %9.1f %9d %9d" % tuple(results[i:i + 5])
+            for i in (0, 5)))
+
+
+if __name__ == "__main__":
+    main()
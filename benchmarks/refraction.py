@@ -0,0 +1,48 @@
+"""Compare tracing through a spherical lens with tracing via two
+spherical mirrors, i.e. the same number of surfaces of the same shape.
+
+Run from the top directory: python benchmarks/refraction.py
+"""
+
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from phoray.element import Mirror
+from phoray.frame import GroupFrame, SphericalLens
+from phoray.source import GaussianSource
+from phoray.surface import Sphere
+
+
+def make_source():
+    return GaussianSource(size=(1e-2, 1e-2, 0), divergence=(1e-3, 1e-3, 0),
+                          position=(0, 0, -1), random_seed=0)
+
+
+def make_lens():
+    source = make_source()
+    lens = SphericalLens(R1=1.0, R2=1.0, thickness=0.05, index=1.5)
+    return source, GroupFrame([source, lens])
+
+
+def make_mirrors():
+    source = make_source()
+    mirror1 = Mirror(geometry=Sphere(1.0), position=(0, 0, -0.025))
+    mirror2 = Mirror(geometry=Sphere(-1.0), position=(0, 0, -1.5))
+    return source, GroupFrame([source, mirror1, mirror2])
+
+
+def main():
+    n = 10**6
+    for name, make in (("lens", make_lens), ("mirrors", make_mirrors)):
+        source, system = make()
+        t0 = time()
+        trace = system.trace(n=n)[source._id]
+        print("%-8s %.3fs, %d rays left" % (name, time() - t0,
+                                            trace[-1].alive.sum()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import abc
 from collections import OrderedDict, Sequence
+from importlib import import_module
 import inspect
 
 from numpy import array, ndarray
@@ -107,3 +108,21 @@ def convert_attr(attr):
                 for item in attr]
     else:
         return attr
+
+
+def object_from_dict(objdict):
+    """Create an object from a dict as returned by object_to_dict."""
+    module, name = objdict["class"].split(".")
+    cls = getattr(import_module("phoray." + module), name)
+    args = {key: convert_dict_attr(value)
+            for key, value in objdict["args"].items()}
+    return cls(**args)
+
+
+def convert_dict_attr(attr):
+    if isinstance(attr, dict) and "class" in attr:
+        return object_from_dict(attr)
+    elif isinstance(attr, list):
+        return [convert_dict_attr(item) for item in attr]
+    else:
+        return attr
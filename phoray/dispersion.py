@@ -0,0 +1,119 @@
+"""
+Refractive indices that depend on the wavelength.
+
+A model is called with the wavelengths of the rays (in meters) and
+returns the index for each. Since sources usually emit only one or a
+few wavelengths, the index is computed once per unique wavelength and
+cached, instead of once per ray. The models should not be changed
+after they are first used.
+"""
+
+from abc import abstractmethod
+
+from numpy import array, asarray, full, interp, unique
+
+from . import PhorayBase
+
+
+class Dispersion(PhorayBase):
+
+    """Base class for dispersion models."""
+
+    # The most wavelengths to keep indices for; more than this probably
+    # means a continuous spectrum, where caching does not help.
+    cache_size = 1000
+
+    def __init__(self):
+        self._cache = {}
+
+    def __call__(self, wavelengths):
+        wavelengths = asarray(wavelengths)
+        if wavelengths.ndim == 0 or len(wavelengths) == 0:
+            return self.index(wavelengths)
+        first = wavelengths[0]
+        if (wavelengths == first).all():
+            return full(len(wavelengths), self._cached([first])[0])
+        lines, inverse = unique(wavelengths, return_inverse=True)
+        if len(lines) > self.cache_size:
+            return self.index(lines)[inverse]
+        return self._cached(lines)[inverse]
+
+    def _cached(self, lines):
+        missing = [w for w in lines if w not in self._cache]
+        if missing:
+            if len(self._cache) + len(missing) > self.cache_size:
+                self._cache.clear()
+                missing = list(lines)
+            self._cache.update(zip(missing, self.index(array(missing))))
+        return array([self._cache[w] for w in lines])
+
+    @abstractmethod
+    def index(self, wavelengths):
+        """Return the refractive index at each of the given wavelengths."""
+
+
+def refractive_index(index, wavelengths):
+    """The index for the given wavelengths; index may be a number or a
+    dispersion model."""
+    if isinstance(index, Dispersion):
+        return index(wavelengths)
+    return index
+
+
+class Sellmeier(Dispersion):
+
+    """
+    The Sellmeier equation, n^2 = 1 + sum(B_i l^2 / (l^2 - C_i)), with
+    the coefficients for the wavelength l in micrometers, as they are
+    usually given. The default is Schott N-BK7.
+    """
+
+    def __init__(self, B:[float]=(1.03961212, 0.231792344, 1.01046945),
+                 C:[float]=(0.00600069867, 0.0200179144, 103.560653)):
+        self.B = list(B)
+        self.C = list(C)
+        Dispersion.__init__(self)
+
+    def index(self, wavelengths):
+        l2 = (asarray(wavelengths) * 1e6)**2
+        n2 = 1.0
+        for b, c in zip(self.B, self.C):
+            n2 = n2 + b * l2 / (l2 - c)
+        return n2**0.5
+
+
+class Cauchy(Dispersion):
+
+    """
+    Cauchy's equation, n = A + B / l^2 + C / l^4 + ..., with the
+    coefficients for the wavelength l in micrometers.
+    """
+
+    def __init__(self, coefficients:[float]=(1.5046, 0.00420)):
+        self.coefficients = list(coefficients)
+        Dispersion.__init__(self)
+
+    def index(self, wavelengths):
+        l2 = (asarray(wavelengths) * 1e6)**2
+        n = 0.0
+        for c in reversed(self.coefficients):
+            n = n / l2 + c
+        return n
+
+
+class Tabulated(Dispersion):
+
+    """
+    Indices measured at the given wavelengths (in meters, increasing),
+    interpolated linearly in between. Outside the table, the index at
+    the nearest end is used.
+    """
+
+    def __init__(self, wavelengths:[float]=(4e-7, 8e-7),
+                 indices:[float]=(1.0, 1.0)):
+        self.wavelengths = list(wavelengths)
+        self.indices = list(indices)
+        Dispersion.__init__(self)
+
+    def index(self, wavelengths):
+        return interp(wavelengths, self.wavelengths, self.indices)
@@ -0,0 +1,113 @@
+"""
+The fraction of the intensity that an element passes on, e.g. the
+reflectivity of a mirror or the efficiency of a grating, as a function
+of the incidence angle and the wavelength of each ray. It is applied
+to the weights of the rays.
+
+An efficiency is either a number, or a model called with the incidence
+angles (in degrees from the surface normal) and the wavelengths (in
+meters) of the rays.
+"""
+
+from abc import abstractmethod
+
+from numpy import (array, asarray, arccos, degrees, interp, linspace,
+                   minimum, nan_to_num, absolute, einsum)
+
+from . import PhorayBase
+
+
+class Efficiency(PhorayBase):
+
+    """Base class for efficiency models."""
+
+    @abstractmethod
+    def __call__(self, angles, wavelengths):
+        """Return the efficiency for each of the given rays."""
+
+
+def incidence_angles(directions, normals):
+    """The angles (in degrees) between the rays and the surface normals,
+    regardless of which side the rays come from."""
+    cosines = absolute(einsum("ij,ij->i", directions, normals))
+    return degrees(arccos(minimum(cosines, 1)))
+
+
+def throughput(efficiency, rays, normals):
+    """
+    The factor to multiply the weights of the rays with, given an
+    efficiency and the normals where the rays hit; None if the weights
+    are unchanged.
+    """
+    if isinstance(efficiency, Efficiency):
+        return efficiency(incidence_angles(rays.directions, normals),
+                          rays.wavelengths)
+    if efficiency == 1:
+        return None
+    return efficiency
+
+
+class EfficiencyTable(Efficiency):
+
+    """
+    Efficiencies measured (or calculated) at the given incidence angles
+    and wavelengths, both increasing, interpolated linearly in between.
+    The values are given for each angle in turn, over all wavelengths.
+    Outside the table, the value at the nearest edge is used.
+
+    For speed, the table is resampled once onto a regular grid with
+    'resolution' points along each axis, where the cell of each ray is
+    found by arithmetic instead of by searching.
+    """
+
+    resolution = 256
+
+    def __init__(self, angles:[float]=(0, 90), wavelengths:[float]=(0, 1),
+                 values:[float]=(1, 1, 1, 1)):
+        self.angles = list(angles)
+        self.wavelengths = list(wavelengths)
+        self.values = list(values)
+        self._grid = None
+
+    def _make_grid(self):
+        table = asarray(self.values, dtype=float).reshape(
+            len(self.angles), len(self.wavelengths))
+        angles = linspace(self.angles[0], self.angles[-1], self.resolution)
+        wavelengths = linspace(self.wavelengths[0], self.wavelengths[-1],
+                               self.resolution)
+        # Linear interpolation is separable, one axis at a time
+        rows = array([interp(wavelengths, self.wavelengths, row)
+                      for row in table])
+        grid = array([interp(angles, self.angles, column)
+                      for column in rows.T]).T
+        self._grid = grid.ravel()
+
+    @staticmethod
+    def _cells(values, lower, upper, n):
+        "The cell of each value on a regular grid, and the position in it."
+        scale = (n - 1) / (upper - lower) if upper > lower else 0.0
+        f = nan_to_num(values - lower) * scale
+        f = f.clip(0, n - 1)
+        i = minimum(f.astype(int), n - 2)
+        return i, f - i
+
+    def __call__(self, angles, wavelengths):
+        if self._grid is None:
+            self._make_grid()
+        n = self.resolution
+        i, s = self._cells(angles, self.angles[0], self.angles[-1], n)
+        if len(wavelengths) and (wavelengths == wavelengths[0]).all():
+            # Only one wavelength, so interpolate in angle only
+            j, t = self._cells(wavelengths[:1], self.wavelengths[0],
+                               self.wavelengths[-1], n)
+            column = self._grid.reshape(n, n)[:, j[0]:j[0] + 2]
+            column = column[:, 0] + (column[:, 1] - column[:, 0]) * t[0]
+            lower = column[i]
+            return lower + (column[i + 1] - lower) * s
+        j, t = self._cells(wavelengths, self.wavelengths[0],
+                           self.wavelengths[-1], n)
+        k = i * n + j
+        grid = self._grid
+        lower = grid[k] + (grid[k + 1] - grid[k]) * t
+        upper = grid[k + n] + (grid[k + n + 1] - grid[k + n]) * t
+        return lower + (upper - lower) * s
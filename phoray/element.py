@@ -1,55 +1,169 @@
 from __future__ import division
-from collections import defaultdict
+from collections import defaultdict, Counter
 from math import *
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta
 
-from numpy import array, NaN, empty, isfinite
+from numpy import NaN, isfinite, isinf, arcsin, cos
 
-from .member import Member
-from .surface import Surface
-from .ray import Rays
+from .dispersion import refractive_index
+from .efficiency import throughput
+from .footprint import Points
+from .member import Member, transform
+from .surface import Surface, Plane, Sphere, Cylinder, Toroid
 
 __all__ = ["Mirror", "Detector", "Screen", "ReflectiveGrating"]
 
 
+def split_key(key, order):
+    """
+    The key of the rays of the given order, split from the rays with
+    the given key by a grating, e.g. (source, order). Rays split again
+    get keys like (source, order1, order2).
+    """
+    return key + (order,) if isinstance(key, tuple) else (key, order)
+
+
+def split_parent(key):
+    """The key of the rays that the rays with the given key were split
+    from, or None if they were not split."""
+    if not isinstance(key, tuple):
+        return None
+    return key[:-1] if len(key) > 2 else key[0]
+
+
 class Element(Member, metaclass=ABCMeta):
 
     """This abstract class represents an optical element, i.e. something
-    that can be used to change the path of rays during a trace. It cannot
-    be instantiated itself, but should be inherited by real element
-    classes.
+    that can be used to change the path of rays during a trace. It should
+    not be instantiated itself, but be inherited by real element classes,
+    which implement either interact or, if that is not enough, propagate.
     """
 
-    def __init__(self, geometry:Surface, save_footprint=True, *args, **kwargs):
+    # Whether interact needs the surface normals.
+    uses_normals = True
+
+    # Whether the element splits the rays, see split_key.
+    splits = False
+
+    def __init__(self, geometry:Surface, save_footprint=True,
+                 accumulators=None, *args, **kwargs):
         self.geometry = geometry
+        # Footprint accumulators by name, e.g. {"image": Histogram()},
+        # used as templates for the ones kept for each source.
+        self.accumulators = dict(accumulators or {})
         self.save_footprint = save_footprint
-        self.footprint = defaultdict(list)
+        self._accumulated = defaultdict(dict)
+        # The number of rays from each source that hit the element
+        self.hits = Counter()
         Member.__init__(self, *args, **kwargs)
 
-    def trace(self, incoming, _):
+    @property
+    def save_footprint(self):
+        "Whether to keep every point where a ray hit the element."
+        return "points" in self.accumulators
+
+    @save_footprint.setter
+    def save_footprint(self, save):
+        if save:
+            self.accumulators.setdefault("points", Points())
+        else:
+            self.accumulators.pop("points", None)
+
+    @property
+    def footprint(self):
+        """
+        The (x, y, wavelength, weight) where rays from each source have
+        hit the element, accumulated since the latest reset_footprint.
+        """
+        return {source: acc.result()
+                for source, acc in self.accumulated("points").items()}
+
+    def accumulated(self, name):
+        """Return the accumulator of the given name for each source."""
+        return {source: accs[name]
+                for source, accs in self._accumulated.items()
+                if name in accs}
+
+    def reset_footprint(self):
+        self._accumulated.clear()
+        self.hits.clear()
+
+    def trace(self, incoming, n=1, outer=None):
+        self.reset_footprint()
+        current = {source: rays[-1] for source, rays in incoming.items()}
+        outgoing = self._trace(current, n, *self.composed_matrices(outer))
+        return {source: [rays] for source, rays in outgoing.items()}
+
+    def _trace(self, current, n, matloc, matglob):
+        """
+        Propagate the latest rays from each source, given the matrices
+        transforming them to and from the local coordinate system.
+        """
         outgoing = {}
-        for source, rays in incoming.items():
-            new_rays = self.propagate(self.localize(rays[-1]))
-            if self.save_footprint:
-                fp = array((new_rays.endpoints.T[0],
-                            new_rays.endpoints.T[1],
-                            new_rays.wavelengths))
-                # remove rays that missed
-                self.footprint[source] = fp.T[isfinite(fp[0])]
-            outgoing[source] = [self.globalize(new_rays)]
+        for source, rays in current.items():
+            new_rays = self.propagate(transform(rays, matloc))
+            self.record_footprint(source, new_rays)
+            outgoing[source] = transform(new_rays, matglob, out=new_rays)
         return outgoing
 
-    @abstractmethod
+    def record_footprint(self, source, rays):
+        """Accumulate where the (local) rays from the source hit the element."""
+        # remove rays that missed
+        hit = rays.alive & isfinite(rays.endpoints[:, 0])
+        self.hits[source] += int(hit.sum())
+        if not self.accumulators:
+            return
+        x, y = rays.endpoints[hit, :2].T
+        wavelengths, weights = rays.data[hit, 6:8].T
+        accumulated = self._accumulated[source]
+        for name, template in self.accumulators.items():
+            if name not in accumulated:
+                accumulated[name] = template.empty()
+            accumulated[name].add(x, y, wavelengths, weights)
+
+    def merge_footprint(self, source, accumulated, hits=0):
+        """Merge accumulators, e.g. from another process, into ours."""
+        self.hits[source] += hits
+        mine = self._accumulated[source]
+        for name, acc in accumulated.items():
+            if name in mine:
+                mine[name].merge(acc)
+            else:
+                mine[name] = acc
+
     def propagate(self, rays):
         """Return the rays as modified by the element; e.g. reflected."""
+        if self.uses_normals:
+            points, normals = self.geometry.intersect_with_normal(rays)
+        else:
+            points, normals = self.geometry.intersect(rays), None
+        new_rays = rays.derive(points, self.interact(rays, points, normals))
+        factor = self.throughput(rays, normals)
+        if factor is not None:
+            new_rays.weights *= factor
+        return new_rays
+
+    def interact(self, rays, points, normals):
+        """Return the new directions of the rays hitting the surface at
+        the given points, where it has the given normals."""
+        raise NotImplementedError
+
+    def throughput(self, rays, normals):
+        """Return the factor to multiply the weights of the rays hitting
+        the surface with, where it has the given normals, or None if the
+        weights are unchanged. See efficiency.py."""
+        return None
 
 
 class Mirror(Element):
 
-    """A mirror reflects incoming rays in its surface."""
+    """A mirror reflects incoming rays in its surface. The reflectivity
+    may be a number or an efficiency model."""
 
     def __init__(self, use_fermat:bool=False, incidence_angle:float=10,
-                 entrance_arm:float=1, exit_arm:float=1, *args, **kwargs):
+                 entrance_arm:float=1, exit_arm:float=1,
+                 reflectivity:float=1.0, *args, **kwargs):
+        self.reflectivity = reflectivity
         self.exit_arm = exit_arm
         self.entrance_arm = entrance_arm
         self.incidence_angle = incidence_angle
@@ -64,8 +178,11 @@ class Mirror(Element):
 
         Element.__init__(self, *args, **kwargs)
 
-    def propagate(self, rays):
-        return self.geometry.reflect(rays)
+    def interact(self, rays, points, normals):
+        return self.geometry.reflect_directions(rays.directions, normals)
+
+    def throughput(self, rays, normals):
+        return throughput(self.reflectivity, rays, normals)
 
 
 class Detector(Element):
@@ -74,11 +191,10 @@ class Detector(Element):
     be the final element in a system.
     """
 
-    def propagate(self, rays):
-        p = self.geometry.intersect(rays)
-        nans = empty((len(rays), 3))
-        nans[:] = (NaN, NaN, NaN)
-        return Rays(p, nans, rays.wavelengths)
+    uses_normals = False
+
+    def interact(self, rays, points, normals):
+        return NaN
 
 
 class Screen(Element):
@@ -88,78 +204,142 @@ class Screen(Element):
     intersection of a beam.
     """
 
-    def propagate(self, rays):
-        p = self.geometry.intersect(rays)
-        return Rays(p, rays.directions, rays.wavelengths)
+    uses_normals = False
+
+    def interact(self, rays, points, normals):
+        return rays.directions
 
 
 class ReflectiveGrating(Element):
 
     """A reflective grating diffracts incoming rays reflectively."""
 
-    def __init__(self, d:float=0., order:int=0, *args, **kwargs):
+    def __init__(self, d:float=0., order:int=0, efficiency:float=1.0,
+                 orders:[int]=None, *args, **kwargs):
         """
         Define a reflecting element with geometry shape given by s. If
         d>0 it will work as a grating with line spacing d and lines in
         the xz-plane and diffraction order given by order. Otherwise
-        it works as a plain mirror.
+        it works as a plain mirror. The efficiency may be a number or
+        an efficiency model, applied to whichever order is traced, or
+        a dict with one of those for each order.
+
+        If a list of orders is given, it is used instead of order, and
+        the rays from each source are split into one batch per order,
+        traced further under the key (source, order); see split_key.
+        Each batch carries the full incoming weights times the
+        efficiency of its order, so give a dict of efficiencies unless
+        the orders are meant to be compared one by one.
         """
+        if orders is not None and not len(orders):
+            raise ValueError("A grating needs at least one order to trace")
+        if isinstance(efficiency, dict):
+            missing = set(orders or [order]) - set(efficiency)
+            if missing:
+                raise ValueError("No efficiency given for order(s) %s"
+                                 % ", ".join(map(str, sorted(missing))))
         self.d = d
         self.order = order
+        self.orders = orders
+        self.efficiency = efficiency
         #print "Mirror", args, kwargs
         Element.__init__(self, *args, **kwargs)
 
-    def propagate(self, rays):
-        diffracted_rays = self.geometry.diffract(
-            rays, self.d, self.order)
-        return diffracted_rays
+    def interact(self, rays, points, normals):
+        return self.geometry.diffract_directions(rays, points, normals,
+                                                 self.d, self.order)
+
+    def throughput(self, rays, normals, order=None):
+        efficiency = self.efficiency
+        if isinstance(efficiency, dict):
+            efficiency = efficiency[self.order if order is None else order]
+        return throughput(efficiency, rays, normals)
+
+    @property
+    def splits(self):
+        return self.orders is not None
+
+    def _trace(self, current, n, matloc, matglob):
+        if not self.splits:
+            return Element._trace(self, current, n, matloc, matglob)
+        outgoing = {}
+        for source, rays in current.items():
+            local = transform(rays, matloc)
+            points, normals = self.geometry.intersect_with_normal(local)
+            directions = self.geometry.diffract_orders(
+                local, points, normals, self.d, self.orders)
+            for order, dirs in zip(self.orders, directions):
+                new_rays = local.derive(points, dirs)
+                factor = self.throughput(local, normals, order)
+                if factor is not None:
+                    new_rays.weights *= factor
+                key = split_key(source, order)
+                self.record_footprint(key, new_rays)
+                outgoing[key] = transform(new_rays, matglob, out=new_rays)
+        return outgoing
 
 
 class ReflectiveVLSGrating(Mirror):
 
-    """A grating with varying line spacing. Not complete."""
+    """A grating with varying line spacing."""
 
-    def __init__(self, an:[float]=[1.0], *args, **kwargs):
+    def __init__(self, an:[float]=[1.0], order:int=1, *args, **kwargs):
         self.an = an
+        self.order = order
         Mirror.__init__(self, *args, **kwargs)
 
+    def _radius(self):
+        "The radius of curvature of the surface along y, in m."
+        geometry = self.geometry
+        if isinstance(geometry, Plane):
+            return inf
+        if isinstance(geometry, (Sphere, Cylinder)):
+            return geometry.R
+        if isinstance(geometry, Toroid):
+            return geometry.r  # the sagittal radius, in the yz plane
+        raise ValueError("VLS gratings are only supported on a Plane, "
+                         "Sphere, Cylinder or Toroid, not a %s"
+                         % type(geometry).__name__)
+
     def get_line_distance(self, p):
         """
-        Returns the local grating line density according to VLS
-        parameters a(x) = a_0 + a_1*x + ... + a_n*x^n where x is the
-        distance to the grating center.
+        Returns the local grating line distance (in m) at the points p,
+        according to VLS parameters giving the line density (in 1/mm)
+        a(x) = a_0 + a_1*x + ... + a_n*x^n, where x is the distance (in
+        mm) to the grating center, along the surface.
         """
-
-        y = 1000 * p.y
-        R = 1000 * self.geometry.R
-        x = copysign(sqrt(y ** 2 + (R - sqrt(R ** 2 - y ** 2))), y)
-        x = 2 * R * asin(x / (2 * R))
-        #x=y
-        b = -x / sqrt(R ** 2 - x ** 2)
-        theta = atan(b)  # grating tangent angle
-        #print b, theta
+        y = 1000 * p[:, 1]
+        R = 1000 * self._radius()
+        # The arc length from the center along the circular profile of
+        # the surface, and the tangent angle of the surface there
+        angle = 0 if isinf(R) else arcsin(y / R)
+        x = y if isinf(R) else R * angle
         d = 0
-        for n, a in enumerate(self.an):
-            d += a * x ** n
-        d *= cos(theta)
+        for a in reversed(self.an):
+            d = d * x + a
+        d *= cos(angle)
         return 1e-3 / d
 
-    def propagate(self, rays):
-        diffracted_rays = self.geometry.diffract(rays, None, self.order,
+    def interact(self, rays, points, normals):
+        return self.geometry.diffract_directions(rays, points, normals, None,
+                                                 self.order,
                                                  self.get_line_distance)
-        return self.globalize(diffracted_rays)
 
 
 class Glass(Element):
 
-    """A glass surface, defined by the refraction indices on each side."""
+    """A glass surface, defined by the refraction indices on each side.
+    Each index may be a number, or a dispersion model, see dispersion.py.
+    """
 
     def __init__(self, index1:float=1.0, index2:float=1.0, *args, **kwargs):
         self.index1 = index1
         self.index2 = index2
         Element.__init__(self, *args, **kwargs)
 
-    def propagate(self, rays):
-        refracted_rays = self.geometry.refract(rays, self.index1,
-                                               self.index2)
-        return refracted_rays
+    def interact(self, rays, points, normals):
+        wavelengths = rays.wavelengths
+        return self.geometry.refract_directions(
+            rays.directions, normals,
+            refractive_index(self.index1, wavelengths),
+            refractive_index(self.index2, wavelengths))
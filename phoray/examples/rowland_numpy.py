@@ -77,7 +77,7 @@ print("Done, took %f s" % (time() - t0))
 datafile = "rowland.dat"
 print("Writing detector image to '%s'" % datafile)
 with open(datafile, "w") as f:
-    f.write("# xpos [m]\typos [m]\twavelength [m]\n")
+    f.write("# xpos [m]\typos [m]\twavelength [m]\tweight\n")
     w = csv.writer(f, delimiter="\t")
     for energy in list(s.children[-1].footprint.values()):
         w.writerows(energy)
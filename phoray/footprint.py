@@ -0,0 +1,214 @@
+"""
+Accumulators that summarize the footprints of rays on an element,
+chunk by chunk, without keeping the individual points.
+
+An element keeps one accumulator per source for each accumulator it
+is given; they are created with empty() from the given ones, which
+only serve as templates.
+"""
+
+from abc import ABCMeta, abstractmethod
+from copy import deepcopy
+
+from numpy import (array, zeros, empty, bincount, floor, sqrt, sum, dot,
+                   vstack, linspace, ones)
+
+
+class Accumulator(metaclass=ABCMeta):
+
+    """Base class for footprint accumulators."""
+
+    def empty(self):
+        """Return a new accumulator with the same settings but no data."""
+        acc = deepcopy(self)
+        acc.reset()
+        return acc
+
+    @abstractmethod
+    def reset(self):
+        pass
+
+    @abstractmethod
+    def add(self, x, y, wavelengths, weights):
+        """Accumulate the given (local) points where rays hit."""
+
+    @abstractmethod
+    def merge(self, other):
+        """Add the data from another accumulator with the same settings."""
+
+    @abstractmethod
+    def result(self):
+        pass
+
+
+class Points(Accumulator):
+
+    """Keeps all the points, as (x, y, wavelength, weight) rows."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.chunks = []
+
+    def add(self, x, y, wavelengths, weights):
+        self.chunks.append(array((x, y, wavelengths, weights)).T)
+
+    def merge(self, other):
+        self.chunks.extend(other.chunks)
+
+    def result(self):
+        if len(self.chunks) != 1:
+            self.chunks[:] = [vstack(self.chunks) if self.chunks
+                              else empty((0, 4))]
+        return self.chunks[0]
+
+
+def _bin_indices(values, bins, lower, upper):
+    "Return the bin of each value and a mask of those inside the range."
+    i = floor((values - lower) * (bins / (upper - lower))).astype(int)
+    inside = (i >= 0) & (i < bins)
+    return i, inside
+
+
+class Histogram(Accumulator):
+
+    """
+    A weighted 2D histogram of the (x, y) positions, with fixed bins.
+    The result is a (ybins, xbins) array, i.e. an image with rows of
+    constant y. Points outside the range are only counted in 'outside'.
+    """
+
+    def __init__(self, bins=(100, 100), range=((-1, 1), (-1, 1))):
+        self.bins = tuple(bins)
+        self.range = tuple(tuple(r) for r in range)
+        self.reset()
+
+    def reset(self):
+        self.counts = zeros(self.bins[::-1])
+        self.outside = 0.0
+
+    def add(self, x, y, wavelengths, weights):
+        (nx, ny), ((x0, x1), (y0, y1)) = self.bins, self.range
+        i, inside_x = _bin_indices(x, nx, x0, x1)
+        j, inside_y = _bin_indices(y, ny, y0, y1)
+        inside = inside_x & inside_y
+        counts = bincount(j[inside] * nx + i[inside], weights[inside],
+                          minlength=nx * ny)
+        self.counts += counts.reshape(ny, nx)
+        self.outside += sum(weights) - sum(counts)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.outside += other.outside
+
+    def result(self):
+        return self.counts
+
+    @property
+    def edges(self):
+        "The bin edges along x and y."
+        return tuple(linspace(lower, upper, n + 1)
+                     for n, (lower, upper) in zip(self.bins, self.range))
+
+
+def density(points, bins=(100, 100)):
+    """
+    A Histogram of (x, y, wavelength, weight) points, as kept by Points,
+    over their extent, padded by half a bin on each side, e.g. to show a
+    footprint as an image of a given size however many points there
+    are. Points without weights count as 1.
+    """
+    range = []
+    for values, n in zip(points[:, :2].T, bins):
+        lower, upper = (values.min(), values.max()) if len(values) else (0, 0)
+        pad = (upper - lower) / (2 * n) or 0.5
+        range.append((lower - pad, upper + pad))
+    histogram = Histogram(bins, range)
+    weights = points[:, 3] if points.shape[1] > 3 else ones(len(points))
+    histogram.add(points[:, 0], points[:, 1], points[:, 2], weights)
+    return histogram
+
+
+class Spectrum(Accumulator):
+
+    """A weighted histogram of the wavelengths, with fixed bins."""
+
+    def __init__(self, bins=100, range=(0, 1e-6)):
+        self.bins = bins
+        self.range = tuple(range)
+        self.reset()
+
+    def reset(self):
+        self.counts = zeros(self.bins)
+        self.outside = 0.0
+
+    def add(self, x, y, wavelengths, weights):
+        i, inside = _bin_indices(wavelengths, self.bins, *self.range)
+        counts = bincount(i[inside], weights[inside], minlength=self.bins)
+        self.counts += counts
+        self.outside += sum(weights) - sum(counts)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.outside += other.outside
+
+    def result(self):
+        return self.counts
+
+    @property
+    def edges(self):
+        return linspace(self.range[0], self.range[1], self.bins + 1)
+
+
+class Moments(Accumulator):
+
+    """
+    Running weighted mean and variance of x, y and wavelength, giving
+    the centroid and RMS size of the footprint. Chunks are combined
+    with the pairwise update of Chan et al., which does not lose
+    precision when the spot is small compared to its distance from
+    the origin.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.weight = 0.0
+        self.mean = zeros(3)
+        self.m2 = zeros(3)  # weighted sums of squared deviations
+
+    def _combine(self, weight, mean, m2):
+        total = self.weight + weight
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self.m2 += m2 + delta**2 * (self.weight * weight / total)
+        self.mean += delta * (weight / total)
+        self.weight = total
+
+    def add(self, x, y, wavelengths, weights):
+        weight = sum(weights)
+        if weight == 0:
+            return
+        values = array((x, y, wavelengths))
+        mean = dot(values, weights) / weight
+        m2 = dot((values - mean[:, None])**2, weights)
+        self._combine(weight, mean, m2)
+
+    def merge(self, other):
+        self._combine(other.weight, other.mean, other.m2)
+
+    @property
+    def centroid(self):
+        "The mean (x, y, wavelength)."
+        return self.mean
+
+    @property
+    def rms(self):
+        "The RMS deviation from the centroid, for x, y and wavelength."
+        return sqrt(self.m2 / self.weight) if self.weight else zeros(3)
+
+    def result(self):
+        return dict(weight=self.weight, centroid=self.centroid, rms=self.rms)
@@ -2,32 +2,182 @@ import abc
 from collections import defaultdict
 from math import *
 
+from numpy import random
+
 from .member import Member
-from .element import Element, Glass, Mirror
+from .element import Element, Glass, Mirror, split_parent
 from .surface import Sphere
 from .source import Source
 
 
+def chunk_sizes(n, chunk_size, first_chunk_size=None):
+    """
+    Yield (first ray, number of rays) for each chunk of n rays. Given
+    first_chunk_size, the chunks grow from that, doubling each time,
+    until they reach chunk_size.
+    """
+    size = min(first_chunk_size or chunk_size, chunk_size)
+    start = 0
+    while start < n:
+        yield start, min(size, n - start)
+        start += size
+        size = min(2 * size, chunk_size)
+
+
 class Frame(Member, metaclass=abc.ABCMeta):
 
+    # Seed for the random numbers of the Russian roulette
+    roulette_seed = 0
+
     def __init__(self, children:[Member]=[], *args, **kwargs):
         self.children = children or []
+        self._compiled = None
         Member.__init__(self, *args, **kwargs)
 
-    def _localize_trace(self, trace):
-        return {source: [self.localize(rays[0])]
-                for source, rays in trace.items()}
-
-    def trace(self, incoming=None, n=1):
-        incoming = incoming or {}
-        local_trace = self._localize_trace(incoming)
+    def compile(self):
+        """
+        Return a flat list of (member, matloc, matglob) for all the
+        sources and elements in the frame, including those of nested
+        frames, in tracing order. The matrices transform directly between
+        the member and the coordinate system outside this frame.
+
+        The result is cached until the matrices of any member are
+        recalculated. Call invalidate() after changing the children.
+        """
+        if self._compiled is None or self._compiled[0] != Member._generation:
+            self._compiled = (Member._generation, list(self._flatten()))
+        return self._compiled[1]
+
+    def invalidate(self):
+        self._compiled = None
+
+    def _flatten(self, outer=None):
+        outer = self.composed_matrices(outer)
+        for child in self.children:
+            if isinstance(child, Frame):
+                yield from child._flatten(outer)
+            else:
+                yield (child,) + child.composed_matrices(outer)
+
+    def trace(self, incoming=None, n=1, outer=None, compact=False,
+              roulette=None):
+        """
+        Trace rays through the children, in order. Returns the rays
+        from each source, followed by the rays leaving each element,
+        all in the coordinate system outside the frame.
+
+        If compact is set, the rays that miss an element are left out
+        of its result and are not traced further, which saves time
+        when many rays are lost. The ids of the remaining rays tell
+        which they are; see Rays.expand.
+
+        If roulette is given, the rays leaving each element with weights
+        below it play Russian roulette (see Rays.roulette), using random
+        numbers seeded by roulette_seed. Weak rays are then mostly
+        killed, and the estimates stay unbiased. Combine with compact
+        to not trace the killed rays any further.
+        """
+        if outer is None:
+            members = self.compile()
+        else:
+            members = list(self._flatten(outer))
+        self._reset_footprints(members)
+        current = {source: rays[-1] for source, rays in (incoming or {}).items()}
+        return self._trace_members(members, current, n, compact=compact,
+                                   roulette=roulette,
+                                   seed=self.roulette_seed)
+
+    def survival(self):
+        """
+        Return the number of rays from each source that hit each
+        element, since the latest trace started, in tracing order.
+        """
+        return [(member, dict(member.hits))
+                for member, _, _ in self.compile()
+                if isinstance(member, Element)]
+
+    def trace_iter(self, n=1, chunk_size=100000, compact=False,
+                   roulette=None, first_chunk_size=None):
+        """
+        Trace n rays from each source in chunks of (at most) chunk_size
+        rays, yielding the result of each chunk, in the same form as
+        trace, as soon as it is done. That way the memory needed for
+        the rays is bounded by the chunk size instead of n. The ray ids
+        are unique over all chunks, and the footprints accumulate. Each
+        chunk draws its random numbers from its own stream (see
+        Source.chunk_rng), so the result only depends on n and the
+        chunk sizes.
+
+        Note that the "points" footprint accumulator, which elements
+        have by default (see Element.save_footprint), keeps every hit,
+        and so still grows with n. For large n, turn it off and use
+        bounded accumulators, such as a Histogram, instead.
+
+        Given first_chunk_size, the chunks start at that size and double
+        up to chunk_size, so that the first results come quickly.
+
+        Note that sources that ignore n, like GridSource, emit all their
+        rays for every chunk. See trace regarding compact and roulette.
+        """
+        members = self.compile()
+        self._reset_footprints(members)
+        for chunk, (start, size) in enumerate(
+                chunk_sizes(n, chunk_size, first_chunk_size)):
+            yield self._trace_members(members, {}, size,
+                                      first_id=start, chunk=chunk,
+                                      compact=compact, roulette=roulette,
+                                      seed=self.roulette_seed)
+
+    @staticmethod
+    def _reset_footprints(members):
+        for member, _, _ in members:
+            if isinstance(member, Element):
+                member.reset_footprint()
+
+    @staticmethod
+    def _trace_members(members, current, n, first_id=0, chunk=None,
+                       compact=False, roulette=None, seed=0):
         outgoing = defaultdict(list)
-        for c in self.children:
-            local_trace = c.trace(local_trace, n)
-            for source, rays in local_trace.items():
-                outgoing[source] += [self.globalize(r) for r in rays]
+        for i, (member, matloc, matglob) in enumerate(members):
+            if isinstance(member, Source):
+                new_rays = member._trace(current, n, matloc, matglob, chunk)
+                if first_id:
+                    for rays in new_rays.values():
+                        rays.ids += first_id
+            else:
+                new_rays = member._trace(current, n, matloc, matglob)
+                if roulette is not None:
+                    # Random numbers only depend on the chunk and element
+                    rng = random.default_rng((seed, chunk or 0, i))
+                    for rays in new_rays.values():
+                        rays.roulette(roulette, rng)
+                if compact:
+                    new_rays = {source: rays if rays.alive.all()
+                                else rays.compact()
+                                for source, rays in new_rays.items()}
+            Frame._advance(current, outgoing, new_rays)
         return outgoing
 
+    @staticmethod
+    def _advance(current, outgoing, new_rays):
+        """
+        Add the rays from a member to the current and outgoing rays.
+        Rays split by an element (see ReflectiveGrating) replace the
+        rays they were split from, taking over their history.
+        """
+        parents = set()
+        for key, rays in new_rays.items():
+            parent = split_parent(key)
+            if key not in current and parent is not None:
+                outgoing[key] = outgoing[parent] + [rays]
+                parents.add(parent)
+            else:
+                outgoing[key].append(rays)
+            current[key] = rays
+        for parent in parents:
+            del current[parent]
+            outgoing.pop(parent, None)
+
     @abc.abstractmethod
     def _blah():
         # Only here to make this class abstract. There must be a better
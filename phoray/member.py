@@ -1,7 +1,8 @@
 from math import *
 from abc import ABCMeta, abstractmethod
 
-from numpy import array, dot, ones, zeros, radians, ndarray
+from numpy import (array, dot, matmul, radians, atleast_2d, empty_like,
+                   isnan, zeros)
 from numpy.linalg import inv as inverse_matrix
 
 from .transformations import (euler_matrix, translation_matrix,
@@ -11,6 +12,39 @@ from .phoray import current_id
 from . import PhorayBase, Position
 
 
+def transform(rays, matrix, out=None):
+    """
+    Apply a 4x4 affine matrix (acting on row vectors, as in Member) to
+    the endpoints and directions of the rays at once. The result is
+    written to the rays given as 'out', if any; it may be the same as
+    the input rays.
+    """
+    # Rotating endpoints and directions together with a block diagonal
+    # matrix is much faster than a batched (N, 2, 3) product.
+    rotation = zeros((6, 6))
+    rotation[:3, :3] = rotation[3:, 3:] = matrix[:3, :3]
+    if out is None:
+        out = Rays.wrap(empty_like(rays.data), rays.ids, rays.alive)
+        out.data[:, 6:] = rays.data[:, 6:]
+    elif out is not rays:
+        out.data[:, 6:] = rays.data[:, 6:]
+        out.ids[:] = rays.ids
+        out.alive[:] = rays.alive
+    # But then NaN in either half of a row, e.g. the directions of rays
+    # stopped by a Detector, spreads to the other, so such rows are
+    # done separately.
+    mixed = isnan(rays.data[:, 0])
+    mixed ^= isnan(rays.data[:, 3])
+    any_mixed = mixed.any()
+    if any_mixed:
+        separate = rays.data[mixed, 0:6].reshape(-1, 3)
+    matmul(rays.data[:, 0:6], rotation, out=out.data[:, 0:6])
+    if any_mixed:
+        out.data[mixed, 0:6] = dot(separate, matrix[:3, :3]).reshape(-1, 6)
+    out.endpoints += matrix[3, :3]
+    return out
+
+
 class Member(PhorayBase, metaclass=ABCMeta):
 
     """Baseclass for a generalized member of an optical system.
@@ -18,19 +52,40 @@ class Member(PhorayBase, metaclass=ABCMeta):
     Contains methods to convert from and to the local coordinate system.
     """
 
+    # Increased whenever the matrices of any member are recalculated,
+    # so that frames know when their compiled matrices are outdated.
+    _generation = 0
+
     def __init__(self, position:Position=(0, 0, 0), rotation:Position=(0, 0, 0),
                  _id:int=None):
-        self.position = Position(position)
-        self.rotation = Position(rotation)
+        # Setting these precalculates the matrices. Note that this means
+        # that modifying the arrays in place has no effect, unless
+        # calculate_matrices is called again afterwards.
+        self.position = position
+        self.rotation = rotation
 
         if _id is None:
             self._id = next(current_id)
         else:
             self._id = _id
 
-        # Precalculate some matrices. Note that this means that the
-        # frame can't be changed after creation, unless
-        # calculate_matrices is called again afterwards.
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, position):
+        self._position = Position(position)
+        if hasattr(self, "_rotation"):
+            self.calculate_matrices()
+
+    @property
+    def rotation(self):
+        return self._rotation
+
+    @rotation.setter
+    def rotation(self, rotation):
+        self._rotation = Position(rotation)
         self.calculate_matrices()
 
     def calculate_matrices(self):
@@ -39,48 +94,47 @@ class Member(PhorayBase, metaclass=ABCMeta):
         self._matloc = concatenate_matrices(
             inverse_matrix(rotate), translation_matrix(-self.position)).T
         self._matglob = inverse_matrix(self._matloc)
+        Member._generation += 1
+
+    def composed_matrices(self, outer=None):
+        """
+        Return the localizing and globalizing matrices of this member,
+        combined with the (localize, globalize) pair 'outer' of the
+        frames containing it. That way rays can be transformed from the
+        outermost coordinate system in one step, however deeply nested.
+        """
+        if outer is None:
+            return self._matloc, self._matglob
+        matloc, matglob = outer
+        return dot(matloc, self._matloc), dot(self._matglob, matglob)
 
     def localize_position(self, v):
         """Turn global (relative to the frame) coordinates into local."""
-        tmp = ones((len(v), 4))  # make 4-vectors for translations
-        tmp[:, :3] = v
-        return dot(tmp, self._matloc)[:, :3]
+        return dot(atleast_2d(v), self._matloc[:3, :3]) + self._matloc[3, :3]
 
     def localize_direction(self, v):
         """A direction does not change with translation."""
-        tmp = zeros((len(v), 4))  # make 4-vectors for translations
-        tmp[:, :3] = v
-        return dot(tmp, self._matloc)[:, :3]
+        return dot(atleast_2d(v), self._matloc[:3, :3])
 
     def globalize_position(self, v):
         """Turn local coordinates into global."""
-        tmp = ones((len(v), 4))  # make 4-vectors for translations
-        tmp[:, :3] = v
-        return dot(tmp, self._matglob)[:, :3]
+        return dot(atleast_2d(v), self._matglob[:3, :3]) + self._matglob[3, :3]
 
     def globalize_direction(self, v):
         """A direction does not change with translation."""
-        tmp = zeros((len(v), 4))  # make 4-vectors for translations
-        tmp[:, :3] = v
-        return dot(tmp, self._matglob)[:, :3]
+        return dot(atleast_2d(v), self._matglob[:3, :3])
 
-    def localize(self, rays):
+    def localize(self, rays, out=None):
         """
         Transform a Ray in global coordinates into local coordinates
         """
-        local_endp = self.localize_position(rays.endpoints)
-        local_dir = self.localize_direction(rays.directions)
-
-        return Rays(local_endp, local_dir, rays.wavelengths)
+        return transform(rays, self._matloc, out)
 
-    def globalize(self, rays):
+    def globalize(self, rays, out=None):
         """
         Transform a local Ray into global coordinates
         """
-        global_endp = self.globalize_position(rays.endpoints)
-        global_dir = self.globalize_direction(rays.directions)
-
-        return Rays(global_endp, global_dir, rays.wavelengths)
+        return transform(rays, self._matglob, out)
 
     def x_axis(self):
         return self.globalize_vector(array((1, 0, 0)))
@@ -92,5 +146,5 @@ class Member(PhorayBase, metaclass=ABCMeta):
         return self.globalize_vector(array((0, 0, 1)))
 
     @abstractmethod
-    def trace(self, incoming, n):
+    def trace(self, incoming, n, outer=None):
         pass
@@ -0,0 +1,156 @@
+"""
+Tracing in parallel, using a pool of processes.
+
+The system is sent to each worker process once, as the dict returned by
+to_dict, and rebuilt there. The rays are traced in chunks, each drawing
+random numbers from its own stream (see Source.chunk_rng), so the
+result is the same regardless of the number of processes, and also the
+same as that of Frame.trace_iter with the same chunk size.
+
+The workers write the rays directly into a memory mapped file, which
+is pre-sized by the parent process and placed in shared memory where
+available. The resulting Rays are views into the same file, so the
+rays are never serialized on their way back from the workers.
+"""
+
+from multiprocessing import Pool
+import os
+from tempfile import NamedTemporaryFile
+
+from numpy import memmap, uint8
+
+from . import object_from_dict
+from .element import Element, split_key
+from .ray import Rays
+from .source import Source
+
+
+# Where to put the buffer files; /dev/shm is memory backed on Linux
+BUFFER_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+_system = None  # the system traced by a worker process
+_buffer = None  # the worker's mapping of the result buffer file
+_layout = None  # offsets of the rays in the buffer, per source
+
+
+def _init_worker(spec, accumulators, filename, layout):
+    global _system, _buffer, _layout
+    _system = object_from_dict(spec)
+    # The footprint settings are not part of the spec
+    members = _system.compile()
+    for i, accs in accumulators.items():
+        members[i][0].accumulators = accs
+    _buffer = memmap(filename, dtype=uint8, mode="r+")
+    _layout = layout
+
+
+def _trace_chunk(args):
+    """
+    Trace one chunk in a worker, writing the rays into the buffer
+    starting at the given row for each source. Since the ids of the
+    members differ between processes, sources and elements are
+    identified by their index in the compiled system. Only the
+    footprint accumulators and hit counts are returned.
+    """
+    chunk, start, n, rows, roulette, seed = args
+    members = _system.compile()
+    indices = {member._id: i for i, (member, _, _) in enumerate(members)}
+
+    def index_key(key):
+        if isinstance(key, tuple):  # split rays, see split_key
+            return (indices[key[0]],) + key[1:]
+        return indices[key]
+
+    _system._reset_footprints(members)
+    traces = _system._trace_members(members, {}, n, first_id=start,
+                                    chunk=chunk, roulette=roulette,
+                                    seed=seed)
+    written = set()  # split rays share the steps before the split
+    for key, trace in traces.items():
+        key = index_key(key)
+        size, offsets = _layout[key]
+        row = rows[key[0] if isinstance(key, tuple) else key]
+        for rays, offset in zip(trace, offsets):
+            if offset in written:
+                continue
+            written.add(offset)
+            result = Rays.from_buffer(_buffer, size, offset)
+            end = row + len(rays)
+            result.data[row:end] = rays.data
+            result.ids[row:end] = rays.ids
+            result.alive[row:end] = rays.alive
+    return {i: {index_key(source): (member._accumulated[source], hits)
+                for source, hits in member.hits.items()}
+            for i, (member, _, _) in enumerate(members)
+            if isinstance(member, Element)}
+
+
+def chunks(n, chunk_size):
+    """Return (chunk number, first ray, number of rays) for each chunk."""
+    return [(chunk, start, min(chunk_size, n - start))
+            for chunk, start in enumerate(range(0, n, chunk_size))]
+
+
+def trace(system, n=1, chunk_size=100000, processes=None, roulette=None):
+    """
+    Trace n rays from each source through the system, using the given
+    number of processes (by default, one per CPU). Returns the result
+    in the same form as Frame.trace, and the footprints of the
+    system's elements are updated. See Frame.trace regarding roulette.
+    """
+    members = system.compile()
+    system._reset_footprints(members)
+    tasks = chunks(n, chunk_size)
+
+    # Each source gets one region in the buffer for its own rays, and
+    # one for the rays leaving each element after it. Rays split by an
+    # element get one region per part from there on. Sources are
+    # identified by their index, also in the keys of split rays.
+    layout = {}
+    rows = {}
+    nbytes = 0
+    for i, (member, _, _) in enumerate(members):
+        if isinstance(member, Source):
+            counts = [member.count(m) for _, _, m in tasks]
+            rows[i] = [sum(counts[:j]) for j in range(len(counts))]
+            size = sum(counts)
+            layout[i] = size, [nbytes]
+            nbytes += Rays.nbytes(size)
+        elif isinstance(member, Element):
+            for key, (size, offsets) in list(layout.items()):
+                if member.splits:
+                    del layout[key]
+                    for order in member.orders:
+                        layout[split_key(key, order)] = (size,
+                                                         offsets + [nbytes])
+                        nbytes += Rays.nbytes(size)
+                else:
+                    offsets.append(nbytes)
+                    nbytes += Rays.nbytes(size)
+    tasks = [task + ({i: r[j] for i, r in rows.items()}, roulette,
+                     system.roulette_seed)
+             for j, task in enumerate(tasks)]
+
+    def global_key(key):
+        if isinstance(key, tuple):
+            return (members[key[0]][0]._id,) + key[1:]
+        return members[key][0]._id
+
+    accumulators = {i: member.accumulators
+                    for i, (member, _, _) in enumerate(members)
+                    if isinstance(member, Element)}
+
+    with NamedTemporaryFile(dir=BUFFER_DIR, prefix="phoray-") as f:
+        f.truncate(max(nbytes, 1))
+        buffer = memmap(f.name, dtype=uint8, mode="r+")
+        with Pool(processes, _init_worker,
+                  (system.to_dict(), accumulators, f.name, layout)) as pool:
+            for footprints in pool.imap(_trace_chunk, tasks):
+                for i, accumulated in footprints.items():
+                    for key, (accs, hits) in accumulated.items():
+                        members[i][0].merge_footprint(global_key(key),
+                                                      accs, hits)
+    # The mapping stays valid after the file is removed
+    return {global_key(key): [Rays.from_buffer(buffer, size, offset)
+                              for offset in offsets]
+            for key, (size, offsets) in layout.items()}
@@ -0,0 +1,137 @@
+from collections import OrderedDict, defaultdict
+from time import perf_counter
+
+from numpy import isfinite
+
+from .element import Element
+from .frame import Frame
+from .member import transform
+from .ray import Rays
+from .source import Source
+
+
+class TracePlan(object):
+
+    """
+    A system compiled into a flat pipeline of stages, for tracing the
+    same system many times, e.g. in parameter scans. The ray buffers are
+    allocated on the first run and then reused in place, as long as the
+    number of rays stays the same.
+
+    The result of run() is the same as that of tracing the system, but
+    note that it refers to the buffers, which are overwritten by the
+    next run. The time spent in each stage is accumulated in 'timings'.
+
+    The plan does not notice changes to the system; create a new one.
+    """
+
+    def __init__(self, system):
+        self.system = system
+        self.members = system.compile()
+        self.stages = [(i, stage)
+                       for i, (member, _, _) in enumerate(self.members)
+                       for stage in self._stage_names(member)]
+        self.timings = OrderedDict((stage, 0.0) for stage in self.stages)
+        self.runs = 0
+        self._buffers = {}
+
+    @staticmethod
+    def _stage_names(member):
+        if isinstance(member, Source):
+            return ("emit", "transform")
+        if member.splits:
+            # Traced like in a frame, without reusing buffers
+            return ("propagate",)
+        if type(member).interact is Element.interact:
+            # The element only implements propagate
+            return ("transform", "propagate", "transform back")
+        return ("transform", "intersect", "interact", "transform back")
+
+    def _buffer(self, key, n):
+        buf = self._buffers.get(key)
+        if buf is None or len(buf) != n:
+            buf = self._buffers[key] = Rays.empty(n)
+        return buf
+
+    def _lap(self, i, stage, t0):
+        t = perf_counter()
+        self.timings[(i, stage)] += t - t0
+        return t
+
+    def run(self, n=1):
+        """Trace n rays from each source, like GroupFrame.trace."""
+        current = {}
+        outgoing = defaultdict(list)
+        self.system._reset_footprints(self.members)
+        for i, (member, matloc, matglob) in enumerate(self.members):
+            if isinstance(member, Source):
+                t = perf_counter()
+                rays = member.emit(n)
+                t = self._lap(i, "emit", t)
+                out = self._buffer((i, member._id), len(rays))
+                transform(rays, matglob, out=out)
+                self._lap(i, "transform", t)
+                current[member._id] = out
+                outgoing[member._id].append(out)
+                continue
+            if member.splits:
+                t = perf_counter()
+                new_rays = member._trace(current, n, matloc, matglob)
+                self._lap(i, "propagate", t)
+                Frame._advance(current, outgoing, new_rays)
+                continue
+            for source, rays in current.items():
+                out = self._run_element(i, member, matloc, matglob,
+                                        source, rays)
+                current[source] = out
+                outgoing[source].append(out)
+        self.runs += 1
+        return outgoing
+
+    def _run_element(self, i, element, matloc, matglob, source, rays):
+        n = len(rays)
+        out = self._buffer((i, source), n)
+        t = perf_counter()
+        local = transform(rays, matloc,
+                          out=self._buffer(("local", source), n))
+        t = self._lap(i, "transform", t)
+        if type(element).interact is Element.interact:
+            stage = "propagate"
+            new_rays = element.propagate(local)
+            out.data[:] = new_rays.data
+            out.ids[:] = new_rays.ids
+            out.alive[:] = new_rays.alive
+        else:
+            stage = "interact"
+            geometry = element.geometry
+            if element.uses_normals:
+                points, normals = geometry.intersect_with_normal(local)
+            else:
+                points, normals = geometry.intersect(local), None
+            t = self._lap(i, "intersect", t)
+            directions = element.interact(local, points, normals)
+            out.endpoints = points
+            out.directions = directions
+            out.data[:, 6:] = local.data[:, 6:]
+            factor = element.throughput(local, normals)
+            if factor is not None:
+                out.weights *= factor
+            out.ids[:] = local.ids
+            out.alive[:] = local.alive & isfinite(points[:, 0])
+        element.record_footprint(source, out)
+        t = self._lap(i, stage, t)
+        transform(out, matglob, out=out)
+        self._lap(i, "transform back", t)
+        return out
+
+    def report(self):
+        """Return a table of the mean time spent in each stage per run."""
+        runs = max(self.runs, 1)
+        lines = []
+        for (i, stage), t in self.timings.items():
+            member = self.members[i][0]
+            lines.append("%3d %-20s %-15s %10.6f s" % (
+                i, member.__class__.__name__, stage, t / runs))
+        lines.append("%-40s %10.6f s" % (
+            "total", sum(self.timings.values()) / runs))
+        return "\n".join(lines)
@@ -1,61 +1,289 @@
 from __future__ import division
-from random import randint
+from warnings import warn
 
-from numpy import array
-from numpy import ma
+from numpy import (array, asarray, empty, zeros, full, arange, isfinite, isnan,
+                   nan, ndarray, float64, int64, where, sqrt, floor, cross,
+                   hstack, bincount, broadcast_to, errstate, searchsorted)
+from numpy.linalg import norm
 
-from .solver import closest_points
+from .solver import estimate_focus
 
 
 class Rays(object):
 
-    def __init__(self, endpoints, directions, wavelengths):
-        self.endpoints = ma.array(endpoints)
-        self.directions = ma.array(directions)
-        self.wavelengths = ma.array(wavelengths)
+    """
+    A bunch of rays, stored as the columns of one contiguous (N, 8)
+    float64 block: endpoint (x, y, z), direction (x, y, z), wavelength
+    and weight. The attributes 'endpoints', 'directions', 'wavelengths'
+    and 'weights' are views into the block, i.e. no copying is involved.
+
+    Rays that have missed an element have NaN endpoints and are not
+    'alive'. The 'ids' identify each ray throughout a trace, also when
+    dead rays have been compacted away.
+    """
+
+    __slots__ = ("data", "alive", "ids")
+
+    def __init__(self, endpoints, directions, wavelengths, weights=1.0,
+                 ids=None, alive=None):
+        endpoints = asarray(endpoints, dtype=float64)
+        n = len(endpoints)
+        self.data = data = empty((n, 8))
+        data[:, 0:3] = endpoints
+        data[:, 3:6] = directions
+        data[:, 6] = 0 if wavelengths is None else wavelengths
+        data[:, 7] = weights
+        self.ids = arange(n) if ids is None else asarray(ids, dtype=int64)
+        if alive is None:
+            self.alive = isfinite(data[:, 0])
+        else:
+            self.alive = asarray(alive, dtype=bool)
+
+    @classmethod
+    def wrap(cls, data, ids, alive):
+        """Create rays using the given arrays as storage, without copying."""
+        rays = cls.__new__(cls)
+        rays.data = data
+        rays.ids = ids
+        rays.alive = alive
+        return rays
+
+    @staticmethod
+    def nbytes(n):
+        """
+        The size of the buffer needed to store n rays, padded so that
+        consecutive rays in a buffer stay aligned.
+        """
+        return n * (8*8 + 8) + -(-n // 8) * 8
+
+    @classmethod
+    def from_buffer(cls, buffer, n, offset=0):
+        """
+        Create n rays stored in the given buffer (e.g. shared memory or
+        a memory mapped file), starting at offset, without copying. The
+        layout is the data block, followed by the ids and alive flags.
+        """
+        data = ndarray((n, 8), float64, buffer, offset)
+        offset += n * 8*8
+        ids = ndarray(n, int64, buffer, offset)
+        alive = ndarray(n, bool, buffer, offset + n*8)
+        return cls.wrap(data, ids, alive)
+
+    @classmethod
+    def empty(cls, n):
+        """Allocate n rays, without initializing the values."""
+        return cls.wrap(empty((n, 8)), empty(n, dtype=int64),
+                        empty(n, dtype=bool))
+
+    @property
+    def endpoints(self):
+        return self.data[:, 0:3]
+
+    @endpoints.setter
+    def endpoints(self, value):
+        self.data[:, 0:3] = value
+
+    @property
+    def directions(self):
+        return self.data[:, 3:6]
+
+    @directions.setter
+    def directions(self, value):
+        self.data[:, 3:6] = value
+
+    @property
+    def wavelengths(self):
+        return self.data[:, 6]
+
+    @wavelengths.setter
+    def wavelengths(self, value):
+        self.data[:, 6] = value
+
+    @property
+    def weights(self):
+        return self.data[:, 7]
+
+    @weights.setter
+    def weights(self, value):
+        self.data[:, 7] = value
 
     def __repr__(self):
         return "%r, %r, %r" % (
             self.endpoints, self.directions, self.wavelengths)
 
     def __len__(self):
-        return len(self.endpoints)
-
-    def estimate_focus(self, samples=None):
+        return len(self.data)
 
+    def derive(self, endpoints, directions):
         """
-        A fairly stupid way to find the focus of the rays, by simply
-        locating the center of where a number of randomly sampled ray
-        pairs are closest to each oher.
+        Return new rays with the given endpoints and directions, but
+        otherwise the same as these. Rays with NaN endpoints are dead.
         """
+        data = empty((len(self), 8))
+        data[:, 0:3] = endpoints
+        data[:, 3:6] = directions
+        data[:, 6:] = self.data[:, 6:]
+        return self.wrap(data, self.ids, self.alive & isfinite(data[:, 0]))
 
-        total = len(self.endpoints)
-        samples = samples or max(1, total // 100)
+    def copy(self):
+        return self.wrap(self.data.copy(), self.ids.copy(), self.alive.copy())
 
-        xsum = ysum = zsum = 0
+    def roulette(self, threshold, rng):
+        """
+        Play Russian roulette with the live rays whose weights are
+        below the threshold, in place: each survives with a probability
+        of its weight divided by the threshold, and then gets the
+        threshold as weight. The rest die. That way the expected weight
+        is unchanged, but fewer rays need to be traced further.
+        """
+        weights = self.weights
+        light = (weights < threshold) & self.alive
+        light = light.nonzero()[0]
+        survive = rng.random(len(light)) * threshold < weights[light]
+        self.alive[light[~survive]] = False
+        weights[light[survive]] = threshold
 
-        for r in range(samples):
-            n1 = randint(0, total-1)
-            p1 = self.endpoints[n1]
-            r1 = self.directions[n1]
-            n2 = randint(0, total-1)
-            while n2 == n1:
-                n2 = randint(0, total-1)
-            p2 = self.endpoints[n2]
-            r2 = self.directions[n2]
-            try:
-                s, t = closest_points(p1, r1, p2, r2)
-            except ValueError:
-                samples -= 1
-                continue
-            x1, y1, z1 = p1 + s*r1
-            x2, y2, z2 = p2 + t*r2
+    def compact(self):
+        """Return only the rays that are still alive."""
+        alive = self.alive
+        return self.wrap(self.data[alive], self.ids[alive], alive[alive])
 
-            xsum += (x1 + x2)
-            ysum += (y1 + y2)
-            zsum += (z1 + z2)
+    def expand(self, ids):
+        """
+        The opposite of compact: return rays with the given (sorted)
+        ids, e.g. those of the rays from the source, in which the rays
+        that are missing here are dead.
+        """
+        rows = searchsorted(self.ids, ids).clip(0, max(len(self) - 1, 0))
+        found = self.ids[rows] == ids if len(self) else zeros(len(ids), bool)
+        rows = rows[found]
+        data = full((len(ids), 8), nan)
+        data[found] = self.data[rows]
+        alive = zeros(len(ids), dtype=bool)
+        alive[found] = self.alive[rows]
+        return self.wrap(data, ids, alive)
 
-        if samples:
-            return xsum / (2*samples), ysum / (2*samples), zsum / (2*samples)
-        else:
+    def estimate_focus(self, samples=None, *, by_wavelength=False):
+        """
+        Find the point closest to all the live rays, weighted by their
+        weights, in the least squares sense. Returns None if there is
+        no focus, e.g. if the rays are parallel. If by_wavelength is
+        set, return a dict with the focus for each wavelength instead.
+
+        The samples argument is deprecated and ignored; all the rays
+        are used.
+        """
+        if samples is not None:
+            warn("estimate_focus no longer samples ray pairs, so "
+                 "'samples' is ignored", DeprecationWarning, stacklevel=2)
+        alive = self.alive & isfinite(self.data[:, 0])
+        data = self.data if alive.all() else self.data[alive]
+        if by_wavelength:
+            wavelengths, foci = estimate_focus(
+                data[:, 0:3], data[:, 3:6], data[:, 7], groups=data[:, 6])
+            return {wavelength: None if isnan(focus[0]) else focus
+                    for wavelength, focus in zip(wavelengths, foci)}
+        if not len(data):
             return None
+        focus = estimate_focus(data[:, 0:3], data[:, 3:6], data[:, 7])
+        return None if isnan(focus[0]) else focus
+
+    def focus_scan(self, distances, origin=None, axis=None, bins=100):
+        """
+        Find the spot size of the live rays on planes perpendicular to
+        the axis, at the given distances from the origin, without
+        tracing; the rays are just extended, also backwards. Returns a
+        dict with the (global) 'centroid' on each plane, and the
+        weighted 'rms' and 'fwhm' widths along the two transverse
+        'axes' of the planes, e.g. to plot a focus curve.
+
+        By default, the axis is the mean direction of the rays and the
+        origin is their focus according to estimate_focus. Raises
+        ValueError if there are no live rays with any weight to scan.
+        """
+        alive = self.alive & isfinite(self.data[:, 0])
+        data = self.data if alive.all() else self.data[alive]
+        p, r, w = data[:, 0:3], data[:, 3:6], data[:, 7]
+        if not w.sum() > 0:
+            raise ValueError("No live rays with weight to scan")
+        if axis is None:
+            axis = w.dot(r)
+        axis = asarray(axis, dtype=float64) / norm(axis)
+        if origin is None:
+            origin = estimate_focus(p, r, w)
+            if isnan(origin[0]):
+                origin = w.dot(p) / w.sum()
+        axes = _transverse_axes(axis)
+
+        # The transverse position of each ray is linear in the distance
+        # along the axis: offset + distance * slope.
+        basis = array(axes + (axis,)).T
+        p, r = (p - origin).dot(basis), r.dot(basis)
+        with errstate(invalid="ignore", divide="ignore"):
+            slope = (r[:, :2] / r[:, 2:]).T
+        offset = p[:, :2].T - slope * p[:, 2]
+        valid = isfinite(slope).all(0)
+        offset, slope, w = offset[:, valid], slope[:, valid], w[valid]
+        if not w.sum() > 0:
+            raise ValueError("No live rays with weight cross the planes")
+
+        distances = asarray(distances, dtype=float64)
+        k = len(distances)
+        rms, fwhm, mean = empty((k, 2)), empty((k, 2)), empty((k, 2))
+        # Handle the planes in blocks, to limit the memory used
+        block = max(1, 2**22 // max(1, len(w)))
+        for start in range(0, k, block):
+            z = distances[start:start+block, None]
+            for i in range(2):
+                x = offset[i] + z * slope[i]  # (planes, rays)
+                m = x.dot(w) / w.sum()
+                s = sqrt(((x - m[:, None])**2).dot(w) / w.sum())
+                mean[start:start+block, i] = m
+                rms[start:start+block, i] = s
+                fwhm[start:start+block, i] = _fwhm(x, w, m - 4*s, 8*s, bins)
+
+        centroid = (origin + distances[:, None] * axis +
+                    mean.dot(array(axes)))
+        return dict(distances=distances, centroid=centroid, rms=rms,
+                    fwhm=fwhm, axes=axes)
+
+
+def _transverse_axes(axis):
+    "Return two unit vectors perpendicular to the axis and each other."
+    other = (1, 0, 0) if abs(axis[0]) < 0.9 else (0, 1, 0)
+    x = cross(other, axis)
+    x /= norm(x)
+    return x, cross(axis, x)
+
+
+def _fwhm(x, weights, lower, width, bins):
+    """
+    The full width at half maximum of the weighted distribution of each
+    row of x, from a histogram between lower and lower + width, with
+    the half maximum crossings interpolated between the bins. Rows
+    with an empty histogram have no width, i.e. NaN.
+    """
+    k = len(x)
+    size = where(width > 0, width, 1) / bins
+    i = floor((x - lower[:, None]) / size[:, None]).astype(int)
+    inside = (i >= 0) & (i < bins)
+    i += arange(k)[:, None] * bins
+    h = bincount(i[inside], broadcast_to(weights, x.shape)[inside],
+                 minlength=k * bins).reshape(k, bins)
+    h = hstack((zeros((k, 1)), h, zeros((k, 1))))
+    half = h.max(1) / 2
+    empty_rows = half == 0
+    # the padding keeps the crossings inside, unless the row is empty
+    above = (h >= half[:, None]) & ~empty_rows[:, None]
+    above[empty_rows, 1] = True
+    rows = arange(k)
+    first = above.argmax(1)
+    last = bins + 1 - above[:, ::-1].argmax(1)
+    # where the histogram crosses the half maximum, in bins
+    with errstate(invalid="ignore", divide="ignore"):
+        left = first - (h[rows, first] - half) / (h[rows, first] -
+                                                  h[rows, first - 1])
+        right = last + (h[rows, last] - half) / (h[rows, last] -
+                                                 h[rows, last + 1])
+    return where(empty_rows, nan, where(width > 0, (right - left) * size, 0))
+
@@ -1,76 +1,226 @@
-from numpy import sqrt, where, allclose
+from numpy import (sqrt, cbrt, where, asarray, ascontiguousarray,
+                   arccos, cos, clip, abs, nan, float64, errstate, stack,
+                   ones, empty, zeros, identity, bincount, unique,
+                   broadcast_to, isfinite)
+from numpy.linalg import eigvals, eigvalsh, solve
 
 
 def quadratic(a, b, c):
     """
     Solve a quadratic function a*x**2 + b*y + c = 0
     """
-    delta = sqrt(b ** 2 - 4 * a * c)
-    x1 = where(a == 0, -c / b, (-b + delta) / (2 * a))
-    x2 = where(a == 0, x1, (-b - delta) / (2 * a))
+    with errstate(invalid="ignore", divide="ignore"):
+        delta = sqrt(b ** 2 - 4 * a * c)
+        x1 = where(a == 0, -c / b, (-b + delta) / (2 * a))
+        x2 = where(a == 0, x1, (-b - delta) / (2 * a))
     return (x1, x2)
 
 
-def closest_points(p, u, q, v):
+def _largest_cubic_root(a, b, c):
     """
-    Given two lines, described by intersection points p, q and
-    directions u, v respectively, calculate the pair of points where
-    the lines are closest.
-
-    ==== solution using SymPy ====
-
-    from sympy import *
+    Return the largest real root of x**3 + a*x**2 + b*x + c = 0,
+    elementwise for arrays of coefficients.
+    """
+    # depressed cubic z**3 + p*z + q = 0, with x = z - a/3
+    p = b - a ** 2 / 3
+    q = 2 * a ** 3 / 27 - a * b / 3 + c
+    delta = (q / 2) ** 2 + (p / 3) ** 3
+    with errstate(invalid="ignore", divide="ignore"):
+        # one real root; Cardano, avoiding cancellation
+        u = cbrt(-q / 2 - where(q < 0, -1, 1) * sqrt(delta))
+        z1 = where(u == 0, 0, u - p / (3 * u))
+        # three real roots; trigonometric solution, largest branch
+        k = 2 * sqrt(-p / 3)
+        z3 = k * cos(arccos(clip(3 * q / (p * k), -1, 1)) / 3)
+    z = where(delta > 0, z1, where(p < 0, z3, 0))
+    return z - a / 3
+
+
+def _companion_roots(b, c, d, e):
+    """
+    The real roots of x**4 + b*x**3 + c*x**2 + d*x + e = 0, as rows of
+    an (N, 4) array, where complex roots are NaN, from the eigenvalues
+    of the companion matrices, like numpy.roots. Slower than Ferrari's
+    method, but also reliable for badly scaled coefficients.
+    """
+    m = zeros((len(b), 4, 4))
+    m[:, 0] = -stack((b, c, d, e), axis=1)
+    m[:, 1, 0] = m[:, 2, 1] = m[:, 3, 2] = 1
+    x = eigvals(m)
+    # double roots come out as complex pairs with tiny imaginary parts
+    return where(abs(x.imag) <= 1e-7 * abs(x), x.real, nan)
 
-    p = Matrix(var("p1 p2 p3"))
-    q = Matrix(var("q1 q2 q3"))
-    u = Matrix(var("u1 u2 u3"))
-    v = Matrix(var("v1 v2 v3"))
-    s, t = var("s t")
-    P = p + s * u
-    Q = q + t * v
-    PQ = Q - P
 
-    # PQ must be orthogonal to both u and v
-    res = solve([PQ.dot(u), PQ.dot(v)], s, t)
+def _suspect(x, step, b, c, d, e):
     """
+    Which columns of the (4, N) roots x of x**4 + b*x**3 + c*x**2 +
+    d*x + e = 0 from Ferrari's method can not be trusted, given the last
+    Newton step: those where Newton had not settled, with an odd number
+    of real roots, with roots that coincide (badly scaled coefficients
+    make Newton collapse them), those that lack the roots of both signs
+    that e < 0 implies, and those with extremely badly scaled
+    coefficients, where small roots go missing.
+    """
+    # the coefficients for x scaled by |e|**(1/4), which are all about
+    # 1 for a well scaled equation
+    k = abs(e) ** 0.25
+    k = where(k > 0, k, 1)
+    spread = abs(b) / k + abs(c) / k**2 + abs(d) / k**3
+    ax = abs(x)
+    suspect = (abs(step) > 1e-6 * ax).any(0) | (spread > 1e6)
+    suspect |= isfinite(x).sum(0) % 2 == 1
+    suspect |= (e < 0) & ~((x > 0).any(0) & (x < 0).any(0))
+    for i in range(3):
+        suspect |= (abs(x[i+1:] - x[i]) <= 1e-9 * ax[i]).any(0)
+    return suspect
+
+
+def quartic(coeffs, polish=2):
+    """
+    Solve a batch of quartic equations a*x**4 + b*x**3 + c*x**2 + d*x + e = 0
+    given as rows (a, b, c, d, e) of an (N, 5) array, with a != 0.
+    Returns an (N, 4) array of the real roots, where complex roots are NaN.
+    The roots are refined with 'polish' Newton iterations.
+
+    Uses Ferrari's method, i.e. the depressed quartic is factored into
+    two quadratics using the largest root of the resolvent cubic. The
+    method loses roots for badly scaled coefficients, so rows where the
+    roots look wrong are solved again from their companion matrices.
+    """
+    coeffs = asarray(coeffs, dtype=float64)
+    a = coeffs[:, 0]
+    b, c, d, e = (coeffs[:, i] / a for i in range(1, 5))
+
+    # depressed quartic y**4 + p*y**2 + q*y + r = 0, with x = y - b/4
+    b2 = b ** 2
+    p = c - 3 * b2 / 8
+    q = d - b * c / 2 + b2 * b / 8
+    r = e - b * d / 4 + b2 * c / 16 - 3 * b2 ** 2 / 256
+
+    m = _largest_cubic_root(p, p ** 2 / 4 - r, -q ** 2 / 8)
+
+    with errstate(invalid="ignore", divide="ignore"):
+        s = sqrt(2 * m)
+        qs = q / s
+        scale = 2 * (abs(m) + abs(p) + abs(qs))
+        disc = (-2 * m - 2 * p - 2 * qs, -2 * m - 2 * p + 2 * qs)
+        # Tangent rays give double roots, which rounding can push
+        # slightly into the complex plane.
+        sq1, sq2 = (sqrt(where((D < 0) & (D > -1e-9 * scale), 0, D))
+                    for D in disc)
+        ys = [(s + sq1) / 2, (s - sq1) / 2, (-s + sq2) / 2, (-s - sq2) / 2]
+
+        # biquadratic case (q == 0), where the factorization breaks down
+        delta = p ** 2 - 4 * r
+        sqd = sqrt(where((delta < 0) & (delta > -1e-9 * p ** 2), 0, delta))
+        y2 = sqrt((-p + sqd) / 2), sqrt((-p - sqd) / 2)
+        biq = [y2[0], -y2[0], y2[1], -y2[1]]
+        degenerate = ~(m > 1e-12 * (abs(p) + sqrt(abs(r))))
+
+        # (4, N), which is faster to work on than (N, 4)
+        x = stack([where(degenerate, yb, y) - b / 4
+                   for y, yb in zip(ys, biq)])
+
+        x, step = _polish(x, b, c, d, e, polish)
+        suspect = _suspect(x, step, b, c, d, e)
+        if suspect.any():
+            b, c, d, e = (v[suspect] for v in (b, c, d, e))
+            x[:, suspect], _ = _polish(_companion_roots(b, c, d, e).T,
+                                       b, c, d, e, polish)
+    return x.T
+
+
+def _polish(x, b, c, d, e, iterations):
+    """
+    Refine the roots x of the monic quartic with Newton iterations,
+    returning them along with the last step taken.
+    """
+    step = zeros(x.shape)
+    for _ in range(iterations):
+        f = (((x + b) * x + c) * x + d) * x + e
+        df = ((4 * x + 3 * b) * x + 2 * c) * x + d
+        step = where(df != 0, f / df, 0)
+        x = x - step
+    return x, step
 
-    p1, p2, p3 = p
-    u1, u2, u3 = u
-    q1, q2, q3 = q
-    v1, v2, v3 = v
-
-    print(u1, u2, u3)
 
-    # make sure the directions are normalized
-    assert allclose(u1**2 + u2**2 + u3**2, 1.0)
-    assert allclose(v1**2 + v2**2 + v3**2, 1.0)
+def closest_points(p, u, q, v):
+    """
+    Given lines described by points p, q and directions u, v
+    respectively, calculate the parameters s, t of the points
+    p + s*u and q + t*v where the lines are closest. Works on single
+    lines as well as on arrays of line pairs, along the last axis.
 
-    y = 1 - (u1*v1 + u2*v2 + u3*v3)**2
+    Parallel lines have no unique closest points; s and t are NaN
+    for those, except for a single pair, which raises ValueError.
 
-    # plenty of simplification possible here, I'm sure
-    if y != 0.0:
-        t = (((p1*v1 + p2*v2 + p3*v3 - q1*v1 - q2*v2 - q3*v3) -
-              (u1*v1 + u2*v2 + u3*v3) *
-              (p1*u1 + p2*u2 + p3*u3 - q1*u1 - q2*u2 - q3*u3)) / y)
-    else:
-        t = None
+    The solution comes from requiring that the line between the
+    points is orthogonal to both u and v.
+    """
+    p, u, q, v = (asarray(x, dtype=float64) for x in (p, u, q, v))
+    w = p - q
+    a = (u * u).sum(-1)
+    b = (u * v).sum(-1)
+    c = (v * v).sum(-1)
+    d = (u * w).sum(-1)
+    e = (v * w).sum(-1)
+    denom = a * c - b**2
+    # Relative test, since the directions need not be normalized
+    parallel = abs(denom) <= 1e-14 * a * c
+    if parallel.ndim == 0 and parallel:
+        raise ValueError("The lines are parallel")
+    with errstate(invalid="ignore", divide="ignore"):
+        denom = where(parallel, nan, denom)
+        s = (b * e - c * d) / denom
+        t = (a * e - b * d) / denom
+    return s, t
 
-    x = 1 - (u1*v1 + u2*v2 + u3*v3)**2
 
-    if x != 0.0:
-        s = ((x * (-p1*u1 - p2*u2 - p3*u3 + q1*u1 + q2*u2 + q3*u3) +
-              ((p1*v1 + p2*v2 + p3*v3 - q1*v1 - q2*v2 - q3*v3) -
-               (u1*v1 + u2*v2 + u3*v3) *
-               (p1*u1 + p2*u2 + p3*u3 - q1*u1 - q2*u2 - q3*u3)) *
-              (u1*v1 + u2*v2 + u3*v3)) / x)
+def estimate_focus(points, directions, weights=None, groups=None):
+    """
+    Find the point closest to all the given lines (e.g. rays), in the
+    least squares sense, i.e. minimizing the (weighted) sum of squared
+    distances. If groups is given, one such point is found for each
+    unique value in it, e.g. for each wavelength, in one batched solve,
+    and the unique values are returned along with the points.
+
+    The result is NaN if the lines are (nearly) parallel, since there
+    is no focus then.
+    """
+    # Work on contiguous (3, N) arrays, since rays are stored by row
+    p = ascontiguousarray(asarray(points, dtype=float64).T)
+    d = ascontiguousarray(asarray(directions, dtype=float64).T)
+    d /= sqrt(d[0]**2 + d[1]**2 + d[2]**2)
+    n = p.shape[1]
+    w = ones(n) if weights is None else broadcast_to(weights, n)
+    wd = d * w
+    wpd = (wd * p).sum(0)
+
+    # The normal equations: sum(w*(I - d d^T)) x = sum(w*(I - d d^T) p)
+    # Per ray, the terms are w, w*d*d^T and w*(p - d*(d.p)).
+    if groups is None:
+        keys = None
+        a = (w.sum() * identity(3) - wd.dot(d.T))[None]
+        b = (p.dot(w) - d.dot(wpd))[None]
     else:
-        s = t
-
-    # This is pretty ugly
-    if t is None:
-        t = s
-
-    if t is None and s is None:
-        raise ValueError
-
-    return s, t
+        keys, labels = unique(groups, return_inverse=True)
+        total = lambda values: bincount(labels, values, minlength=len(keys))
+        a = empty((len(keys), 3, 3))
+        weight = total(w)
+        for i in range(3):
+            for j in range(i, 3):
+                a[:, i, j] = a[:, j, i] = -total(wd[i] * d[j])
+            a[:, i, i] += weight
+        b = stack([total(w * p[i] - wpd * d[i]) for i in range(3)], axis=1)
+
+    # Parallel lines give a singular matrix, whose smallest
+    # eigenvalue is zero compared to the largest one
+    eigenvalues = eigvalsh(a)
+    singular = ~(eigenvalues[:, 0] > 1e-12 * eigenvalues[:, 2])
+    a[singular] = identity(3)
+    focus = solve(a, b[..., None])[..., 0]
+    focus[singular] = nan
+
+    if keys is None:
+        return focus[0]
+    return keys, focus
@@ -1,12 +1,11 @@
 import abc
 from itertools import chain
 from random import seed, randint, gauss
-from sys import maxsize
 
 from numpy import (array, ones, zeros, random, sum,
                    linspace, meshgrid, hstack, vstack)
 from numpy.linalg import norm
-from .member import Member
+from .member import Member, transform
 from .ray import Rays
 from . import Rotation, Position, Length
 
@@ -15,6 +14,9 @@ class Source(Member, metaclass=abc.ABCMeta):
 
     "Source base class"
 
+    # Seed for the random numbers of sources that use them
+    random_seed = 0
+
     def __init__(self, wavelength:Length=0.0, color:str="#ffffff",
                  *args, **kwargs):
 
@@ -25,25 +27,47 @@ class Source(Member, metaclass=abc.ABCMeta):
         self.axis = array((0., 0., 1.0))
 
     @abc.abstractmethod
-    def generate(self, n):
+    def emit(self, n, rng=None):
         """Needs to be overridden by child classes.
-        Should return Rays, probably limited by n.
+        Should return Rays in local coordinates, probably limited by n.
+        Random numbers should be drawn from rng, if given.
+        """
+
+    def count(self, n):
+        """The number of rays emitted when asked for n."""
+        return n
+
+    def chunk_rng(self, chunk):
         """
+        Return a random number generator for the given chunk of rays,
+        which only depends on the seed of the source and the chunk
+        number. That way chunked traces are reproducible, regardless of
+        the order, or the processes, in which the chunks are traced.
+        """
+        return random.default_rng((self.random_seed, chunk))
+
+    def generate(self, n=1):
+        """Return rays in the coordinate system containing the source."""
+        rays = self.emit(n)
+        return self.globalize(rays, out=rays)
 
-    def trace(self, incoming, n=1):
-        traces = self.generate(n)
-        return dict(chain(incoming.items(), [(self._id, [traces])]))
+    def trace(self, incoming, n=1, outer=None):
+        traces = self._trace(incoming, n, *self.composed_matrices(outer))
+        return dict(chain(incoming.items(), [(self._id, [traces[self._id]])]))
+
+    def _trace(self, current, n, matloc, matglob, chunk=None):
+        rays = self.emit(n, None if chunk is None else self.chunk_rng(chunk))
+        return {self._id: transform(rays, matglob, out=rays)}
 
 
 class TrivialSource(Source):
 
     """A very simple pointsource that sends out rays in one direction."""
 
-    def generate(self, n=1):
+    def emit(self, n=1, rng=None):
         endpoints = zeros((n, 3))
         directions = ones((n, 3)) * self.axis
-        rays = Rays(endpoints, directions, zeros(n))
-        return self.globalize(rays)
+        return Rays(endpoints, directions, zeros(n))
 
 
 class GridSource(Source):
@@ -57,7 +81,10 @@ class GridSource(Source):
         self.resolution = resolution
         Source.__init__(self, *args, **kwargs)
 
-    def generate(self, _=None):
+    def count(self, _):
+        return self.resolution ** 3
+
+    def emit(self, _=None, rng=None):
         """TODO: make it more efficient by skipping identical rays."""
         n = self.resolution
         sx, sy, sz = self.size
@@ -69,11 +96,7 @@ class GridSource(Source):
                                          linspace(-dy/2, dy/2, n),
                                          zeros(n))).T + self.axis))
         d = (d.T / sum(d**2, axis=1)**0.5).T
-        rays = self.globalize(
-            Rays(endpoints=s, directions=d,
-                 wavelengths=ones((n**3,)) * self.wavelength))
-
-        return rays
+        return Rays(endpoints=s, directions=d, wavelengths=self.wavelength)
 
 
 class GaussianSource(Source):
@@ -86,29 +109,29 @@ class GaussianSource(Source):
 
     def __init__(self, size:Position=(0, 0, 0),
                  divergence:Position=(0, 0, 0),
-                 random_seed:int=randint(0, maxsize),
+                 random_seed:int=None,
                  *args, **kwargs):
         self.size = Position(size)
         self.divergence = Position(divergence)
+        if random_seed is None:
+            random_seed = randint(0, 2**32 - 1)
         self.random_seed = random_seed
         random.seed(random_seed)
 
         Source.__init__(self, *args, **kwargs)
 
-    def generate(self, n=1):
+    def emit(self, n=1, rng=None):
 
+        rng = rng or random
         sx, sy, sz = self.size
-        s = array((zeros(n) if sx == 0 else random.normal(0, sx, n),
-                   zeros(n) if sy == 0 else random.normal(0, sy, n),
-                   zeros(n) if sz == 0 else random.normal(0, sz, n))).T
+        s = array((zeros(n) if sx == 0 else rng.normal(0, sx, n),
+                   zeros(n) if sy == 0 else rng.normal(0, sy, n),
+                   zeros(n) if sz == 0 else rng.normal(0, sz, n))).T
 
         dx, dy, dz = self.divergence
-        d = array((zeros(n) if dx == 0 else random.normal(0, dx, n),
-                   zeros(n) if dy == 0 else random.normal(0, dy, n),
+        d = array((zeros(n) if dx == 0 else rng.normal(0, dx, n),
+                   zeros(n) if dy == 0 else rng.normal(0, dy, n),
                    zeros(n))).T + self.axis
         d = (d.T / sum(d**2, axis=1)**0.5).T  # this can't be the best way
                                               # to normalize the directions
-        rays = self.globalize(Rays(endpoints=s, directions=d,
-                                   wavelengths=ones((n,)) * self.wavelength))
-
-        return rays
+        return Rays(endpoints=s, directions=d, wavelengths=self.wavelength)
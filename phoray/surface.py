@@ -4,13 +4,11 @@ from abc import ABCMeta, abstractmethod
 from math import *
 
 import numpy as np
-from numpy import (array, dot, cross, where, sqrt,
-                   cos, sin, arccos, arcsin)
+from numpy import array, cross, where, sqrt, cos, sin, arccos, arcsin
 
-from .transformations import (rotation_matrix, angle_between_vectors,
-                              vector_norm)
+from .transformations import angle_between_vectors, vector_norm
 from .ray import Rays
-from .solver import quadratic
+from .solver import quadratic, quartic
 from . import PhorayBase, Length
 
 
@@ -24,6 +22,11 @@ class Surface(PhorayBase, metaclass=ABCMeta):
     Should not be instantiated but serves as a base class to be inherited.
     """
 
+    # Whether to check which rays can hit the surface before intersecting;
+    # otherwise all rays are intersected, and only _intersect checks
+    # the aperture.
+    cull = True
+
     def __init__(self, xsize:Length=1.0, ysize:Length=1.0):
         self.xsize, self.ysize = xsize, ysize
 
@@ -31,11 +34,108 @@ class Surface(PhorayBase, metaclass=ABCMeta):
     def get_module_name(cls):
         return cls.__module__.split(".")[-1]
 
+    def intersect(self, rays):
+        """
+        Return the points where the rays intersect the surface, NaN
+        where they miss. Only live rays that pass through the bounding
+        box of the surface are actually intersected, and points outside
+        the box (e.g. on the back side of a closed surface) are misses.
+        """
+        return self._hits(rays, lambda rays: (self._intersect(rays),))[0]
+
+    def intersect_with_normal(self, rays):
+        """
+        Return the points where the rays intersect the surface, like
+        intersect, and the surface normals at those points. This is
+        cheaper than calling intersect and normal, since surfaces can
+        reuse the terms they have in common.
+        """
+        return self._hits(rays, self._intersect_with_normal, 2)
+
+    def _hits(self, rays, compute, outputs=1):
+        """
+        Call compute, which returns a tuple of outputs (N, 3) arrays
+        with the points first, for the rays that may hit the surface.
+        """
+        candidates = rays.alive
+        if self.cull:
+            lower, upper = self._box()
+            candidates = candidates & self.may_hit(rays, lower, upper)
+        if candidates.all():
+            results = compute(rays)
+        else:
+            results = tuple(np.full((len(rays), 3), np.NaN)
+                            for _ in range(outputs))
+            if candidates.any():
+                subset = Rays.wrap(rays.data[candidates],
+                                   rays.ids[candidates],
+                                   rays.alive[candidates])
+                for result, values in zip(results, compute(subset)):
+                    result[candidates] = values
+        if not self.cull:
+            return results
+        outside = (results[0] < lower) | (results[0] > upper)
+        outside = outside[:, 0] | outside[:, 1] | outside[:, 2]
+        for result in results:
+            result[outside] = np.NaN
+        return results
+
     @abstractmethod
-    def intersect(self, r):
+    def _intersect(self, rays):
         """This method needs to be implemented by an actual surface.
-        Shall return the point where Ray r intersects the surface.
+        Shall return the points where the rays intersect the surface,
+        or NaN where they don't.
+        """
+
+    def _intersect_with_normal(self, rays):
+        """Surfaces can override this to share terms between the
+        intersection and the normals."""
+        points = self._intersect(rays)
+        return points, self.normal(points)
+
+    def bounds(self):
+        """
+        Return the lower and upper corners of a box containing the
+        surface, within its aperture.
+        """
+        zmin, zmax = self.zrange()
+        return (array((-self.xsize / 2, -self.ysize / 2, zmin)),
+                array((self.xsize / 2, self.ysize / 2, zmax)))
+
+    def zrange(self):
+        """The range of z covered by the surface within its aperture.
+        Should be overridden by surfaces that know better."""
+        return -np.inf, np.inf
+
+    def _box(self):
+        "The bounding box, slightly enlarged to allow for rounding."
+        lower, upper = self.bounds()
+        margin = 1e-9 * (1 + np.abs(upper - lower))
+        return lower - margin, upper + margin
+
+    def may_hit(self, rays, lower=None, upper=None):
+        """
+        Return True for the rays whose lines pass through the bounding
+        box (by default, that of the surface). This is much cheaper
+        than intersecting, and rays outside can't hit the surface.
         """
+        if lower is None:
+            lower, upper = self._box()
+        # One pair of faces at a time, on contiguous copies of the
+        # coordinates, which is much faster than working on the
+        # columns of the rays, or reducing over (N, 3) arrays. Where r is 0,
+        # the ray is parallel to the faces and the distances to them are
+        # infinite, with the right signs if the ray is between them.
+        tnear, tfar = -np.inf, np.inf
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for i in range(3):
+                p = np.ascontiguousarray(rays.data[:, i])
+                inverse = 1 / rays.data[:, i + 3]
+                t1 = (lower[i] - p) * inverse
+                t2 = (upper[i] - p) * inverse
+                tnear = np.maximum(tnear, np.minimum(t1, t2))
+                tfar = np.minimum(tfar, np.maximum(t1, t2))
+        return tnear <= tfar
 
     @abstractmethod
     def normal(self, p):
@@ -43,7 +143,7 @@ class Surface(PhorayBase, metaclass=ABCMeta):
         Shall return the normal to the surface at point p.
         """
 
-    def grating_direction(self, ps):
+    def grating_direction(self, ps, normal=None):
         """
         Returns a vector oriented along the grating lines (if any).
         This vector always lies in the plane containing the normal and
@@ -51,9 +151,12 @@ class Surface(PhorayBase, metaclass=ABCMeta):
         perpendicular to the normal. It also always has a non-negative
         projection on the x-axis.
 
+        The normals at the points may be given, if they are known.
+
         FIXME: special case of n and x-axis parallel
         """
-        normal = self.normal(ps)
+        if normal is None:
+            normal = self.normal(ps)
         xaxis = array((1, 0, 0))
         a = cross(xaxis, normal)
         b = cross(normal, a)
@@ -63,44 +166,59 @@ class Surface(PhorayBase, metaclass=ABCMeta):
         """
         Reflect the given ray in the surface, returning the reflected ray.
         """
+        P, n = self.intersect_with_normal(rays)
+        return rays.derive(P, self.reflect_directions(rays.directions, n))
 
-        r = rays.directions
-        P = self.intersect(rays)
-        if P is None:
-            return None
-        else:
-            n = self.normal(P)
-            dots = (r * n).sum(axis=1) * 2.0
-            # Flip if backlit
-            #dots = np.where(dots > 0, dots, -dots)
-            refl = r - (n.T * dots).T
-            return Rays(P, refl, rays.wavelengths)
+    def reflect_directions(self, r, n):
+        """Return the directions r reflected in the surface normals n."""
+        dots = (r * n).sum(axis=1) * 2.0
+        # Flip if backlit
+        #dots = np.where(dots > 0, dots, -dots)
+        return r - (n.T * dots).T
 
     def diffract(self, rays, d, order, line_spacing_function=None):
 
         """
         Diffract the given ray in the surface, returning the diffracted ray.
+        """
+
+        P, n = self.intersect_with_normal(rays)
+        return rays.derive(P, self.diffract_directions(
+            rays, P, n, d, order, line_spacing_function))
+
+    def diffract_directions(self, rays, P, n, d, order,
+                            line_spacing_function=None):
+
+        """
+        Return the directions of the rays diffracted at the points P,
+        where the surface normals are n.
+        """
+        return self.diffract_orders(rays, P, n, d, [order],
+                                    line_spacing_function)[0]
+
+    def diffract_orders(self, rays, P, n, d, orders,
+                        line_spacing_function=None):
+
+        """
+        Return the directions of the rays diffracted at the points P,
+        where the surface normals are n, for each of the given orders.
+        The work that does not depend on the order is only done once.
 
         TODO: it's definitely possible to simplify this. Also, check for
         correctness!
         """
 
-        refl = self.reflect(rays)
-        P = refl.endpoints
-        if order == 0 or d == 0:
-            return refl
+        r_ref = self.reflect_directions(rays.directions, n)
+        if (d == 0 or not any(orders) or
+                (d is None and line_spacing_function is None)):
+            return [r_ref for _ in orders]
         if d is None:
-            if line_spacing_function is None:
-                return refl
-            else:
-                # VLS grating
-                d = line_spacing_function(P)
-        n = self.normal(P)
-        r_ref = refl.directions
+            # VLS grating
+            d = line_spacing_function(P)
         # OK, this isn't great, but for now flip the normal if the
         # ray is hitting the back of the element.
+        g = self.grating_direction(P, n)
         n = (n.T * np.sign((r_ref * n).sum(axis=1))).T
-        g = self.grating_direction(P)
         a = cross(g, n)  # surface tangent
 
         alpha = angle_between_vectors(g, r_ref, axis=1)
@@ -109,35 +227,48 @@ class Surface(PhorayBase, metaclass=ABCMeta):
 
         phi = arccos((g * r_ref).sum(axis=1))  # dot product
         theta = arccos((n * r_ref).sum(axis=1) / sin(phi))
-        theta_m = arcsin(order * rays.wavelengths /
-                         (d * sin(phi)) + sin(theta))
-        r_diff = g.T * x + a.T * y * sin(theta_m) + n.T * y * cos(theta_m)
-        return Rays(P, r_diff.T, rays.wavelengths)
+        sin_theta = sin(theta)
+        step = rays.wavelengths / (d * sin(phi))
+        gx = g.T * x
+        a, n = a.T * y, n.T * y
+        directions = []
+        for order in orders:
+            if order == 0:
+                directions.append(r_ref)
+                continue
+            theta_m = arcsin(order * step + sin_theta)
+            r_diff = gx + a * sin(theta_m) + n * cos(theta_m)
+            directions.append(r_diff.T)
+        return directions
 
     def refract(self, rays, i1, i2):
         """
-        Refurns the refracted ray given an incident ray.
-        Uses Snell's law. Does not simulate dispersion.
+        Refract the given rays in the surface, going from refraction
+        index i1 to i2, returning the refracted rays.
+        """
+        P, n = self.intersect_with_normal(rays)
+        return rays.derive(P, self.refract_directions(rays.directions,
+                                                      n, i1, i2))
 
-        FIXME: Completely wrong.
-        TODO: port to numpy.
+    def refract_directions(self, r, n, i1, i2):
         """
-        P = self.intersect(rays)
-        if P is not None:
-            r = ray.directions
-            n = self.normal(P)
-            dotp = dot(n, r)
-            if dotp >= 0:
-                n = -n
-            theta_in = acos(dot(n, r))
-            if sin(theta_in) == 0:
-                return ray
-            theta_out = asin((i1 / i2) * sin(theta_in))
-            v = r % n
-            r2 = dot(-n, rotation_matrix(theta_out, v)[:3, :3].T)
-            return Ray(P, r2, ray.wavelength)
-        else:
-            return None
+        Return the directions r refracted at surface normals n, using
+        the vector form of Snell's law. The rays go from index i1 to
+        i2 regardless of which side of the surface they hit. The
+        indices may also be arrays, with one value per ray. Rays that
+        are totally internally reflected are reflected instead.
+        """
+        cos_in = -(r * n).sum(axis=1)
+        # Turn the normals against the incoming rays
+        sign = np.sign(cos_in)
+        cos_in *= sign
+        eta = np.divide(i1, i2)
+        k = 1 - eta**2 * (1 - cos_in**2)
+        tir = k < 0
+        # For total internal reflection, this gives the reflection
+        factor = where(tir, 2 * cos_in, eta * cos_in - sqrt(abs(k)))
+        eta = where(tir, 1, eta)
+        return r * eta[:, None] + n * (sign * factor)[:, None]
 
     def mesh(self, res=10):
         """
@@ -166,10 +297,17 @@ class Plane(Surface):
     A plane through the origin and perpendicular to z, i.e. z = 0.
     """
 
+    cull = False  # intersecting is as cheap as checking the bounds
+
     def normal(self, ps):
-        return array([(0, 0, 1)] * len(ps))
+        n = np.zeros((len(ps), 3))
+        n[:, 2] = 1
+        return n
 
-    def intersect(self, rays):
+    def zrange(self):
+        return 0, 0
+
+    def _intersect(self, rays):
         rx, ry, rz = r = rays.directions.T
         ax, ay, az = a = rays.endpoints.T
         bx, by, bz = a + r
@@ -206,7 +344,22 @@ class Sphere(Surface):
     def normal(self, p):
         return -(p + self.offset) / self.R
 
-    def intersect(self, rays):
+    def _intersect(self, rays):
+        return self._solve(rays).T - self.offset
+
+    def _intersect_with_normal(self, rays):
+        # the normal is just the scaled point, relative to the center
+        q = self._solve(rays).T
+        return q - self.offset, -q / self.R
+
+    def zrange(self):
+        # the sag at the corners of the aperture
+        rho2 = (self.xsize / 2)**2 + (self.ysize / 2)**2
+        z = -self.R + np.sign(self.R) * sqrt(max(self.R**2 - rho2, 0))
+        return min(0, z), max(0, z)
+
+    def _solve(self, rays):
+        "The intersections, relative to the center of the sphere."
 
         rx, ry, rz = r = rays.directions.T
         #if r.z * self.R <= 0:  # backlit
@@ -232,7 +385,7 @@ class Sphere(Surface):
         nans[:] = np.NaN
         q = where((np.abs(px) <= halfxsize) & (np.abs(py) <= halfysize),
                   p, nans)
-        return q.T - self.offset
+        return q
 
 
 class Toroid(Surface):
@@ -256,12 +409,32 @@ class Toroid(Surface):
         Surface.__init__(self, *args, **kwargs)
 
     def normal(self, p):
-        x, z, y = (p + self.offset).T
-        a = x**2 + y**2 + z**2 - self.r**2 - self._R**2
-        n = array((4*x * a, 4*z * a + 8 * self._R**2 * z, 4*y * a))
+        return self._normal((p + self.offset).T)
+
+    def _normal(self, q):
+        # The normal points from the nearest point on the central ring
+        # (in the xz plane), which stays accurate also when r -> R.
+        x, y, z = q
+        rho = sqrt(x**2 + z**2)
+        k = 1 - self._R / where(rho > 0, rho, np.inf)
+        n = array((x * k, y, z * k))
         return -(n / vector_norm(n, axis=0)).T
 
-    def intersect(self, rays):
+    def _intersect(self, rays):
+        return self._solve(rays).T - self.offset
+
+    def _intersect_with_normal(self, rays):
+        q = self._solve(rays)
+        return q.T - self.offset, self._normal(q)
+
+    def zrange(self):
+        # The deepest point is at the corners, where the distance from
+        # the center, in the xz plane, is the smallest.
+        rho = self._R + sqrt(max(self.r**2 - (self.ysize / 2)**2, 0))
+        return -self.R + sqrt(max(rho**2 - (self.xsize / 2)**2, 0)), 0
+
+    def _solve(self, rays):
+        "The intersections, relative to the center of the toroid."
 
         rx, ry, rz = r = rays.directions.T
         ax, ay, az = a = (rays.endpoints + self.offset).T
@@ -278,17 +451,15 @@ class Toroid(Surface):
                       B**2 + 2*A*C + 4*_R**2*ry**2,
                       2*B*C + 8*_R**2*ay*ry,
                       C**2 + 4*_R**2*ay**2 - 4*_R**2*_r**2)).T
-        t = array([np.roots(p) for p in poly]).T
+        t = quartic(poly)  # complex roots are NaN
+        tmax = np.fmax.reduce(t, axis=1)
+        tmin = np.fmin.reduce(t, axis=1)
 
         # Figure out which intersection we should use
         if self._R > 0:
-            p = where(az + np.max(t, axis=0) * rz > 0,
-                      a + np.real(np.max(t, axis=0)) * r,
-                      a + np.real(np.min(t, axis=0)) * r)
+            p = where(az + tmax * rz > 0, a + tmax * r, a + tmin * r)
         else:
-            p = where(az + np.min(t, axis=0) * rz < 0,
-                      a + np.real(np.min(t, axis=0)) * r,
-                      a + np.real(np.max(t, axis=0)) * r)
+            p = where(az + tmin * rz < 0, a + tmin * r, a + tmax * r)
         px, py, pz = p
         halfxsize = self.xsize / 2
         halfysize = self.ysize / 2
@@ -296,7 +467,7 @@ class Toroid(Surface):
         nans[:] = np.NaN
         q = where((np.abs(px) <= halfxsize) & (np.abs(py) <= halfysize),
                   p, nans)
-        return q.T - self.offset
+        return q
 
     def from_fermat(self, angle, arm_in, arm_out):
         R = 1 / ((1/arm_in + 1/arm_out) * (cos(radians(angle)) / 2))
@@ -318,7 +489,22 @@ class Cylinder(Surface):
         r[:, 0] = 0
         return r
 
-    def intersect(self, ray):
+    def _intersect(self, rays):
+        return self._solve(rays).T - self.offset
+
+    def _intersect_with_normal(self, rays):
+        q = self._solve(rays).T
+        n = -q / self.R
+        n[:, 0] = 0
+        return q - self.offset, n
+
+    def zrange(self):
+        y2 = (self.ysize / 2)**2
+        z = -self.R + np.sign(self.R) * sqrt(max(self.R**2 - y2, 0))
+        return min(0, z), max(0, z)
+
+    def _solve(self, ray):
+        "The intersections, relative to the axis of the cylinder."
         rx, ry, rz = r = ray.directions.T
 
         # if rz * self.R <= 0:  # backlit
@@ -348,7 +534,7 @@ class Cylinder(Surface):
         nans = np.empty((3, len(px)))
         nans[:] = np.NaN
         q = where((np.abs(px) <= halfxsize) & (np.abs(py) <= halfysize), p, nans)
-        return q.T - self.offset
+        return q
 
 
 class Ellipsoid(Surface):
@@ -367,11 +553,28 @@ class Ellipsoid(Surface):
         """
         Surface normal at point p, calculated through the gradient
         """
-        p = -((p + self.offset) *
-              (2 / self.a ** 2, 2 / self.b ** 2, 2 / self.c ** 2))
-        return (p.T / vector_norm(p, axis=1)).T
+        return self._normal(p + self.offset)
+
+    def _normal(self, q):
+        q = -(q * (2 / self.a ** 2, 2 / self.b ** 2, 2 / self.c ** 2))
+        return (q.T / vector_norm(q, axis=1)).T
 
-    def intersect(self, ray):
+    def _intersect(self, rays):
+        return self._solve(rays).T - self.offset
+
+    def _intersect_with_normal(self, rays):
+        q = self._solve(rays).T
+        return q - self.offset, self._normal(q)
+
+    def zrange(self):
+        a, b, c = self.a, self.b, self.c
+        if a > 0 and b > 0 and c > 0:
+            s = 1 - (self.xsize / (2*a))**2 - (self.ysize / (2*b))**2
+            return -c + c * sqrt(max(s, 0)), 0
+        return -c - abs(c), -c + abs(c)  # the whole ellipsoid
+
+    def _solve(self, ray):
+        "The intersections, relative to the center of the ellipsoid."
         rx, ry, rz = r = ray.directions.T
         p0x, p0y, p0z = p0 = (ray.endpoints + self.offset).T
 
@@ -398,7 +601,7 @@ class Ellipsoid(Surface):
         nans = np.empty((3, len(px)))
         nans[:] = np.NaN
         q = where((np.abs(px) <= xsize) & (np.abs(py) <= ysize), p, nans)
-        return q.T - self.offset
+        return q
 
 
 class Paraboloid(Surface):
@@ -424,7 +627,12 @@ class Paraboloid(Surface):
         f = sqrt((self.d * px) ** 2 + (self.e * py) ** 2 + 1)
         return array((self.d * px / f, self.e * py / f, 1 / f)).T
 
-    def intersect(self, rays):
+    def zrange(self):
+        z = -self.c * ((self.xsize / (2*self.a))**2 +
+                       (self.ysize / (2*self.b))**2)
+        return min(0, z), max(0, z)
+
+    def _intersect(self, rays):
         rx, ry, rz = r = rays.directions.T
         px, py, pz = p = rays.endpoints.T
         a2, b2, c = self.a ** 2, self.b ** 2, -self.c
@@ -432,9 +640,9 @@ class Paraboloid(Surface):
                       2 * px * rx / a2 + 2 * py * ry / b2 - rz / c,
                       px ** 2 / a2 + py ** 2 / b2 - pz / c)
         if self.concave:
-            p += np.max(t, axis=0) * r
+            p = p + np.max(t, axis=0) * r
         else:
-            p += np.min(t, axis=0) * r
+            p = p + np.min(t, axis=0) * r
         px, py, pz = p
         halfxsize = self.xsize / 2
         halfysize = self.ysize / 2
@@ -1,8 +1,31 @@
 from unittest import TestCase
 from numpy import allclose
 
+from phoray.element import Mirror, Detector
+from phoray.frame import GroupFrame
+from phoray.source import GaussianSource
+from phoray.surface import Plane, Sphere
+
 
 class PhorayTestCase(TestCase):
 
     def assertAllClose(self, a, b, **kwargs):
         assert allclose(a, b, **kwargs), "Not close: %r, %r" % (a, b)
+
+
+def make_system(nested=False):
+    """
+    A source, a spherical mirror and a detector, that many of the tests
+    trace. If nested, the mirror and the detector are in a frame of
+    their own, moved along z, but in the same places as otherwise.
+    """
+    offset = 0.1 if nested else 0
+    source = GaussianSource(divergence=(0.02, 0.02, 0), random_seed=1)
+    mirror = Mirror(geometry=Sphere(2, xsize=0.05, ysize=0.05),
+                    position=(0, 0, 1.1 - offset), rotation=(10, 0, 0))
+    detector = Detector(geometry=Plane(xsize=0.2, ysize=0.2),
+                        position=(0, 0.3, 0.3 - offset), rotation=(20, 0, 0))
+    if nested:
+        return GroupFrame([source, GroupFrame([mirror, detector],
+                                              position=(0, 0, offset))])
+    return GroupFrame([source, mirror, detector])
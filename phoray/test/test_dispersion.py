@@ -0,0 +1,59 @@
+from numpy import array, repeat
+
+from phoray import object_from_dict
+from phoray.dispersion import Sellmeier, Cauchy, Tabulated
+from phoray.element import Glass
+from phoray.ray import Rays
+from phoray.surface import Plane
+from . import PhorayTestCase
+
+
+class CountingCauchy(Cauchy):
+
+    def index(self, wavelengths):
+        self.calls = getattr(self, "calls", 0) + 1
+        return Cauchy.index(self, wavelengths)
+
+
+class DispersionTestCase(PhorayTestCase):
+
+    def test_sellmeier(self):
+        # N-BK7 at the helium d line
+        self.assertAllClose(Sellmeier()([587.56e-9]), 1.5168, atol=1e-4)
+
+    def test_cauchy(self):
+        model = Cauchy((1.5, 0.004, 0.0001))
+        l = array([0.4, 0.5, 0.6])
+        self.assertAllClose(model(l * 1e-6), 1.5 + 0.004 / l**2 + 0.0001 / l**4)
+
+    def test_tabulated(self):
+        model = Tabulated((400e-9, 500e-9, 700e-9), (1.53, 1.52, 1.51))
+        self.assertAllClose(model([300e-9, 450e-9, 600e-9, 800e-9]),
+                            (1.53, 1.525, 1.515, 1.51))
+
+    def test_cached_per_line(self):
+        model = CountingCauchy()
+        lines = array([400e-9, 500e-9, 600e-9])
+        wavelengths = repeat(lines, 1000)
+        indices = model(wavelengths)
+        self.assertEqual(model.calls, 1)
+        self.assertAllClose(indices, Cauchy().index(wavelengths))
+        model(wavelengths[::-1])
+        model(wavelengths[:1000])
+        self.assertEqual(model.calls, 1)
+
+    def test_glass_disperses(self):
+        glass = Glass(index1=1.0, index2=Sellmeier(), geometry=Plane())
+        directions = repeat([(0, 0.5, 0.5**0.5)], 2, axis=0)
+        rays = Rays(-directions, directions, array([400e-9, 700e-9]))
+        refracted = glass.propagate(rays).directions
+        # blue is refracted more
+        self.assertLess(refracted[0, 1], refracted[1, 1])
+        for direction, wavelength in zip(refracted, rays.wavelengths):
+            n = Sellmeier()([wavelength])[0]
+            self.assertAllClose(direction[1], 0.5 / n)
+
+    def test_to_dict(self):
+        glass = Glass(index2=Cauchy((1.4, 0.01)), geometry=Plane())
+        copy = object_from_dict(glass.to_dict())
+        self.assertEqual(copy.index2.coefficients, [1.4, 0.01])
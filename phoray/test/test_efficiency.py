@@ -0,0 +1,77 @@
+from numpy import array, random, meshgrid, radians, sin, cos
+
+from phoray.efficiency import EfficiencyTable, incidence_angles
+from phoray.element import Mirror, ReflectiveGrating
+from phoray.footprint import Moments
+from phoray.frame import GroupFrame
+from phoray.plan import TracePlan
+from phoray.source import GaussianSource
+from phoray.surface import Plane
+from . import PhorayTestCase
+
+
+def bilinear(angles, wavelengths):
+    return 0.2 + 0.003 * angles + 1e5 * wavelengths - 1e3 * angles * wavelengths
+
+
+class EfficiencyTableTestCase(PhorayTestCase):
+
+    def make_table(self):
+        angles = [0, 10, 30, 45, 80]
+        wavelengths = [1e-7, 2e-7, 5e-7]
+        a, w = meshgrid(angles, wavelengths, indexing="ij")
+        return EfficiencyTable(angles, wavelengths,
+                               list(bilinear(a, w).ravel()))
+
+    def test_interpolation(self):
+        table = self.make_table()
+        rng = random.default_rng(0)
+        angles = rng.uniform(0, 80, 1000)
+        wavelengths = rng.uniform(1e-7, 5e-7, 1000)
+        # linear interpolation of a bilinear function is exact
+        self.assertAllClose(table(angles, wavelengths),
+                            bilinear(angles, wavelengths))
+
+    def test_outside(self):
+        table = self.make_table()
+        self.assertAllClose(table(array([-5, 90]), array([1e-8, 1e-6])),
+                            bilinear(array([0, 80]), array([1e-7, 5e-7])))
+
+    def test_incidence_angles(self):
+        normals = array([(0, 0, 1), (0, 0, -1)])
+        directions = array([(0, sin(radians(30)), -cos(radians(30)))] * 2)
+        self.assertAllClose(incidence_angles(directions, normals), 30)
+
+
+class WeightsTestCase(PhorayTestCase):
+
+    def make_system(self):
+        source = GaussianSource(divergence=(1e-3, 1e-3, 0), wavelength=2e-7,
+                                random_seed=0)
+        mirror = Mirror(geometry=Plane(), position=(0, 0, 1),
+                        rotation=(-60, 0, 0), reflectivity=0.9,
+                        accumulators={"moments": Moments()})
+        table = EfficiencyTable([0, 90], [1e-7, 3e-7], [0.1, 0.3, 0.2, 0.6])
+        grating = ReflectiveGrating(d=1e-5, order=1, efficiency=table,
+                                    geometry=Plane(),
+                                    position=(0, -0.433, 1.25),
+                                    rotation=(30, 0, 0))
+        return source, mirror, grating, GroupFrame([source, mirror, grating])
+
+    def test_weights(self):
+        source, mirror, grating, system = self.make_system()
+        trace = system.trace(n=100)[source._id]
+        self.assertTrue(trace[-1].alive.all())
+        self.assertAllClose(trace[1].weights, 0.9)
+        # the rays hit the grating at about 30 degrees
+        self.assertAllClose(trace[2].weights, 0.9 * (0.2 + 0.2 * 30 / 90),
+                            rtol=1e-2)
+        # the footprint is weighted
+        self.assertAllClose(mirror.accumulated("moments")[source._id].weight,
+                            90)
+
+    def test_plan(self):
+        source, mirror, grating, system = self.make_system()
+        trace = TracePlan(system).run(100)[source._id]
+        self.assertAllClose(trace[1].weights, 0.9)
+        self.assertAllClose(trace[2].weights, 0.24, rtol=1e-2)
@@ -0,0 +1,142 @@
+from math import copysign
+from random import uniform
+
+from numpy import (array, array_equal, diff, full, linspace, ones, random,
+                   zeros)
+from numpy.linalg import norm
+
+from phoray.element import ReflectiveGrating, ReflectiveVLSGrating, Screen
+from phoray.frame import GroupFrame
+from phoray.plan import TracePlan
+from phoray.source import GaussianSource
+from phoray.ray import Rays
+from phoray.surface import Plane, Sphere, Cylinder, Ellipsoid, Toroid
+from . import PhorayTestCase
+
+
+def profile(geometry, ys):
+    "Points on the surface at x = 0 and the given y, and their normals."
+    n = len(ys)
+    rays = Rays(array((zeros(n), ys, full(n, -1.0))).T,
+                array((zeros(n), zeros(n), ones(n))).T, None)
+    return geometry.intersect_with_normal(rays)
+
+
+def measured_line_distance(an, geometry, y):
+    """
+    The VLS line distance at the surface point at x = 0 and y, with the
+    arc length measured along a fine polyline on the surface, and the
+    tangent angle taken from the surface normal.
+    """
+    points, _ = profile(geometry, linspace(0, y, 2001))
+    x = copysign(norm(diff(points, axis=0), axis=1).sum(), y) * 1000
+    _, normals = profile(geometry, array([y]))
+    density = sum(a * x**n for n, a in enumerate(an)) * abs(normals[0, 2])
+    return 1e-3 / density
+
+
+class VLSGratingTestCase(PhorayTestCase):
+
+    geometries = [Plane(), Sphere(-2.5), Sphere(3), Cylinder(2),
+                  Toroid(R=10, r=0.5)]
+
+    def test_line_distance(self):
+        an = [1200, uniform(-10, 10), uniform(-1, 1), uniform(-0.1, 0.1)]
+        ys = random.default_rng(0).uniform(-0.05, 0.05, 10)
+        for geometry in self.geometries:
+            grating = ReflectiveVLSGrating(an=an, geometry=geometry)
+            points, _ = profile(geometry, ys)
+            expected = [measured_line_distance(an, geometry, y) for y in ys]
+            self.assertAllClose(grating.get_line_distance(points), expected,
+                                rtol=1e-8)
+
+    def test_unsupported_geometry(self):
+        grating = ReflectiveVLSGrating(an=[1200], geometry=Ellipsoid(1, 2, 3))
+        with self.assertRaises(ValueError):
+            grating.get_line_distance(zeros((1, 3)))
+
+    def test_constant_density_is_grating(self):
+        """With constant density, a VLS grating is an ordinary grating,
+        also when it is placed in a system."""
+        gratings = [ReflectiveVLSGrating(an=[100.], order=1,
+                                         geometry=Plane()),
+                    ReflectiveGrating(d=1e-5, order=1, geometry=Plane())]
+        results = []
+        for grating in gratings:
+            grating.position = (0, 0.01, 1)
+            grating.rotation = (60, 0, 0)
+            source = GaussianSource(divergence=(1e-3, 1e-3, 0),
+                                    wavelength=5e-7, random_seed=0)
+            system = GroupFrame([source, grating])
+            results.append(system.trace(n=10)[source._id][-1])
+        vls, plain = results
+        self.assertAllClose(vls.endpoints, plain.endpoints)
+        self.assertAllClose(vls.directions, plain.directions)
+
+
+class MultiOrderGratingTestCase(PhorayTestCase):
+
+    def make_system(self, **kwargs):
+        source = GaussianSource(divergence=(1e-3, 1e-3, 0), wavelength=5e-7,
+                                random_seed=0)
+        grating = ReflectiveGrating(d=1e-5, geometry=Plane(),
+                                    position=(0, 0.01, 1),
+                                    rotation=(60, 0, 0), **kwargs)
+        screen = Screen(geometry=Plane(xsize=10, ysize=10),
+                        position=(0, 2, 1), rotation=(90, 0, 0))
+        return source, GroupFrame([source, grating, screen])
+
+    def test_same_as_single_orders(self):
+        orders = [-2, -1, 0, 1, 2]
+        source, system = self.make_system(orders=orders)
+        result = system.trace(n=10)
+        self.assertEqual(sorted(result), [(source._id, order)
+                                          for order in orders])
+        for order in orders:
+            source1, system1 = self.make_system(order=order)
+            expected = system1.trace(n=10)[source1._id]
+            trace = result[source._id, order]
+            self.assertEqual(len(trace), 3)
+            for rays, expected_rays in zip(trace, expected):
+                self.assertTrue(array_equal(rays.data, expected_rays.data,
+                                            equal_nan=True))
+
+    def test_efficiency_for_each_order(self):
+        source, system = self.make_system(orders=[0, 1],
+                                          efficiency={0: 0.6, 1: 0.1})
+        result = system.trace(n=10)
+        self.assertAllClose(result[source._id, 0][1].weights, 0.6)
+        self.assertAllClose(result[source._id, 1][1].weights, 0.1)
+
+    def test_same_efficiency_for_all_orders(self):
+        # a single efficiency is applied to every order, so each order
+        # carries the full weight times the efficiency
+        source, system = self.make_system(orders=[-1, 0, 1], efficiency=0.5)
+        result = system.trace(n=10)
+        for order in (-1, 0, 1):
+            self.assertAllClose(result[source._id, order][1].weights, 0.5)
+
+    def test_bad_orders(self):
+        self.assertRaises(ValueError, ReflectiveGrating, d=1e-5, orders=[])
+        self.assertRaises(ValueError, ReflectiveGrating, d=1e-5,
+                          orders=[0, 1], efficiency={1: 0.1})
+
+    def test_footprints_by_order(self):
+        source, system = self.make_system(orders=[0, 1])
+        system.trace(n=10)
+        screen = system.children[-1]
+        self.assertEqual(sorted(screen.footprint),
+                         [(source._id, 0), (source._id, 1)])
+        for _, hits in system.survival():
+            self.assertEqual(hits, {(source._id, 0): 10, (source._id, 1): 10})
+
+    def test_plan(self):
+        source, system = self.make_system(orders=[0, 1])
+        source.divergence = (0, 0, 0)  # same rays in every trace
+        expected = system.trace(n=10)
+        result = TracePlan(system).run(10)
+        self.assertEqual(sorted(result), sorted(expected))
+        for key, trace in result.items():
+            self.assertEqual(len(trace), 3)
+            for rays, expected_rays in zip(trace, expected[key]):
+                self.assertAllClose(rays.data, expected_rays.data)
@@ -0,0 +1,106 @@
+from base64 import b64decode
+import json
+
+from numpy import array, array_equal, frombuffer, isnan, random
+
+from phoray.webui.encoding import (trace_paths, encode_array, pack, unpack,
+                                   stratified, SUCCEEDED)
+from . import PhorayTestCase, make_system
+
+
+def paths_by_loop(trace):
+    "How the web UI used to collect the paths, one ray at a time."
+    paths = []
+    for i in range(len(trace[0])):
+        path = []
+        for j, rays in enumerate(trace):
+            if isnan(rays.endpoints[i][0]):
+                path.append(trace[j-1].endpoints[i] +
+                            trace[j-1].directions[i])
+                paths.append((path, False))
+                break
+            path.append(rays.endpoints[i])
+        else:
+            if not isnan(rays.directions[i][0]):
+                path.append(rays.endpoints[i] + rays.directions[i])
+            paths.append((path, True))
+    return paths
+
+
+class TracePathsTestCase(PhorayTestCase):
+
+    def test_same_as_loop(self):
+        system = make_system()
+        trace = system.trace(n=200)[system.children[0]._id]
+        vertices, offsets, status = trace_paths(trace)
+        expected = paths_by_loop(trace)
+        self.assertEqual(len(offsets), 201)
+        self.assertEqual(set(status), {0, 1})
+        for i, (path, succeeded) in enumerate(expected):
+            self.assertEqual(status[i] == SUCCEEDED, succeeded)
+            self.assertAllClose(vertices[offsets[i]:offsets[i + 1]],
+                                array(path), atol=1e-6)
+
+    def test_budget(self):
+        system = make_system()
+        trace = system.trace(n=1000)[system.children[0]._id]
+        _, _, all_status = trace_paths(trace)
+        vertices, offsets, status = trace_paths(trace, budget=100)
+        self.assertEqual(len(status), 100)
+        self.assertAlmostEqual((status == SUCCEEDED).mean(),
+                               (all_status == SUCCEEDED).mean(), delta=0.01)
+        self.assertEqual(offsets[-1], len(vertices))
+
+    def test_stratified(self):
+        strata = array([0] * 990 + [1] * 10)
+        chosen = stratified(strata, 50)
+        self.assertEqual(list(strata[chosen]).count(1), 1)
+        self.assertEqual(len(chosen), 50)
+        self.assertEqual(len(set(chosen)), 50)
+
+    def test_stratified_small_budgets(self):
+        strata = array([0] * 990 + [1] * 10)
+        self.assertEqual(len(stratified(strata, 0)), 0)
+        # too few for both, so the larger stratum gets it
+        self.assertEqual(list(strata[stratified(strata, 1)]), [0])
+        self.assertEqual(sorted(strata[stratified(strata, 2)]), [0, 1])
+        three = array([0] * 5 + [1] * 3 + [2] * 2)
+        for budget in range(12):
+            chosen = stratified(three, budget)
+            self.assertEqual(len(chosen), min(budget, 10))
+            self.assertEqual(len(set(chosen)), len(chosen))
+
+    def test_zero_budget(self):
+        system = make_system()
+        trace = system.trace(n=100)[system.children[0]._id]
+        vertices, offsets, status = trace_paths(trace, budget=0)
+        self.assertEqual((len(vertices), list(offsets), len(status)),
+                         (0, [0], 0))
+
+    def test_encode_array(self):
+        a = array([(1.5, 2), (3, 4)], dtype="float32")
+        encoded = encode_array(a)
+        self.assertEqual(encoded["dtype"], "float32")
+        self.assertEqual(list(encoded["shape"]), [2, 2])
+        decoded = frombuffer(b64decode(encoded["data"]), dtype="<f4")
+        self.assertEqual(list(decoded), [1.5, 2, 3, 4])
+
+    def test_pack(self):
+        vertices = array([(1.5, 2, 3), (4, 5, 6)], dtype="float32")
+        status = array([1, 0, 1], dtype="uint8")
+        obj = {"a": {"vertices": vertices, "status": status},
+               "time": 0.5, "faces": array([(0, 1, 2)], dtype="uint32")}
+        packed = pack(obj)
+        self.assertEqual(len(packed) % 8, 0)
+        unpacked = unpack(packed)
+        self.assertEqual(unpacked["time"], 0.5)
+        for name, a in [("vertices", vertices), ("status", status)]:
+            self.assertEqual(unpacked["a"][name].dtype, a.dtype)
+            self.assertTrue(array_equal(unpacked["a"][name], a))
+        self.assertEqual(unpacked["faces"].shape, (1, 3))
+
+    def test_pack_is_smaller(self):
+        points = random.default_rng(0).normal(size=(1000, 3))
+        packed = pack({"footprint": points.astype("float32")})
+        as_json = json.dumps({"footprint": points.tolist()})
+        self.assertLess(4 * len(packed), len(as_json))
@@ -0,0 +1,99 @@
+from numpy import (array, average, concatenate, histogram, histogram2d,
+                   random, sqrt)
+
+from phoray.element import Detector
+from phoray.footprint import Histogram, Spectrum, Moments, Points, density
+from phoray.frame import GroupFrame
+from phoray.source import GaussianSource
+from phoray.surface import Plane
+from . import PhorayTestCase
+
+
+class AccumulatorTestCase(PhorayTestCase):
+
+    def setUp(self):
+        rng = random.default_rng(3)
+        self.x = rng.normal(5, 0.1, 1000)
+        self.y = rng.normal(-2, 0.3, 1000)
+        self.wl = rng.uniform(1e-7, 2e-7, 1000)
+        self.weights = rng.uniform(0, 1, 1000)
+
+    def add_in_chunks(self, acc, chunk_size=300):
+        for i in range(0, 1000, chunk_size):
+            s = slice(i, i + chunk_size)
+            acc.add(self.x[s], self.y[s], self.wl[s], self.weights[s])
+        return acc
+
+    def test_histogram(self):
+        bins, range_ = (20, 10), ((4.8, 5.2), (-3, -1))
+        acc = self.add_in_chunks(Histogram(bins, range_))
+        expected, _, _ = histogram2d(self.x, self.y, bins, range_,
+                                     weights=self.weights)
+        self.assertAllClose(acc.result(), expected.T)
+        self.assertAlmostEqual(acc.outside + acc.result().sum(),
+                               self.weights.sum())
+
+    def test_spectrum(self):
+        acc = self.add_in_chunks(Spectrum(16, (1e-7, 2e-7)))
+        expected, _ = histogram(self.wl, 16, (1e-7, 2e-7),
+                                weights=self.weights)
+        self.assertAllClose(acc.result(), expected)
+
+    def test_moments(self):
+        acc = self.add_in_chunks(Moments())
+        values = array((self.x, self.y, self.wl))
+        mean = average(values, axis=1, weights=self.weights)
+        rms = sqrt(average((values.T - mean)**2, axis=0,
+                           weights=self.weights))
+        self.assertAllClose(acc.centroid, mean, rtol=1e-12, atol=0)
+        self.assertAllClose(acc.rms, rms, rtol=1e-12, atol=0)
+
+    def test_merge(self):
+        acc1 = self.add_in_chunks(Moments(), 1000)
+        acc2 = Moments()
+        for i in range(0, 1000, 250):
+            part = Moments()
+            s = slice(i, i + 250)
+            part.add(self.x[s], self.y[s], self.wl[s], self.weights[s])
+            acc2.merge(part)
+        self.assertAllClose(acc1.rms, acc2.rms, rtol=1e-12, atol=0)
+
+    def test_density(self):
+        points = array((self.x, self.y, self.wl)).T
+        image = density(points, (30, 20))
+        self.assertEqual(image.result().shape, (20, 30))
+        self.assertEqual(image.result().sum(), 1000)
+        (x0, x1), (y0, y1) = image.range
+        self.assertLess(x0, self.x.min())
+        self.assertGreater(x1, self.x.max())
+        self.assertEqual(density(points[:1]).result().sum(), 1)
+
+    def test_weighted_density(self):
+        points = self.add_in_chunks(Points()).result()
+        image = density(points, (30, 20))
+        self.assertAlmostEqual(image.result().sum(), self.weights.sum())
+        expected, _, _ = histogram2d(self.x, self.y, (30, 20), image.range,
+                                     weights=self.weights)
+        self.assertAllClose(image.result(), expected.T)
+
+    def test_empty(self):
+        acc = self.add_in_chunks(Points())
+        self.assertEqual(acc.result().shape, (1000, 4))
+        self.assertEqual(acc.empty().result().shape, (0, 4))
+        self.assertAllClose(acc.result()[:, 3], self.weights)
+
+
+class ElementFootprintTestCase(PhorayTestCase):
+
+    def test_accumulators_per_source(self):
+        source = GaussianSource(size=(0.1, 0.1, 0), random_seed=1)
+        detector = Detector(geometry=Plane(), position=(0, 0, 1),
+                            save_footprint=False,
+                            accumulators=dict(moments=Moments()))
+        system = GroupFrame([source, detector])
+        for _ in system.trace_iter(1000, chunk_size=300):
+            pass
+        self.assertEqual(detector.footprint, {})
+        moments = detector.accumulated("moments")[source._id]
+        self.assertEqual(moments.weight, 1000)
+        self.assertAllClose(moments.rms[:2], (0.1, 0.1), atol=0.01)
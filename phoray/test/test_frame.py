@@ -0,0 +1,135 @@
+from math import tan, radians
+
+from numpy import array, concatenate
+
+from phoray.frame import GroupFrame, SphericalLens
+from phoray.element import Screen, Mirror
+from phoray.source import TrivialSource, GridSource, GaussianSource
+from phoray.surface import Plane
+from . import PhorayTestCase
+
+
+class FrameTestCase(PhorayTestCase):
+
+    def make_system(self):
+        self.source = TrivialSource(position=(0.1, 0, 0))
+        self.screen = Screen(geometry=Plane(), position=(0, 0.2, 1),
+                             rotation=(10, 0, 0))
+        self.inner = GroupFrame([self.screen], position=(0, 0, 1),
+                                rotation=(0, 0, 90))
+        self.outer = GroupFrame([self.inner], position=(0, 0.1, 0))
+        return GroupFrame([self.source, self.outer])
+
+    def test_compile(self):
+        system = self.make_system()
+        members = [m for m, _, _ in system.compile()]
+        self.assertEqual(members, [self.source, self.screen])
+
+    def test_compile_composes_matrices(self):
+        system = self.make_system()
+        _, matloc, _ = system.compile()[1]
+        p = array([(0.3, 0.2, 0.1)])
+        expected = self.screen.localize_position(
+            self.inner.localize_position(self.outer.localize_position(p)))
+        self.assertAllClose(p.dot(matloc[:3, :3]) + matloc[3, :3], expected)
+
+    def test_compile_is_cached(self):
+        system = self.make_system()
+        self.assertIs(system.compile(), system.compile())
+
+    def test_moving_member_invalidates(self):
+        system = self.make_system()
+        _, matloc1, _ = system.compile()[1]
+        self.outer.position = (0, 0.2, 0)
+        _, matloc2, _ = system.compile()[1]
+        self.assertAllClose(matloc2[3, :3] - matloc1[3, :3],
+                            self.inner.localize_direction((0, -0.1, 0))
+                            .dot(self.screen._matloc[:3, :3])[0])
+
+    def test_trace(self):
+        system = self.make_system()
+        trace = system.trace(n=3)[self.source._id]
+        self.assertEqual(len(trace), 2)
+        # the source sends rays along z, hitting the screen, which is
+        # tilted around the y axis after all the transforms
+        self.assertAllClose(trace[1].endpoints[:, :2], (0.1, 0))
+        self.assertAllClose(trace[1].endpoints[:, 2], 2 - 0.3 * tan(radians(10)))
+
+    def test_trace_iter(self):
+        system = self.make_system()
+        chunks = list(system.trace_iter(10, chunk_size=4))
+        self.assertEqual([len(chunk[self.source._id][-1]) for chunk in chunks],
+                         [4, 4, 2])
+        ids = concatenate([chunk[self.source._id][-1].ids for chunk in chunks])
+        self.assertEqual(list(ids), list(range(10)))
+
+    def test_trace_iter_growing_chunks(self):
+        system = self.make_system()
+        chunks = list(system.trace_iter(20, chunk_size=8,
+                                        first_chunk_size=2))
+        self.assertEqual([len(chunk[self.source._id][-1]) for chunk in chunks],
+                         [2, 4, 8, 6])
+        ids = concatenate([chunk[self.source._id][-1].ids for chunk in chunks])
+        self.assertEqual(list(ids), list(range(20)))
+
+    def test_trace_iter_accumulates_footprint(self):
+        system = self.make_system()
+        for _ in system.trace_iter(10, chunk_size=4):
+            pass
+        self.assertEqual(len(self.screen.footprint[self.source._id]), 10)
+        system.trace(n=3)
+        self.assertEqual(len(self.screen.footprint[self.source._id]), 3)
+
+    def test_compact(self):
+        source = GridSource(size=(0.2, 0.2, 0), resolution=5)
+        screen1 = Screen(geometry=Plane(xsize=0.12, ysize=0.3),
+                         position=(0, 0, 1))
+        screen2 = Screen(geometry=Plane(xsize=0.3, ysize=0.12),
+                         position=(0, 0, 2))
+        system = GroupFrame([source, screen1, screen2])
+        full = system.trace()[source._id]
+        compacted = system.trace(compact=True)[source._id]
+        self.assertEqual([len(rays) for rays in compacted], [125, 75, 45])
+        for rays, expected in zip(compacted, full):
+            expanded = rays.expand(full[0].ids)
+            self.assertEqual(list(expanded.alive), list(expected.alive))
+            self.assertAllClose(expanded.endpoints[expanded.alive],
+                                expected.endpoints[expected.alive])
+        self.assertEqual(system.survival(), [(screen1, {source._id: 75}),
+                                             (screen2, {source._id: 45})])
+
+    def test_spherical_lens(self):
+        source = GaussianSource(size=(0.005, 0.005, 0), random_seed=0,
+                                position=(0, 0, -1))
+        lens = SphericalLens(R1=1.0, R2=1.0, thickness=0.05, index=1.5)
+        system = GroupFrame([source, lens])
+        trace = system.trace(n=100)[source._id]
+        self.assertTrue(trace[-1].alive.all())
+        # the back focal length of a thick lens, from the lensmaker's
+        # equation
+        n, R, d = 1.5, 1.0, 0.05
+        f = 1 / ((n - 1) * (2 / R - (n - 1) * d / (n * R**2)))
+        back = f * (1 - (n - 1) * d / (n * R))
+        self.assertAllClose(trace[-1].estimate_focus(), (0, 0, d/2 + back),
+                            atol=5e-4)
+
+    def test_roulette(self):
+        source = GaussianSource(divergence=(0.01, 0.01, 0), random_seed=0)
+        mirror = Mirror(geometry=Plane(), reflectivity=0.3,
+                        position=(0, 0, 1), rotation=(-60, 0, 0))
+        screen = Screen(geometry=Plane(xsize=10, ysize=10),
+                        position=(0, -0.866, 1.5), rotation=(-60, 0, 0))
+        system = GroupFrame([source, mirror, screen])
+        full = system.trace(n=10000)[source._id]
+        roulette = system.trace(n=10000, compact=True,
+                                roulette=0.9)[source._id]
+        self.assertLess(len(roulette[-1]), 4000)
+        self.assertAllClose(roulette[-1].weights, 0.9)
+        # the total weight is unbiased
+        self.assertAllClose(roulette[-1].weights.sum(),
+                            full[-1].weights.sum(), rtol=0.05)
+        self.assertEqual(system.survival()[-1][1][source._id],
+                         len(roulette[-1]))
+        # and reproducible
+        again = system.trace(n=10000, compact=True, roulette=0.9)[source._id]
+        self.assertEqual(list(again[-1].ids), list(roulette[-1].ids))
@@ -0,0 +1,80 @@
+from threading import Thread
+from time import sleep
+
+from numpy import concatenate
+
+from phoray.webui.jobs import TraceJob, TraceJobs, CANCELLED, FINISHED
+from . import PhorayTestCase, make_system
+
+
+class TraceJobTestCase(PhorayTestCase):
+
+    def setUp(self):
+        self.system = make_system()
+        self.source = self.system.children[0]
+
+    def test_chunks(self):
+        job = TraceJob(self.system, 1000, chunk_size=300)
+        job.run()
+        self.assertEqual(job.state, FINISHED)
+        self.assertEqual(job.done, 1000)
+        paths = job.traces[self.source._id]
+        self.assertEqual(len(paths["status"]), 1000)
+        self.assertEqual(paths["offsets"][-1], len(paths["vertices"]))
+        self.assertTrue((paths["offsets"][1:] > paths["offsets"][:-1]).all())
+
+    def test_budget(self):
+        job = TraceJob(self.system, 1000, chunk_size=300, budget=99)
+        job.run()
+        self.assertEqual(len(job.traces[self.source._id]["status"]), 99)
+
+    def test_updates(self):
+        job = TraceJob(self.system, 10000, chunk_size=4000)
+        thread = Thread(target=job.run)
+        thread.start()
+        updates = list(job.updates())
+        thread.join()
+        self.assertEqual(updates[-1][0]["state"], FINISHED)
+        parts = [paths[self.source._id] for _, paths in updates if paths]
+        status = concatenate([part["status"] for part in parts])
+        self.assertEqual(list(status),
+                         list(job.traces[self.source._id]["status"]))
+
+    def test_cancel(self):
+        job = TraceJob(self.system, 1000, chunk_size=300)
+        job.cancel()
+        job.run()
+        self.assertEqual(job.state, CANCELLED)
+        self.assertEqual(job.done, 0)
+        self.assertIsNone(job.traces)
+
+    def test_cancel_between_chunks(self):
+        job = TraceJob(self.system, 10000, chunk_size=3000)
+
+        class CancelAfterChunk:
+            "Stands in for the tracing lock, cancelling after a chunk."
+            def __enter__(self):
+                pass
+
+            def __exit__(self, *exc):
+                job.cancel()
+
+        job.run(CancelAfterChunk())
+        self.assertEqual(job.state, CANCELLED)
+        self.assertEqual(job.done, job.first_chunk_size)
+        self.assertIsNone(job.traces)
+        # the paths traced so far are still there
+        (status, paths), = job.updates()
+        self.assertEqual(status["state"], CANCELLED)
+        self.assertEqual(len(paths[self.source._id]["status"]),
+                         job.first_chunk_size)
+
+    def test_expire(self):
+        jobs = TraceJobs(keep=0)
+        job = jobs.submit(TraceJob(self.system, 100))
+        with jobs.tracing:
+            self.assertIs(jobs.get(job.id), job)  # not ended yet
+        while not job.ended:
+            sleep(0.01)
+        sleep(0.01)
+        self.assertIsNone(jobs.get(job.id))
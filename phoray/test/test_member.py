@@ -1,7 +1,10 @@
 from random import uniform
 
+from numpy import NaN, isnan
+
 from phoray.ray import Rays
 from phoray.frame import GroupFrame
+from phoray.member import transform
 from . import PhorayTestCase
 
 
@@ -109,6 +112,36 @@ class MemberTestCase(PhorayTestCase):
         self.assertAllClose(r1.endpoints[0], r2.endpoints[0] - pos)
         self.assertAllClose(r1.directions[0], r2.directions[0])
 
+    def test_localize_out(self):
+        r1 = Rays([(A, B, C)], [(D, E, F)], None)
+        member = GroupFrame(position=(G, H, I), rotation=(30, 0, 0))
+        r2 = member.localize(r1, out=r1)
+        self.assertIs(r1, r2)
+        self.assertAllClose(r1.endpoints,
+                            member.localize_position([(A, B, C)]))
+        self.assertAllClose(r1.directions,
+                            member.localize_direction([(D, E, F)]))
+
+    def test_composed_matrices(self):
+        "Composed matrices transform like the frames one after another"
+        r1 = Rays([(A, B, C)], [(D, E, F)], None)
+        outer = GroupFrame(position=(G, H, I), rotation=(90, 0, 30))
+        inner = GroupFrame(position=(I, G, H), rotation=(0, 45, 0))
+        matloc, matglob = inner.composed_matrices(outer.composed_matrices())
+        r2 = transform(r1, matloc)
+        r3 = inner.localize(outer.localize(r1))
+        self.assertAllClose(r2.data, r3.data)
+        self.assertAllClose(transform(r2, matglob).data, r1.data)
+
+    def test_transform_nan_directions(self):
+        "Rays with NaN directions, e.g. stopped, keep their endpoints"
+        r1 = Rays([(A, B, C), (A, B, C)], [(D, E, F), (NaN, NaN, NaN)], None)
+        member = GroupFrame(position=(G, H, I), rotation=(30, 0, 0))
+        r2 = transform(r1, member._matloc)
+        self.assertAllClose(r2.endpoints,
+                            member.localize_position([(A, B, C)] * 2))
+        self.assertTrue(isnan(r2.directions[1]).all())
+
     # def test_globalize_multiple_frames(self):
     #     "Globalizing a ray with several rotated frames is correctly ordered"
     #     p = [(A, B, C)]
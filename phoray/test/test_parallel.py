@@ -0,0 +1,91 @@
+from numpy import array_equal, concatenate
+
+from phoray import object_from_dict
+from phoray.footprint import Moments
+from phoray.element import Detector, ReflectiveGrating
+from phoray.parallel import trace
+from phoray.source import GridSource
+from phoray.surface import Plane
+from . import PhorayTestCase, make_system
+
+
+class ParallelTestCase(PhorayTestCase):
+
+    def test_object_from_dict(self):
+        system = make_system(nested=True)
+        spec = system.to_dict()
+        self.assertEqual(object_from_dict(spec).to_dict(), spec)
+
+    def test_independent_of_processes(self):
+        system = make_system(nested=True)
+        result1 = trace(system, 100, chunk_size=30, processes=1)
+        result2 = trace(system, 100, chunk_size=30, processes=2)
+        for source, traces in result1.items():
+            for rays1, rays2 in zip(traces, result2[source]):
+                self.assertEqual(len(rays1), 100)
+                self.assertTrue(array_equal(rays1.data, rays2.data,
+                                            equal_nan=True))
+
+    def test_same_as_trace_iter(self):
+        system = make_system(nested=True)
+        mirror = system.children[1].children[0]
+        result = trace(system, 100, chunk_size=30, processes=2)
+        footprint = mirror.footprint
+        survival = system.survival()
+        chunks = list(system.trace_iter(100, chunk_size=30))
+        self.assertEqual(system.survival(), survival)
+        for source, traces in result.items():
+            for i, rays in enumerate(traces):
+                data = concatenate([chunk[source][i].data for chunk in chunks])
+                self.assertTrue(array_equal(rays.data, data, equal_nan=True))
+        for source, fp in mirror.footprint.items():
+            self.assertTrue(array_equal(footprint[source], fp))
+
+    def test_roulette(self):
+        system = make_system(nested=True)
+        system.children[1].children[0].reflectivity = 0.5
+        result = trace(system, 100, chunk_size=30, processes=2, roulette=0.8)
+        chunks = list(system.trace_iter(100, chunk_size=30, roulette=0.8))
+        for source, traces in result.items():
+            for i, rays in enumerate(traces):
+                alive = concatenate([chunk[source][i].alive
+                                     for chunk in chunks])
+                self.assertTrue(array_equal(rays.alive, alive))
+            self.assertLess(traces[1].alive.sum(), 80)
+
+    def test_split_rays(self):
+        system = make_system(nested=True)
+        system.children[1].children[1:] = [
+            ReflectiveGrating(d=1e-5, orders=[0, 1], geometry=Plane(),
+                              position=(0, -0.3, 0.2), rotation=(-20, 0, 0)),
+            Detector(geometry=Plane(xsize=10, ysize=10), position=(0, 0, 2))]
+        system.invalidate()
+        result = trace(system, 100, chunk_size=30, processes=2)
+        chunks = list(system.trace_iter(100, chunk_size=30))
+        self.assertEqual(sorted(result), sorted(chunks[0]))
+        for key, traces in result.items():
+            self.assertEqual(len(traces), 4)
+            for i, rays in enumerate(traces):
+                data = concatenate([chunk[key][i].data for chunk in chunks])
+                self.assertTrue(array_equal(rays.data, data, equal_nan=True))
+
+    def test_source_ignoring_n(self):
+        system = make_system(nested=True)
+        system.children[0] = GridSource(resolution=3)
+        system.invalidate()
+        result = trace(system, 10, chunk_size=4, processes=2)
+        for rays in list(result.values())[0]:
+            self.assertEqual(len(rays), 3 * 27)
+            self.assertTrue(array_equal(rays.data[:27], rays.data[27:54],
+                                        equal_nan=True))
+
+    def test_merges_accumulators(self):
+        system = make_system(nested=True)
+        mirror = system.children[1].children[0]
+        mirror.accumulators["moments"] = Moments()
+        trace(system, 100, chunk_size=30, processes=2)
+        rms = [acc.rms for acc in mirror.accumulated("moments").values()]
+        for _ in system.trace_iter(100, chunk_size=30):
+            pass
+        expected = [acc.rms for acc in mirror.accumulated("moments").values()]
+        self.assertAllClose(rms, expected, rtol=1e-12, atol=0)
@@ -0,0 +1,40 @@
+from numpy import array_equal, random
+
+from phoray.plan import TracePlan
+from . import PhorayTestCase, make_system
+
+
+class TracePlanTestCase(PhorayTestCase):
+
+    def test_same_as_trace(self):
+        system = make_system(nested=True)
+        random.seed(17)
+        expected = system.trace(n=100)
+        plan = TracePlan(system)
+        random.seed(17)
+        result = plan.run(100)
+        for source, traces in expected.items():
+            self.assertEqual(len(traces), len(result[source]))
+            for rays1, rays2 in zip(traces, result[source]):
+                self.assertTrue(array_equal(rays1.data, rays2.data,
+                                            equal_nan=True))
+                self.assertTrue(array_equal(rays1.alive, rays2.alive))
+
+    def test_buffers_are_reused(self):
+        plan = TracePlan(make_system(nested=True))
+        result1 = plan.run(10)
+        result2 = plan.run(10)
+        for traces1, traces2 in zip(result1.values(), result2.values()):
+            for rays1, rays2 in zip(traces1, traces2):
+                self.assertIs(rays1, rays2)
+
+    def test_timings(self):
+        plan = TracePlan(make_system(nested=True))
+        plan.run(10)
+        stages = [stage for _, stage in plan.timings]
+        self.assertEqual(stages, ["emit", "transform",
+                                  "transform", "intersect",
+                                  "interact", "transform back",
+                                  "transform", "intersect",
+                                  "interact", "transform back"])
+        self.assertTrue(all(t > 0 for t in plan.timings.values()))
@@ -1,11 +1,14 @@
 from math import sqrt
 from random import seed
 
-from numpy import array
+from numpy import array, isnan, NaN, zeros, uint8, random
+from numpy.linalg import norm
 
-from phoray.ray import Rays
-from phoray.surface import Sphere
-from phoray.element import Mirror
+from phoray.ray import Rays, _fwhm
+from phoray.surface import Sphere, Plane
+from phoray.element import Mirror, Detector
+from phoray.footprint import Moments
+from phoray.frame import GroupFrame
 from phoray.source import GridSource
 from . import PhorayTestCase
 
@@ -15,14 +18,72 @@ seed(123)  # make things more predictable
 
 class RaysTestCase(PhorayTestCase):
 
+    def test_views(self):
+        rays = Rays([(1, 2, 3)], [(0, 0, 1)], 5e-7)
+        rays.endpoints += (1, 1, 1)
+        self.assertAllClose(rays.data[0], (2, 3, 4, 0, 0, 1, 5e-7, 1))
+
+    def test_nan_endpoints_are_dead(self):
+        rays = Rays([(0, 0, 0), (NaN, NaN, NaN)], [(0, 0, 1)] * 2, None)
+        self.assertEqual(list(rays.alive), [True, False])
+
+    def test_derive(self):
+        rays = Rays([(0, 0, 0), (1, 0, 0)], [(0, 0, 1)] * 2, (1e-9, 2e-9),
+                    weights=(0.5, 0.25), ids=(7, 8))
+        new_rays = rays.derive([(0, 0, 1), (NaN, NaN, NaN)], NaN)
+        self.assertAllClose(new_rays.wavelengths, (1e-9, 2e-9))
+        self.assertAllClose(new_rays.weights, (0.5, 0.25))
+        self.assertEqual(list(new_rays.ids), [7, 8])
+        self.assertEqual(list(new_rays.alive), [True, False])
+        self.assertTrue(isnan(new_rays.directions).all())
+
+    def test_compact(self):
+        rays = Rays([(0, 0, 0), (NaN, NaN, NaN), (2, 0, 0)],
+                    [(0, 0, 1)] * 3, None)
+        compacted = rays.compact()
+        self.assertEqual(len(compacted), 2)
+        self.assertEqual(list(compacted.ids), [0, 2])
+        self.assertAllClose(compacted.endpoints, [(0, 0, 0), (2, 0, 0)])
+
+    def test_roulette(self):
+        n = 100000
+        rays = Rays(zeros((n, 3)), zeros((n, 3)), None)
+        rays.weights = random.default_rng(0).uniform(0, 0.2, n)
+        rays.weights[:10] = 0.5
+        rays.alive[10:20] = False
+        before = rays.weights.copy()
+        rays.roulette(0.1, random.default_rng(1))
+        alive = rays.alive
+        # heavy and dead rays are left alone
+        self.assertEqual(list(rays.weights[:20]), list(before[:20]))
+        self.assertTrue(alive[:10].all())
+        self.assertFalse(alive[10:20].any())
+        light = before < 0.1
+        self.assertTrue((rays.weights[light & alive] == 0.1).all())
+        self.assertLess(alive[light].mean(), 0.6)
+        # the expected total weight is unchanged
+        self.assertAllClose(rays.weights[alive].sum(),
+                            before[10:].sum() - before[10:20].sum() +
+                            before[:10].sum(), rtol=1e-2)
+
+    def test_from_buffer(self):
+        buffer = zeros(Rays.nbytes(3) + Rays.nbytes(5), dtype=uint8)
+        rays = Rays.from_buffer(buffer, 5, Rays.nbytes(3))
+        rays.endpoints = (1, 2, 3)
+        rays.ids[:] = 7
+        again = Rays.from_buffer(buffer, 5, Rays.nbytes(3))
+        self.assertAllClose(again.endpoints, [(1, 2, 3)] * 5)
+        self.assertEqual(list(again.ids), [7] * 5)
+        self.assertFalse(Rays.from_buffer(buffer, 3).data.any())
+
     def test_estimate_focus_two_rays(self):
         p1 = (0, 0, 0)
         p2 = (1, 0, 0)
         r1 = (1/sqrt(2), 0, 1/sqrt(2))
         r2 = (0, 1, 0)
         rays = Rays(array((p1, p2)), array((r1, r2)),
-                    array(((0, 0, 0), (0, 0, 0))))
-        a = rays.estimate_focus(1)
+                    array((0, 0)))
+        a = rays.estimate_focus()
         self.assertAllClose(a, (0.75, 0.0, 0.25))
 
     def test_estimate_focus_parallel_rays(self):
@@ -31,10 +92,27 @@ class RaysTestCase(PhorayTestCase):
         r1 = (0, 1, 0)
         r2 = (0, 1, 0)
         rays = Rays(array((p1, p2)), array((r1, r2)),
-                    array(((0, 0, 0), (0, 0, 0))))
-        a = rays.estimate_focus(1)
+                    array((0, 0)))
+        a = rays.estimate_focus()
         self.assertEqual(a, None)
 
+    def test_estimate_focus_samples_deprecated(self):
+        directions = array([(1, 0, 1), (0, 1, 1)])
+        rays = Rays(zeros((2, 3)), directions, array((1, 1)))
+        with self.assertWarns(DeprecationWarning):
+            a = rays.estimate_focus(100)
+        self.assertAllClose(a, (0, 0, 0))
+        with self.assertRaises(TypeError):
+            rays.estimate_focus(None, True)
+
+    def test_estimate_focus_by_wavelength(self):
+        directions = array([(1, 0, 1), (0, 1, 1), (1, 0, 1), (0, 1, 1)])
+        endpoints = array([(0, 0, 0), (0, 0, 0), (0, 0, 1), (0, 0, 1)])
+        rays = Rays(endpoints, directions, array((1, 1, 2, 2)))
+        foci = rays.estimate_focus(by_wavelength=True)
+        self.assertAllClose(foci[1], (0, 0, 0))
+        self.assertAllClose(foci[2], (0, 0, 1))
+
     def test_estimate_focus_spherical_mirror(self):
         sphere = Sphere(1)
         mirror = Mirror(geometry=sphere, position=(0, 0, 1))
@@ -53,5 +131,50 @@ class RaysTestCase(PhorayTestCase):
 
         rays = {0: [source.generate()]}
         refl = mirror.trace(rays)
-        a = refl[0][0].estimate_focus(100)
+        a = refl[0][0].estimate_focus()
         self.assertAllClose(a, (-0.0, 0.57, 1.67), atol=0.05)
+
+    def test_focus_scan(self):
+        rng = random.default_rng(0)
+        endpoints = zeros((10000, 3))
+        endpoints[:, :2] = rng.normal(0, 0.01, (10000, 2))
+        directions = (0, 0, 2) - endpoints
+        directions /= norm(directions, axis=1)[:, None]
+        rays = Rays(endpoints, directions, None)
+        scan = rays.focus_scan((-0.5, 0, 0.25))
+        self.assertAllClose(scan["centroid"], [(0, 0, 1.5), (0, 0, 2),
+                                               (0, 0, 2.25)], atol=1e-4)
+        rms = scan["rms"]
+        self.assertAllClose(rms[1], 0)
+        self.assertAllClose(rms[0], 2 * rms[2])
+        self.assertAllClose(scan["fwhm"][0] / rms[0], 2.355, rtol=0.05)
+
+    def test_focus_scan_nothing_to_scan(self):
+        endpoints = zeros((3, 3))
+        directions = array([(0, 0, 1.)] * 3)
+        dead = Rays(endpoints, directions, None)
+        dead.alive[:] = False
+        self.assertRaises(ValueError, dead.focus_scan, (0, 1))
+        weightless = Rays(endpoints, directions, None, weights=(0, 0, 0))
+        self.assertRaises(ValueError, weightless.focus_scan, (0, 1),
+                          origin=(0, 0, 0), axis=(0, 0, 1))
+
+    def test_fwhm_empty_histogram(self):
+        x = array([(0., 0.5, 1), (5, 6, 7)])
+        fwhm = _fwhm(x, array((1., 1, 1)), array((0., 0)),
+                     array((1., 1)), 10)
+        self.assertTrue(fwhm[0] > 0)
+        self.assertTrue(isnan(fwhm[1]))
+
+    def test_focus_scan_same_as_trace(self):
+        source = GridSource(divergence=(0.1, 0.1, 0), resolution=20)
+        mirror = Mirror(geometry=Sphere(1.5), position=(0, 0, 1))
+        detector = Detector(geometry=Plane(), position=(0, 0, 0.4),
+                            accumulators=dict(moments=Moments()))
+        traces = GroupFrame([source, mirror, detector]).trace()
+        scan = traces[source._id][1].focus_scan(
+            [0.6], origin=(0, 0, 1), axis=(0, 0, -1))
+        moments = detector.accumulated("moments")[source._id]
+        self.assertAllClose(scan["centroid"][0], (0, 0, 0.4))
+        self.assertAllClose(sorted(scan["rms"][0]), sorted(moments.rms[:2]))
+
@@ -0,0 +1,154 @@
+from io import BytesIO
+import json
+import sys
+from threading import Thread
+from time import sleep
+
+from phoray import object_from_dict
+from phoray.webui import server
+from phoray.webui.meta import create_member
+from phoray.webui.encoding import unpack, MEDIA_TYPE
+from . import PhorayTestCase, make_system
+
+
+# What the web UI sends when it asks for packed arrays, see backend.js
+ACCEPT_ARRAYS = MEDIA_TYPE + ", application/json"
+
+
+def call(method, path, query="", body=None, accept=None):
+    "Make a request to the server app, returning (status, headers, body)."
+    body = b"" if body is None else json.dumps(body).encode()
+    environ = {"REQUEST_METHOD": method, "PATH_INFO": path,
+               "QUERY_STRING": query, "SERVER_NAME": "localhost",
+               "SERVER_PORT": "8080", "wsgi.url_scheme": "http",
+               "wsgi.input": BytesIO(body), "wsgi.errors": sys.stderr,
+               "CONTENT_LENGTH": str(len(body)),
+               "CONTENT_TYPE": "application/json; charset=UTF-8"}
+    if accept:
+        environ["HTTP_ACCEPT"] = accept
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started.update(status=int(status.split()[0]), headers=dict(headers))
+
+    data = b"".join(chunk if isinstance(chunk, bytes) else chunk.encode()
+                    for chunk in server.app(environ, start_response))
+    return started["status"], started["headers"], data
+
+
+class TraceJobsTestCase(PhorayTestCase):
+
+    def setUp(self):
+        self.saved, server.data = server.data, make_system()
+        self.source = server.data.children[0]
+
+    def tearDown(self):
+        server.data = self.saved
+
+    def assertArrays(self, status, headers):
+        "Check the response like the web UI does before unpacking it."
+        self.assertTrue(200 <= status < 300)
+        self.assertEqual(headers["Content-Type"], MEDIA_TYPE)
+
+    def test_job_round_trip(self):
+        status, headers, body = call("POST", "/trace-jobs",
+                                     body={"n": 1000, "budget": 100},
+                                     accept=ACCEPT_ARRAYS)
+        self.assertArrays(status, headers)
+        result = self.poll(unpack(body)["id"])
+        self.assertEqual(result["state"], "finished")
+        self.assertEqual(result["done"], 1000)
+        paths = result["traces"][str(self.source._id)]
+        self.assertEqual(len(paths["status"]), 100)
+        # the result is only kept until it is fetched
+        status, _, _ = call("GET", "/trace-jobs/" + result["id"])
+        self.assertEqual(status, 404)
+
+    def poll(self, id):
+        "Poll a job like the web UI did, until it has ended."
+        for _ in range(100):
+            status, headers, body = call("GET", "/trace-jobs/" + id,
+                                         accept=ACCEPT_ARRAYS)
+            self.assertArrays(status, headers)
+            result = unpack(body)
+            if result["state"] not in ("queued", "running"):
+                return result
+            sleep(0.05)
+
+    def test_bad_job_arguments(self):
+        for body in ({}, {"n": "many"}, {"n": 0}, {"n": 10, "budget": -1}):
+            status, _, _ = call("POST", "/trace-jobs", body=body)
+            self.assertEqual(status, 400, body)
+
+    def test_failed_job_is_forgotten(self):
+        def emit(*args):
+            raise ValueError("no rays today")
+        self.source.emit = emit
+        _, _, body = call("POST", "/trace-jobs", body={"n": 1000},
+                          accept=ACCEPT_ARRAYS)
+        job = unpack(body)
+        result = self.poll(job["id"])
+        self.assertEqual(result["state"], "failed")
+        self.assertIn("no rays today", result["error"])
+        status, _, _ = call("GET", "/trace-jobs/" + job["id"])
+        self.assertEqual(status, 404)
+
+    def test_job_events(self):
+        "The UI follows a new job through its event stream"
+        status, headers, body = call("POST", "/trace-jobs",
+                                     body={"n": 5000, "budget": 500},
+                                     accept=ACCEPT_ARRAYS)
+        self.assertArrays(status, headers)
+        job = unpack(body)
+        status, headers, body = call(
+            "GET", "/trace-jobs/%s/events" % job["id"])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["Content-Type"], "text/event-stream")
+        events = [json.loads(event[len("data: "):])
+                  for event in body.decode().split("\n\n") if event]
+        self.assertEqual(events[-1]["state"], "finished")
+        self.assertEqual(events[-1]["done"], 5000)
+        traced = sum(event["traces"][name]["status"]["shape"][0]
+                     for event in events for name in event["traces"])
+        self.assertEqual(traced, 500)
+        status, _, _ = call("GET", "/trace-jobs/" + job["id"])
+        self.assertEqual(status, 404)
+
+    def test_trace_waits_for_jobs(self):
+        "The synchronous trace does not trace while a job does"
+        results = []
+        with server.jobs.tracing:
+            thread = Thread(target=lambda: results.append(
+                call("GET", "/trace", "n=100")))
+            thread.start()
+            sleep(0.2)
+            self.assertEqual(results, [])
+        thread.join()
+        self.assertEqual(results[0][0], 200)
+
+    def test_footprint_image_is_weighted(self):
+        mirror = server.data.children[1]
+        mirror.reflectivity = 0.5
+        server.data.trace(n=1000)
+        detector = server.data.children[2]
+        hits = len(detector.footprint[self.source._id])
+        self.assertGreater(hits, 0)
+        status, headers, body = call("GET", "/footprint",
+                                     "element=children/2&resolution=20x20",
+                                     accept=ACCEPT_ARRAYS)
+        self.assertArrays(status, headers)
+        image = unpack(body)["footprint"]
+        self.assertAlmostEqual(image.sum(), 0.5 * hits, places=3)
+
+
+class MetaTestCase(PhorayTestCase):
+
+    def test_create_member(self):
+        spec = make_system(nested=True).to_dict()
+        self.assertEqual(create_member(spec).to_dict(), spec)
+        self.assertEqual(object_from_dict(spec).to_dict(), spec)
+
+    def test_create_member_defaults(self):
+        spec = {"class": "element.Mirror", "args": {"unknown": 1}}
+        mirror = create_member(spec)
+        self.assertEqual(type(mirror.geometry).__name__, "Plane")
@@ -1,7 +1,9 @@
 from math import sqrt
-from random import random
+from random import random, uniform
 
-from phoray.solver import closest_points
+from numpy import arange, array, poly, roots, sort, isnan
+
+from phoray.solver import closest_points, estimate_focus, quartic
 
 
 from . import PhorayTestCase
@@ -33,3 +35,83 @@ class ClosestPointTestCase(PhorayTestCase):
         s, t = closest_points(p1, r1, p2, r2)
         self.assertAllClose(s, 1/sqrt(2))
         self.assertAllClose(t, 0)
+
+    def test_parallel_lines(self):
+        self.assertRaises(ValueError, closest_points,
+                          (0, 0, 0), (0, 1, 0), (1, 0, 0), (0, 2, 0))
+
+    def test_arrays_of_lines(self):
+        p = array([(0, 0, 0), (0, 0, 0), (0, 0, 0)])
+        u = array([(1/sqrt(2), 0, 1/sqrt(2)), (0, 0, 1), (0, 1, 0)])
+        q = array([(1, 0, 0), (1, 0, 0), (1, 0, 0)])
+        v = array([(0, 1, 0), (0, -2, 0), (0, 1, 0)])
+        s, t = closest_points(p, u, q, v)
+        self.assertAllClose(s[:2], (1/sqrt(2), 0))
+        self.assertAllClose(t[:2], (0, 0))
+        self.assertTrue(isnan(s[2]) and isnan(t[2]))
+
+
+class EstimateFocusTestCase(PhorayTestCase):
+
+    def test_rays_through_point(self):
+        directions = array([(0, 0, 1), (0, 1, 1), (1, 0, 2), (-1, 3, 1)])
+        points = (0.5, -0.2, 1) + directions * array([[1], [-2], [0.5], [3]])
+        self.assertAllClose(estimate_focus(points, directions),
+                            (0.5, -0.2, 1))
+
+    def test_groups(self):
+        directions = array([(0, 0, 1), (0, 1, 1), (1, 0, 1), (0, 1, 0)])
+        points = array([(0, 0, 1), (0, 0, 0), (1, 1, 0), (2, 2, 2)])
+        keys, foci = estimate_focus(points, directions,
+                                    groups=(3, 3, 1, 1))
+        self.assertEqual(list(keys), [1, 3])
+        self.assertAllClose(foci[1], (0, 0, 0))
+        self.assertAllClose(estimate_focus(points[2:], directions[2:]),
+                            foci[0])
+
+    def test_parallel_rays(self):
+        directions = array([(0, 0, 1), (0, 0, 2)])
+        points = array([(0, 0, 0), (1, 0, 0)])
+        self.assertTrue(isnan(estimate_focus(points, directions)).all())
+
+
+class QuarticTestCase(PhorayTestCase):
+
+    def test_real_roots(self):
+        roots = array([(-2, -0.5, 1, 3), (0.1, 0.2, 0.3, 0.4)])
+        coeffs = array([poly(r) for r in roots]) * 2.5
+        result = quartic(coeffs)
+        self.assertAllClose(sort(result, axis=1), roots)
+
+    def test_biquadratic(self):
+        result = quartic([(1, 0, -5, 0, 4)])
+        self.assertAllClose(sort(result, axis=1), [(-2, -1, 1, 2)])
+
+    def test_complex_roots_are_nan(self):
+        # (x**2 + 1) * (x - 1) * (x - 2)
+        result = quartic([(1, -3, 3, -3, 2)])
+        self.assertEqual(isnan(result).sum(), 2)
+        self.assertAllClose(sort(result[~isnan(result)]), (1, 2))
+
+    def test_same_as_roots(self):
+        coeffs = array([[uniform(-1, 1) for _ in range(5)]
+                        for _ in range(100)])
+        result = quartic(coeffs)
+        for c, r in zip(coeffs, result):
+            expected = roots(c)
+            expected = sort(expected[abs(expected.imag) < 1e-7].real)
+            self.assertAllClose(sort(r[~isnan(r)]), expected, atol=1e-6)
+
+    def test_badly_scaled(self):
+        # roots, and a complex pair, of very different sizes
+        roots = array([(-2594.64, 2594.65, 1.3e-6, -1.6e-6),
+                       (-3e4, 1e-3, 2e-3, 2e4),
+                       (1.187, -1.187, -0.5 + 4e4j, -0.5 - 4e4j),
+                       (-1e-5, 8e-5, -4e-5 + 0.2j, -4e-5 - 0.2j)])
+        coeffs = array([poly(r).real for r in roots])
+        coeffs *= 10.0 ** arange(-3, 1)[:, None]
+        result = quartic(coeffs)
+        for r, expected in zip(result, roots):
+            expected = sort(expected[expected.imag == 0].real)
+            self.assertAllClose(sort(r[~isnan(r)]), expected, rtol=1e-6,
+                                atol=0)
@@ -7,7 +7,8 @@ TODO: Most classes have only very basic tests. Expand.
 from math import sqrt, atan, sin, cos, asin
 from random import uniform
 
-from numpy import array, allclose, isnan
+from numpy import array, allclose, isnan, isfinite, random, NaN
+from numpy.linalg import norm
 
 from phoray.surface import (Plane, Sphere, Cylinder, Ellipsoid, Paraboloid,
                             Toroid)
@@ -73,6 +74,32 @@ class PlaneSurfaceTestCase(PhorayTestCase):
                                  diffraction.directions))
 
 
+    def test_refract(self):
+        plane = Plane()
+        angle = uniform(0.1, 1.2)
+        # from both sides of the surface
+        directions = array([(0, sin(angle), cos(angle)),
+                            (0, sin(angle), -cos(angle))])
+        refraction = plane.refract(Rays(-directions, directions, None),
+                                   1.0, 1.5)
+        exit_angle = asin(sin(angle) / 1.5)
+        self.assertAllClose(refraction.endpoints, (0, 0, 0))
+        self.assertAllClose(refraction.directions,
+                            [(0, sin(exit_angle), cos(exit_angle)),
+                             (0, sin(exit_angle), -cos(exit_angle))])
+
+    def test_total_internal_reflection(self):
+        plane = Plane()
+        directions = array([(0, 1, 1), (0, 0.5, 1)])
+        directions /= norm(directions, axis=1)[:, None]
+        refraction = plane.refract(Rays(-directions, directions, None),
+                                   1.5, 1.0)
+        # beyond the critical angle, the ray is reflected
+        self.assertAllClose(refraction.directions[0],
+                            array((0, 1, -1)) / sqrt(2))
+        self.assertGreater(refraction.directions[1, 2], 0)
+
+
 class SphereSurfaceTestCase(PhorayTestCase):
 
     def test_reflect(self):
@@ -131,3 +158,52 @@ class ParaboloidSurfaceTestCase(PhorayTestCase):
         reflection = surf.reflect(ray)
         self.assertAlmostEquals(reflection.directions[0][0], 0)
         self.assertAlmostEquals(reflection.directions[0][1], 0)
+
+
+class BoundsTestCase(PhorayTestCase):
+
+    surfaces = [Sphere(2, xsize=0.5, ysize=0.3),
+                Sphere(-1.5, xsize=0.5, ysize=0.3),
+                Cylinder(1.2, xsize=0.5, ysize=0.6),
+                Ellipsoid(1, 0.7, 0.5, xsize=0.6, ysize=0.5),
+                Toroid(3, 0.5, xsize=1, ysize=0.4),
+                Paraboloid(1, 2, 0.5, xsize=0.6, ysize=0.8)]
+
+    def make_rays(self, n=10000):
+        rng = random.default_rng(0)
+        endpoints = rng.uniform(-0.5, 0.5, (n, 3)) - (0, 0, 1)
+        directions = rng.normal(0, 0.3, (n, 3))
+        directions[:, 2] = 1
+        directions /= norm(directions, axis=1)[:, None]
+        return Rays(endpoints, directions, None)
+
+    def test_culling_keeps_hits(self):
+        rays = self.make_rays()
+        for surface in self.surfaces:
+            points = surface.intersect(rays)
+            expected = surface._intersect(rays)
+            hit = isfinite(points[:, 0])
+            self.assertTrue(hit.any())
+            self.assertAllClose(points[hit], expected[hit])
+            lower, upper = surface.bounds()
+            self.assertTrue(((points[hit] >= lower - 1e-9) &
+                             (points[hit] <= upper + 1e-9)).all())
+            self.assertFalse(hit[~surface.may_hit(rays)].any())
+
+    def test_dead_rays_miss(self):
+        rays = self.make_rays(10)
+        rays.alive[::2] = False
+        for surface in self.surfaces + [Plane(xsize=2, ysize=2)]:
+            self.assertTrue(isnan(surface.intersect(rays)[::2]).all())
+            points, normals = surface.intersect_with_normal(rays)
+            self.assertTrue(isnan(points[::2]).all())
+            self.assertTrue(isnan(normals[::2]).all())
+
+    def test_intersect_with_normal(self):
+        rays = self.make_rays()
+        for surface in self.surfaces + [Plane(xsize=0.5, ysize=0.5)]:
+            points, normals = surface.intersect_with_normal(rays)
+            expected = surface.intersect(rays)
+            self.assertTrue(allclose(points, expected, equal_nan=True))
+            hit = isfinite(points[:, 0])
+            self.assertAllClose(normals[hit], surface.normal(points[hit]))
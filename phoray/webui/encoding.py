@@ -0,0 +1,178 @@
+"""
+Encoding of trace results for the web UI.
+
+The paths of the rays are sent as columns instead of nested lists: a
+float32 buffer with the vertices of all the paths, one after another,
+the offset of each path in it, and the status of each ray.
+
+Arrays are either encoded as base64 inside JSON, or, for clients that
+accept MEDIA_TYPE, packed as raw buffers after a small JSON header.
+"""
+
+from base64 import b64encode
+import json
+from struct import pack_into, unpack_from
+
+from numpy import (arange, argsort, ascontiguousarray, concatenate, cumsum,
+                   empty, flatnonzero, float32, frombuffer, generic,
+                   isfinite, maximum, minimum, ndarray, prod, sort, stack,
+                   uint8, uint32, unique, where, zeros)
+
+
+FAILED, SUCCEEDED = 0, 1
+
+MEDIA_TYPE = "application/x-phoray-arrays"
+ALIGNMENT = 8  # so that typed arrays can be made directly on the buffers
+
+
+def stratified(strata, budget):
+    """
+    The (sorted) indices of at most 'budget' items, chosen evenly spread
+    within each stratum, e.g. status, in proportion to its size. If the
+    budget allows, every stratum keeps at least one item; otherwise the
+    largest strata get one each.
+    """
+    values, counts = unique(strata, return_counts=True)
+    largest = argsort(-counts, kind="stable")
+    sizes = zeros(len(values), dtype=int)
+    if budget < len(values):
+        sizes[largest[:max(budget, 0)]] = 1
+    else:
+        sizes = 1 + (budget - len(values)) * counts // len(strata)
+        sizes[largest[0]] += budget - sizes.sum()
+    chosen = []
+    for value, size in zip(values, minimum(sizes, counts)):
+        members = flatnonzero(strata == value)
+        chosen.append(members[arange(size) * len(members) // max(size, 1)])
+    return sort(concatenate(chosen)) if chosen else arange(0)
+
+
+def trace_paths(trace, budget=None):
+    """
+    Return the paths of the rays in a trace, i.e. a list of Rays with
+    the same rays in each, as (vertices, offsets, status). The path of
+    ray i is vertices[offsets[i]:offsets[i + 1]]: its endpoints until it
+    is lost, followed by a step along its last direction, so that the
+    UI can show where it went. A ray that is lost has FAILED status.
+
+    Given a budget, only about that many of the paths are returned, with
+    the same fraction of failed ones as in the whole trace.
+    """
+    finite = stack([isfinite(rays.endpoints[:, 0]) for rays in trace],
+                   axis=1)
+    n, steps = finite.shape
+    # The first step where each ray is lost, or steps if it is not
+    lost = where(finite.all(axis=1), steps, finite.argmin(axis=1))
+    failed = lost < steps
+    if budget is not None and budget < n:
+        selected = stratified(failed, budget)
+        lost, failed = lost[selected], failed[selected]
+    else:
+        selected = slice(None)
+    endpoints = stack([rays.endpoints[selected] for rays in trace], axis=1)
+    directions = stack([rays.directions[selected] for rays in trace],
+                       axis=1)
+    n = len(lost)
+    rows = arange(n)
+
+    last = where(failed, maximum(lost - 1, 0), steps - 1)
+    tips = endpoints[rows, last] + directions[rows, last]
+    has_tip = isfinite(tips[:, 0]) & (lost > 0)
+
+    paths = empty((n, steps + 1, 3), dtype=float32)
+    paths[:, :steps] = endpoints
+    paths[rows, lost] = tips
+    counts = lost + has_tip
+    vertices = paths[arange(steps + 1) < counts[:, None]]
+
+    offsets = zeros(n + 1, dtype=uint32)
+    offsets[1:] = cumsum(counts)
+    status = where(failed, FAILED, SUCCEEDED).astype(uint8)
+    return vertices, offsets, status
+
+
+def encode_array(a):
+    """A JSON friendly encoding of an array, as little endian base64."""
+    a = ascontiguousarray(a, dtype=a.dtype.newbyteorder("<"))
+    return {"dtype": a.dtype.name, "shape": a.shape,
+            "data": b64encode(a.data).decode("ascii")}
+
+
+def path_arrays(trace, budget=None):
+    """The paths of a trace, as a dict of arrays."""
+    vertices, offsets, status = trace_paths(trace, budget)
+    return {"vertices": vertices, "offsets": offsets, "status": status}
+
+
+def concatenate_paths(parts):
+    """Join the path arrays of consecutive parts of a trace, e.g. chunks."""
+    starts = cumsum([0] + [len(part["vertices"]) for part in parts])
+    offsets = [part["offsets"][1:] + start
+               for part, start in zip(parts, starts)]
+    return {"vertices": concatenate([empty((0, 3), dtype=float32)] +
+                                    [part["vertices"] for part in parts]),
+            "offsets": concatenate([zeros(1, dtype=uint32)] +
+                                   offsets).astype(uint32),
+            "status": concatenate([empty(0, dtype=uint8)] +
+                                  [part["status"] for part in parts])}
+
+
+def encode_paths(trace, budget=None):
+    """The paths of a trace, encoded for JSON."""
+    return {name: encode_array(a)
+            for name, a in path_arrays(trace, budget).items()}
+
+
+def _aligned(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def pack(obj):
+    """
+    Pack a JSON friendly object, that may contain arrays, into bytes:
+    the length of a JSON header (uint32), the header and then the raw
+    arrays, all little endian. In the header, each array is replaced by
+    {"__array__": true, "dtype": ..., "shape": ..., "offset": ...}. The
+    offsets count from the end of the header, rounded up to ALIGNMENT,
+    and are aligned too.
+    """
+    arrays = []
+    size = 0
+
+    def replace(o):
+        nonlocal size
+        if isinstance(o, ndarray):
+            a = ascontiguousarray(o, dtype=o.dtype.newbyteorder("<"))
+            arrays.append((size, a))
+            placeholder = {"__array__": True, "dtype": a.dtype.name,
+                           "shape": a.shape, "offset": size}
+            size = _aligned(size + a.nbytes)
+            return placeholder
+        if isinstance(o, generic):
+            return o.item()
+        raise TypeError("Can't pack %r" % (o,))
+
+    header = json.dumps(obj, default=replace).encode()
+    start = _aligned(4 + len(header))
+    buffer = bytearray(start + size)
+    pack_into("<I", buffer, 0, len(header))
+    buffer[4:4 + len(header)] = header
+    for offset, a in arrays:
+        buffer[start + offset:start + offset + a.nbytes] = a.tobytes()
+    return bytes(buffer)
+
+
+def unpack(data):
+    """The inverse of pack; the arrays are views on the data."""
+    length, = unpack_from("<I", data)
+    start = _aligned(4 + length)
+
+    def restore(o):
+        if o.get("__array__"):
+            a = frombuffer(data, dtype=o["dtype"], offset=start + o["offset"],
+                           count=int(prod(o["shape"])))
+            return a.reshape(o["shape"])
+        return o
+
+    return json.loads(bytes(data[4:4 + length]).decode(),
+                      object_hook=restore)
@@ -0,0 +1,185 @@
+"""
+Trace jobs for the web UI. They run in the background, in a pool of
+workers, so that a large trace does not block the server. Tracing is
+done in chunks, so that a job can report its progress, and the paths
+so far, and be cancelled between chunks. The chunks start small and
+grow, so that the first results come quickly. The result of a job is
+kept until it is fetched, or for a while after the job has ended.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Event, Lock
+from time import time
+from traceback import print_exc
+from uuid import uuid4
+
+from phoray.frame import chunk_sizes
+from .encoding import path_arrays, concatenate_paths
+
+
+QUEUED, RUNNING, FINISHED, CANCELLED, FAILED = (
+    "queued", "running", "finished", "cancelled", "failed")
+ENDED = (FINISHED, CANCELLED, FAILED)
+
+
+class TraceJob:
+
+    """
+    Trace n rays from each source of a system, keeping the paths of
+    (at most) 'budget' of them per source, for display.
+    """
+
+    chunk_size = 20000
+    first_chunk_size = 1000
+
+    def __init__(self, system, n, chunk_size=None, budget=None):
+        self.id = uuid4().hex
+        self.system = system
+        self.n = n
+        if chunk_size:
+            self.chunk_size = chunk_size
+        self.budget = budget
+        self.done = 0  # the number of rays traced so far
+        self.state = QUEUED
+        self.error = None
+        self.time = None
+        self.ended_at = None  # when the job ended, for expiring it
+        self.traces = None
+        self._parts = defaultdict(list)  # the paths of each chunk
+        self._chunks = 0  # the number of chunks done
+        self._changed = Condition()
+        self._cancelled = Event()
+
+    @property
+    def ended(self):
+        return self.state in ENDED
+
+    def status(self):
+        return {"id": self.id, "state": self.state, "n": self.n,
+                "done": self.done, "error": self.error}
+
+    def cancel(self):
+        """Stop the job, before it starts or after the current chunk."""
+        self._cancelled.set()
+
+    def _set_state(self, state):
+        with self._changed:
+            self.state = state
+            if state in ENDED:
+                self.ended_at = time()
+            self._changed.notify_all()
+
+    def _chunk_budget(self, start, size):
+        "Share the budget between the chunks, in proportion to their size."
+        if self.budget is None:
+            return None
+        return ((self.budget * (start + size)) // self.n -
+                (self.budget * start) // self.n)
+
+    def run(self, lock=None):
+        """
+        Trace the system, holding the lock, if given, while tracing
+        each chunk, e.g. to keep footprints from being read meanwhile.
+        """
+        if self._cancelled.is_set():
+            self._set_state(CANCELLED)
+            return
+        self._set_state(RUNNING)
+        lock = lock or Lock()
+        t0 = time()
+        sizes = list(chunk_sizes(self.n, self.chunk_size,
+                                 self.first_chunk_size))
+        chunks = self.system.trace_iter(self.n, self.chunk_size, compact=True,
+                                        first_chunk_size=self.first_chunk_size)
+        try:
+            for start, size in sizes:
+                with lock:
+                    traces = next(chunks)
+                budget = self._chunk_budget(start, size)
+                # Put back the rays lost along the way, so that each ray
+                # has the same index throughout.
+                paths = {key: path_arrays([rays.expand(trace[0].ids)
+                                           for rays in trace], budget)
+                         for key, trace in traces.items()}
+                with self._changed:
+                    for key, part in paths.items():
+                        self._parts[key].append(part)
+                    self._chunks += 1
+                    self.done = start + size
+                    self._changed.notify_all()
+                if self._cancelled.is_set():
+                    self._set_state(CANCELLED)
+                    return
+        except Exception as e:
+            print_exc()
+            self.error = "%s: %s" % (type(e).__name__, e)
+            self._set_state(FAILED)
+            return
+        self.traces = {key: concatenate_paths(parts)
+                       for key, parts in self._parts.items()}
+        self.time = time() - t0
+        self._set_state(FINISHED)
+
+    def updates(self, timeout=None):
+        """
+        Yield the status and the paths of each source traced since the
+        last update, as the chunks are done, until the job has ended. If
+        nothing happens within the timeout, yield the status only, e.g.
+        to check that the receiver is still there.
+        """
+        seen = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(
+                    lambda: self._chunks > seen or self.ended, timeout)
+                ended = self.ended
+                new = {key: parts[seen:self._chunks]
+                       for key, parts in self._parts.items()}
+                seen = self._chunks
+                status = self.status()
+            yield status, {key: concatenate_paths(parts)
+                           for key, parts in new.items() if parts}
+            if ended:
+                return
+
+
+class TraceJobs:
+
+    """
+    The trace jobs, by id, run by a pool of worker threads. The jobs
+    trace the elements in place, and so share their footprints; with
+    the default single worker they run one at a time. The 'tracing'
+    lock is held while a chunk is traced. Jobs that have ended are
+    forgotten after 'keep' seconds, in case nobody fetches them.
+    """
+
+    def __init__(self, workers=1, keep=600):
+        self._pool = ThreadPoolExecutor(workers)
+        self._jobs = {}
+        self._lock = Lock()
+        self.tracing = Lock()
+        self.keep = keep
+
+    def submit(self, job):
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        self._pool.submit(job.run, self.tracing)
+        return job
+
+    def get(self, id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(id)
+
+    def _expire(self):
+        now = time()
+        for id, job in list(self._jobs.items()):
+            if job.ended_at is not None and now - job.ended_at > self.keep:
+                del self._jobs[id]
+
+    def pop(self, id):
+        """Forget the job, e.g. when its result has been fetched."""
+        with self._lock:
+            return self._jobs.pop(id, None)
@@ -5,7 +5,8 @@ from itertools import chain
 from operator import itemgetter
 from pprint import pprint
 
-from phoray import PhorayBase, frame, element, surface, source
+from phoray import (PhorayBase, frame, element, surface, source,
+                    object_from_dict)
 from phoray.member import Member
 from .schema import make_schema
 
@@ -52,14 +53,23 @@ def hash_dict(d):
     return hash(repr(sorted(d.items())))
 
 
+def geometry_spec(spec={}):
+    "Complete a surface spec, for object_from_dict; by default a Plane."
+    return {"class": spec.get("class", "surface.Plane"),
+            "args": spec.get("args", {})}
+
+
 def create_geometry(spec={}):
     """Create a Surface instance from specifications."""
-    cls = classes["surface"].get(spec.get("class", "surface.Plane"))
-    geometry = cls(**spec.get("args", {}))
-    return geometry
+    return object_from_dict(geometry_spec(spec))
 
 
-def create_member(spec={}, path=""):
+def member_spec(spec={}):
+    """
+    Complete a member spec from the UI for object_from_dict, with the
+    default class and geometry, and without the arguments that the
+    class does not take.
+    """
     member_type = spec.get("class", list(classes["member"].keys())[0])
     cls = classes["member"][member_type]
     print(cls.get_module_name(), cls.__name__)
@@ -69,13 +79,16 @@ def create_member(spec={}, path=""):
             if key in schema}
     pprint(args)
     if "children" in schema:
-        args["children"] = [
-            create_member(sp, "%s/args/children/%d" % (path, i))
-            for i, sp in enumerate(args.get("children", []))]
+        args["children"] = [member_spec(sp)
+                            for sp in args.get("children", [])]
     if "geometry" in schema:
-        args["geometry"] = create_geometry(args.get("geometry", {}))
-    mem = cls(**args)
-    return mem
+        args["geometry"] = geometry_spec(args.get("geometry", {}))
+    return {"class": member_type, "args": args}
+
+
+def create_member(spec={}):
+    """Create a member, e.g. a whole system, from specifications."""
+    return object_from_dict(member_spec(spec))
 
 
 def object_from_spec(spec):
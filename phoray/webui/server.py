@@ -2,15 +2,21 @@
 
 import json
 from pprint import pprint
+from socketserver import ThreadingMixIn
 from time import time
+from wsgiref.simple_server import WSGIServer
 
-from numpy import isnan, ndarray
+from numpy import array, empty, ndarray, float32, uint32, vstack
 from bottle import (Bottle, request, run, static_file, JSONPlugin,
-                    response)
+                    response, abort)
 import jsonpatch
 
 from .meta import schemas, create_member, create_geometry
+from phoray.footprint import density
 from phoray.frame import GroupFrame
+from .encoding import (encode_array, encode_paths, path_arrays, pack,
+                       MEDIA_TYPE)
+from .jobs import TraceJob, TraceJobs, FINISHED, ENDED
 from .util import get_subobj
 
 
@@ -20,11 +26,28 @@ class NumpyAwareJSONEncoder(json.JSONEncoder):
             return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
 app = Bottle()
 app.install(JSONPlugin(
     json_dumps=lambda s: json.dumps(s, cls=NumpyAwareJSONEncoder)))
 
 
+def wants_arrays():
+    "Whether the client accepts arrays packed as raw buffers."
+    return MEDIA_TYPE in request.headers.get("Accept", "")
+
+
+def reply(result):
+    "Return the result packed, if the client accepts it, otherwise as JSON."
+    if result is not None and wants_arrays():
+        response.content_type = MEDIA_TYPE
+        return pack(result)
+    return result
+
+
 # == Route callbacks ===
 
 @app.route('/')
@@ -82,7 +105,17 @@ def get_mesh():
     spec = query["spec"]
     geo = create_geometry(spec)
     verts, faces = geo.mesh()
-    return {"verts": verts, "faces": faces}
+    if wants_arrays():
+        verts, faces = verts.astype(float32), array(faces, dtype=uint32)
+    return reply({"verts": verts, "faces": faces})
+
+
+def trace_name(key):
+    "The rays split by a grating have keys like (source, order)."
+    return ":".join(map(str, key)) if isinstance(key, tuple) else key
+
+
+jobs = TraceJobs()
 
 
 @app.get('/trace')
@@ -93,52 +126,148 @@ def trace():
     #print("trace")
     #pprint(data)
     n = int(query.n)  # number of rays to trace
+    # the most paths to return for each source, for display
+    budget = int(query.budget) if query.budget else None
     t0 = time()
-    traces = data.trace(n=n)
+    # Not while a trace job is tracing the same elements
+    with jobs.tracing:
+        traces = data.trace(n=n, compact=True)
     dt = time() - t0
     print("traced %d rays, took %f s." % (n, dt))
-    #pprint(traces)
-    # Format the footprint data for consumption by the UI.
-    # Separates out the failed rays and add "dummies" for
-    # non-terminated ones. TODO: very slow, find a better way.
-    result = {}
+    # Put back the rays lost along the way, so that each ray has the
+    # same index throughout.
     t1 = time()
-    for source, trace in traces.items():
-        succeeded = []
-        failed = []
-        for i in range(len(trace[0].endpoints)):
-            tmp2 = []
-            for j, tr in enumerate(trace):
-                broke = False
-                if isnan(tr.endpoints[i][0]):
-                    tmp2.append(tuple(trace[j-1].endpoints[i] +
-                                      trace[j-1].directions[i]))
-                    broke = True
-                    break
-                else:
-                    tmp2.append(tuple(tr.endpoints[i]))
-            if broke:
-                failed.append(tmp2)
-            else:
-                if not isnan(tr.directions[i][0]):
-                    tmp2.append(tuple(tr.endpoints[i] + tr.directions[i]))
-                succeeded.append(tmp2)
-        result[source] = dict(succeeded=succeeded, failed=failed)
-
-    print("trace treatment took", time() - t1, ":(")
-    # result = DataFrame(list(traces.values())).to_json()
-    return dict(traces=result, time=dt)
-
+    encode = path_arrays if wants_arrays() else encode_paths
+    result = {trace_name(source): encode([rays.expand(trace[0].ids)
+                                          for rays in trace], budget)
+              for source, trace in traces.items()}
+    print("encoding the trace took %f s." % (time() - t1))
+    return reply(dict(traces=result, time=dt))
+
+
+def int_arg(args, name, default=None, least=0):
+    "An integer argument of a request, if given; 400 if it is bad."
+    value = args.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(400, "Argument '%s' must be an integer." % name)
+    if value < least:
+        abort(400, "Argument '%s' must be at least %d." % (name, least))
+    return value
+
+
+@app.post('/trace-jobs')
+def start_trace_job():
+    """
+    Start tracing the system in the background, see trace for the
+    arguments. Returns the status of the new job, including its id.
+    """
+    args = request.json or request.query
+    n = int_arg(args, "n", least=1)
+    if n is None:
+        abort(400, "Missing argument 'n'.")
+    chunk_size = int_arg(args, "chunk_size", 0)
+    budget = int_arg(args, "budget")
+    job = jobs.submit(TraceJob(data, n, chunk_size, budget))
+    response.status = 202
+    return reply(job.status())
+
+
+@app.get('/trace-jobs/<id>')
+def trace_job(id):
+    """
+    Return the status of a trace job, e.g. how many rays are done. Once
+    it has ended, the job is forgotten, and if it finished, the traces
+    are returned too, like from trace.
+    """
+    job = jobs.get(id) or abort(404, "No such trace job.")
+    result = job.status()
+    if result["state"] in ENDED:
+        jobs.pop(id)
+    if result["state"] == FINISHED:
+        encode = ((lambda paths: paths) if wants_arrays() else
+                  lambda paths: {name: encode_array(a)
+                                 for name, a in paths.items()})
+        result.update(time=job.time,
+                      traces={trace_name(source): encode(paths)
+                              for source, paths in job.traces.items()})
+    return reply(result)
+
+
+@app.get('/trace-jobs/<id>/events')
+def trace_job_events(id):
+    """
+    Stream the progress of a trace job as server-sent events, each with
+    the status of the job and the paths traced since the last event, as
+    from trace, so that the client can show the trace as it goes. The
+    paths are base64 encoded, since events are text. The last event is
+    sent when the job has ended, and the job is then forgotten.
+    """
+    job = jobs.get(id) or abort(404, "No such trace job.")
+    response.content_type = "text/event-stream"
+    response.set_header("Cache-Control", "no-cache")
+
+    def events():
+        for status, traces in job.updates(timeout=15):
+            status["traces"] = {trace_name(source): {
+                name: encode_array(a) for name, a in paths.items()}
+                for source, paths in traces.items()}
+            if status["state"] in ENDED:
+                jobs.pop(id)
+            if status["state"] == FINISHED:
+                status["time"] = job.time
+            yield "data: %s\n\n" % json.dumps(status,
+                                               cls=NumpyAwareJSONEncoder)
+
+    return events()
+
+
+@app.delete('/trace-jobs/<id>')
+def cancel_trace_job(id):
+    """Cancel a trace job and forget it."""
+    job = jobs.pop(id) or abort(404, "No such trace job.")
+    job.cancel()
+    return reply(job.status())
 
 
 @app.get('/footprint')
 def footprint():
-    """Return the current traced footprint for the given element."""
+    """
+    Return the current traced footprint for the given element; either
+    the raw points, a density image of all the sources at the given
+    resolution (as "columns x rows") or, if given, the result of the
+    named accumulator.
+    """
     query = request.query
     element = get_subobj(data, query.element)
-    if hasattr(element, "footprint"):
+    # Not while a trace job is adding to the footprints
+    with jobs.tracing:
+        return get_footprint(element, query)
+
+
+def get_footprint(element, query):
+    if query.resolution and hasattr(element, "footprint"):
+        bins = tuple(int(n) for n in query.resolution.split("x"))
+        footprints = list(element.footprint.values())
+        image = density(vstack(footprints) if footprints else empty((0, 4)),
+                        bins)
+        counts = image.result()
+        if wants_arrays():
+            counts = counts.astype(float32)
+        return reply({"footprint": counts, "range": image.range})
+    if query.accumulator:
+        accumulated = element.accumulated(query.accumulator)
+        if accumulated:
+            return reply(
+                {"footprint": list(accumulated.values())[0].result()})
+    elif hasattr(element, "footprint"):
         footprint = list(element.footprint.values())[0]
-        return {"footprint": footprint}
+        if wants_arrays():
+            footprint = footprint.astype(float32)
+        return reply({"footprint": footprint})
 
 
 data = GroupFrame([])
@@ -158,8 +287,10 @@ def main():
         except ValueError as e:
             sys.exit("Could not parse JSON file '%s': %s" % (jsonfile, e))
 
-    # Start the server
-    run(app, host='localhost', port=8080, debug=True, reloader=True)
+    # Start the server, handling each request in a thread of its own,
+    # so that streaming the events of a trace job does not block it.
+    run(app, host='localhost', port=8080, debug=True, reloader=True,
+        server_class=ThreadingWSGIServer)
 
 
 if __name__ == "__main__":
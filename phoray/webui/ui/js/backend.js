@@ -22,5 +22,81 @@ var Backend = {};
         if (callback) xhr.onloadend = callback;
     };
 
+    var arrayTypes = {float32: Float32Array, float64: Float64Array,
+                      uint32: Uint32Array, uint8: Uint8Array,
+                      int32: Int32Array},
+        ARRAYS = "application/x-phoray-arrays", ALIGNMENT = 8;
+
+    // Ask for arrays as raw buffers, and call back with the unpacked
+    // result, or null if there was none.
+    function requestArrays(method, url, body, callback) {
+        var xhr = new XMLHttpRequest();
+        xhr.open(method, url, true);
+        xhr.responseType = "arraybuffer";
+        xhr.setRequestHeader("Accept", ARRAYS + ", application/json");
+        if (body !== null)
+            xhr.setRequestHeader('Content-Type',
+                                 'application/json; charset=UTF-8');
+        xhr.onloadend = function () {
+            var packed = (xhr.status >= 200 && xhr.status < 300 &&
+                          xhr.getResponseHeader("Content-Type") === ARRAYS);
+            if (callback)
+                callback(packed ? Backend.unpack(xhr.response) : null);
+        };
+        xhr.send(body);
+    }
+
+    Backend.getArrays = function (url, callback) {
+        requestArrays("GET", url, null, callback);
+    };
+
+    Backend.postArrays = function (url, data, callback) {
+        requestArrays("POST", url, JSON.stringify(data), callback);
+    };
+
+    Backend.deleteArrays = function (url, callback) {
+        requestArrays("DELETE", url, null, callback);
+    };
+
+    // Unpack a buffer packed by the server, see encoding.py. Only the
+    // small header is parsed, the arrays are views on the buffer.
+    // (The data is little endian, like practically all browsers.)
+    Backend.unpack = function (buffer) {
+        var length = new DataView(buffer).getUint32(0, true),
+            header = new Uint8Array(buffer, 4, length),
+            start = Math.ceil((4 + length) / ALIGNMENT) * ALIGNMENT;
+        return JSON.parse(new TextDecoder().decode(header), function (k, v) {
+            if (v && v.__array__) {
+                var size = v.shape.reduce(function (a, b) {return a * b;}, 1),
+                    array = new arrayTypes[v.dtype](buffer, start + v.offset,
+                                                    size);
+                array.shape = v.shape;
+                return array;
+            }
+            return v;
+        });
+    };
+
+    // The rows of an unpacked 2D array, e.g. vertices, as lists
+    Backend.rows = function (array) {
+        var width = array.shape[1], rows = [];
+        for (var i = 0; i < array.length; i += width)
+            rows.push(Array.prototype.slice.call(array, i, i + width));
+        return rows;
+    };
+
+    // Decode an array encoded by the server as base64, see encoding.py.
+    // Arrays that were unpacked already are returned as they are.
+    Backend.decodeArray = function (encoded) {
+        if (ArrayBuffer.isView(encoded))
+            return encoded;
+        var binary = atob(encoded.data),
+            bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new arrayTypes[encoded.dtype](bytes.buffer);
+    };
+
 })();
 2
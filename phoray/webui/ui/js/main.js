@@ -1,5 +1,7 @@
 Jsonary.getData("system", function (data) {
     var meshes = {}, n_rays = 1000,
+        path_budget = 10000,  // the most ray paths to draw per source
+        footprint_resolution = "200x200",  // pixels in footprint images
         spec_el = document.getElementById("spec");
 
     data.addSchema("system-schema.json");
@@ -98,27 +100,88 @@ Jsonary.getData("system", function (data) {
         if (key in meshes)
             callback(meshes[key]);
         else {
-            Backend.post("mesh", {spec: spec}, function () {
-                var mesh = JSON.parse(this.responseText);
+            Backend.postArrays("mesh", {spec: spec}, function (mesh) {
+                if (mesh)
+                    mesh = {verts: Backend.rows(mesh.verts),
+                            faces: Backend.rows(mesh.faces)};
                 meshes[key] = mesh;
                 callback(mesh);
             });
         }
     };
 
-    // Ask the server to trace the current system
+    // Ask the server to trace the current system. The trace runs as a
+    // job on the server, which streams the paths as they are traced,
+    // so that the picture builds up while the trace goes on. Starting
+    // a new trace cancels the one in progress.
+    var trace_job = null, trace_events = null;
     var trace = function (n) {
         n = n || 1000;
         var t0 = Date.now();
-        Backend.get("/trace?n=" + n, null, function () {
-            var data = JSON.parse(this.responseText);
-            console.log("trace took " + (Date.now() - t0) + " ms.");
-            console.log(data);
-            scene.drawTrace(data.traces);
-            var selpath = tree.getSelectedPath();
+        if (trace_job) {
+            trace_events.close();
+            Backend.deleteArrays("/trace-jobs/" + trace_job, null);
+        }
+        Backend.postArrays("/trace-jobs", {n: n, budget: path_budget},
+                           function (job) {
+            if (job)
+                follow_trace(job.id, t0);
         });
     };
 
+    var follow_trace = function (id, t0) {
+        var traces = {};
+        trace_job = id;
+        trace_events = new EventSource("/trace-jobs/" + id + "/events");
+        trace_events.onmessage = function (e) {
+            var job = JSON.parse(e.data);
+            for (var src in job.traces)
+                traces[src] = concat_paths(traces[src], job.traces[src]);
+            if (job.state === "running" || job.state === "finished") {
+                console.log("traced " + job.done + " of " + job.n +
+                            " rays in " + (Date.now() - t0) + " ms.");
+                scene.drawTrace(traces);
+                if (footprint_element)
+                    footprint(footprint_element);
+            }
+            if (job.state !== "queued" && job.state !== "running") {
+                if (job.error)
+                    console.log("trace failed: " + job.error);
+                trace_events.close();
+                trace_job = null;
+            }
+        };
+        trace_events.onerror = function () {
+            trace_events.close();
+            trace_job = null;
+        };
+    };
+
+    // Append the (encoded) paths of some more rays to the ones so far
+    function concat_paths (paths, more) {
+        more = {vertices: Backend.decodeArray(more.vertices),
+                offsets: Backend.decodeArray(more.offsets),
+                status: Backend.decodeArray(more.status)};
+        if (!paths)
+            return more;
+        var n = paths.offsets.length,
+            offsets = new Uint32Array(n + more.offsets.length - 1),
+            last = paths.offsets[n - 1];
+        offsets.set(paths.offsets);
+        for (var i = 1; i < more.offsets.length; i++)
+            offsets[n + i - 1] = last + more.offsets[i];
+        return {vertices: concat(paths.vertices, more.vertices),
+                offsets: offsets,
+                status: concat(paths.status, more.status)};
+    }
+
+    function concat (a, b) {
+        var c = new a.constructor(a.length + b.length);
+        c.set(a);
+        c.set(b, a.length);
+        return c;
+    }
+
     // Prepare the 3D representation
     var scene = new ThreeScene(document.getElementById("scene"),
                                data.value(), meshes,
@@ -227,19 +290,31 @@ Jsonary.getData("system", function (data) {
     $footprint.dialog({ autoOpen: false, width: 300, height: 300 });
     $footprint.dialog("option", {title: "Footprint"});
 
+    $footprint.on("dialogclose", function () {footprint_element = null;});
+
     function plot_footprint(fpdata, path) {
         //console.log("data", element, fpdata);
         if (fpdata) {
-            $footprint.empty();
             $footprint.dialog("open");
-            d3plot( "#footprint", fpdata.footprint );
+            d3plot.image("#footprint", fpdata.footprint, fpdata.range);
         }
     }
 
+    // Show the footprint of an element, and keep it updated while a
+    // trace is going on. Only one request is made at a time.
+    var footprint_element = null, footprint_pending = false;
     function footprint (element) {
-        console.log("get footprint", element);
-        $.get("/footprint", {element: element},
-              function (data) {plot_footprint(data, element);});
+        footprint_element = element;
+        if (footprint_pending)
+            return;
+        footprint_pending = true;
+        Backend.getArrays("/footprint?element=" + encodeURIComponent(element) +
+                          "&resolution=" + footprint_resolution,
+                          function (data) {
+            footprint_pending = false;
+            if (element === footprint_element)
+                plot_footprint(data, element);
+        });
     };
 
     // Called every time the data is changed, e.g. by the user
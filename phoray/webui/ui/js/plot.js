@@ -44,6 +44,37 @@ var d3plot = {};
                 .domain([ymin - 0.1 * ywidth, ymax + 0.1 * ywidth])
     	        .range([innerHeight*0.95, innerHeight*0.05]);
 
+        var main = makeChart(element, x, y);
+
+        var g = main.append("svg:g");
+
+        var colors = ["red", "violet", "blue"];
+        var colorscale = d3.scale.linear()
+                .domain([0, colors.length - 1])
+                .range([wlmin, wlmax]);
+        var color = d3.scale.linear()
+                .domain(d3.range(colors.length).map(colorscale))
+                .range(colors);
+
+        for (i in data) {
+            g.selectAll("scatter-dots-" + i)
+                .data(data[i])
+                .enter().append("svg:circle")
+                .attr("cx", function (d,i) { return x(d[0]); } )
+                .attr("cy", function (d) { return y(d[1]); } )
+                .attr("r", 1)
+                .attr("fill", function (d) {return color(d[2]);});
+        }
+    };
+
+    // Make an SVG chart in the element, with axes for the given scales
+    function makeChart (element, x, y) {
+        var $el = $(element),
+            width = $el.width(),
+            height = $el.height(),
+            innerWidth = width - (margin.left + margin.right),
+            innerHeight = height - (margin.top + margin.bottom);
+
         var chart = d3.select(element)
 	        .append('svg:svg')
 	        .attr('width', width)
@@ -79,25 +110,58 @@ var d3plot = {};
 	    .attr('class', 'plot axis')
 	    .call(yAxis);
 
-        var g = main.append("svg:g");
 
-        var colors = ["red", "violet", "blue"];
-        var colorscale = d3.scale.linear()
-                .domain([0, colors.length - 1])
-                .range([wlmin, wlmax]);
-        var color = d3.scale.linear()
-                .domain(d3.range(colors.length).map(colorscale))
-                .range(colors);
+        return main;
+    }
 
-        for (i in data) {
-            g.selectAll("scatter-dots-" + i)
-                .data(data[i])
-                .enter().append("svg:circle")
-                .attr("cx", function (d,i) { return x(d[0]); } )
-                .attr("cy", function (d) { return y(d[1]); } )
-                .attr("r", 1)
-                .attr("fill", function (d) {return color(d[2]);});
+    // Plot a density image, i.e. rows of counts with increasing y,
+    // covering the range [[xmin, xmax], [ymin, ymax]]. Any previous
+    // plot in the element is replaced, so that it can be called again
+    // as the image builds up, e.g. while tracing.
+    d3plot.image = function (element, image, range) {
+        d3.select(element).selectAll("svg").remove();
+        var $el = $(element),
+            innerWidth = $el.width() - (margin.left + margin.right),
+            innerHeight = $el.height() - (margin.top + margin.bottom),
+            rows = image.shape[0], columns = image.shape[1];
+
+        var x = d3.scale.linear()
+                .domain(range[0])
+                .range([innerWidth*0.05, innerWidth*0.95]);
+
+        var y = d3.scale.linear()
+                .domain(range[1])
+    	        .range([innerHeight*0.95, innerHeight*0.05]);
+
+        var main = makeChart(element, x, y);
+
+        // Draw the image on a canvas, with the first row at the bottom
+        var canvas = document.createElement("canvas");
+        canvas.width = columns;
+        canvas.height = rows;
+        var context = canvas.getContext("2d"),
+            pixels = context.createImageData(columns, rows),
+            max = 0, i, j;
+        for (i = 0; i < image.length; i++)
+            max = Math.max(max, image[i]);
+        for (j = 0; j < rows; j++) {
+            for (i = 0; i < columns; i++) {
+                var p = 4 * ((rows - 1 - j) * columns + i);
+                pixels.data[p] = 255;
+                pixels.data[p + 1] = 255;
+                pixels.data[p + 2] = 136;
+                pixels.data[p + 3] = max ? 255 * image[j * columns + i] / max : 0;
+            }
         }
+        context.putImageData(pixels, 0, 0);
+
+        main.append("svg:image")
+            .attr("x", x(range[0][0]))
+            .attr("y", y(range[1][1]))
+            .attr("width", x(range[0][1]) - x(range[0][0]))
+            .attr("height", y(range[1][0]) - y(range[1][1]))
+            .attr("preserveAspectRatio", "none")
+            .attr("xlink:href", canvas.toDataURL());
     };
 
     var debounce = function(fn, timeout) {
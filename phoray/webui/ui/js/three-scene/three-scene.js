@@ -303,42 +303,44 @@ var ThreeScene;
         return ~~(r * factor) << 16 ^ ~~(g * factor) << 8 ^ ~~(b * factor);
     };
 
+    // Add line segments along the paths with the given status to
+    // a geometry. The paths are given as columns, see encoding.py.
+    var addPaths = function (geometry, paths, status) {
+        var vertices = paths.vertices, offsets = paths.offsets,
+            i, j, k, m = 0;
+        for (i = 0; i < paths.status.length; i++) {
+            if (paths.status[i] !== status)
+                continue;
+            m++;
+            for (j = offsets[i]; j < offsets[i + 1] - 1; j++) {
+                k = 3 * j;
+                geometry.vertices.push(new THREE.Vector3(
+                    vertices[k], vertices[k + 1], vertices[k + 2]));
+                geometry.vertices.push(new THREE.Vector3(
+                    vertices[k + 3], vertices[k + 4], vertices[k + 5]));
+            }
+        }
+        return m;
+    };
+
+    var SUCCEEDED = 1, FAILED = 0;
+
     var makeTrace = function (data, colors, fancy, alpha) {
 
-	var traces = new THREE.Object3D(), tmpdata, start, end, geometry,
-            trace, line, i, j, n, m;
+	var traces = new THREE.Object3D(), paths, geometry, line, m;
 
         for (var src in data) {
-            tmpdata = data[src];
+            paths = {vertices: Backend.decodeArray(data[src].vertices),
+                     offsets: Backend.decodeArray(data[src].offsets),
+                     status: Backend.decodeArray(data[src].status)};
 
 	    // Draw succeeded rays
             geometry = new THREE.Geometry();
-	    m = tmpdata.succeeded.length;
-	    for (i=0; i < m; i++) {
-		trace = tmpdata.succeeded[i];
-		n = trace.length - 1;
-                for (j=0; j < n; j++ ) {
-                    if (trace[j][0] === NaN) {
-                        break;
-		    }
-                    start = new THREE.Vector3(
-                        trace[j][0], trace[j][1], trace[j][2]),
-                    geometry.vertices.push(start);
-		    end = new THREE.Vector3(
-                        trace[j+1][0], trace[j+1][1], trace[j+1][2]);
-                    geometry.vertices.push(end);
-                }
-            }
-	    //line = new THREE.Line(geometry, self.shaderMaterial, THREE.LinePieces);
+            m = addPaths(geometry, paths, SUCCEEDED);
             var linemat = new THREE.LineDashedMaterial( {
-                //color: color_from_string_times(colors[system], Math.random()),
-                //color: color_from_string_times(colors[system]),
                 color: color_from_string("#ffffff"),
                 opacity: alpha, linewidth: 1,
                 dashSize: 1, gapSize: 0,
-                //dashSize: 0.1, gapSize: 0.4,
-		//blending: THREE.AdditiveBlending,
-                //transparent: true
             });
             if (fancy) {
 		linemat.depthTest = false;
@@ -353,24 +355,9 @@ var ThreeScene;
 
 	    // Draw failed rays
             geometry = new THREE.Geometry();
-	    m = tmpdata.failed.length;
-	    for (i=0; i < m; i++) {
-		trace = tmpdata.failed[i];
-		n = trace.length - 1;
-                for (j=0; j<n; j++ ) {
-                    if (trace[j][0] === NaN)
-                        break;
-                    start = new THREE.Vector3(
-                        trace[j][0], trace[j][1], trace[j][2]);
-                    geometry.vertices.push(start);
-                    end = new THREE.Vector3(
-                        trace[j+1][0], trace[j+1][1], trace[j+1][2]);
-                    geometry.vertices.push(end);
-                }
-	    }
+            addPaths(geometry, paths, FAILED);
             line = new THREE.Line(
                 geometry, new THREE.LineDashedMaterial( {
-                    //color: color_from_string_times(colors[src]),
                     color: "#ff0000",
                     dashSize: 0.1,
                     gapSize: 0.05} ), THREE.LinePieces);